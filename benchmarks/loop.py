@@ -0,0 +1,384 @@
+#!/usr/bin/env python3
+"""
+Offline loop benchmark for orb-lite.
+
+Drives orb-lite's agent loop (`run_task`) through scripted multi-iteration
+scenarios against a fake LiteLLM and a fake Composio toolset, so the loop's
+own cost can be measured without network calls or API spend. LLM latency,
+tool latency, result payload size and tool-call fan-out are configurable.
+
+For each scenario it reports:
+  - overhead per iteration: wall time minus the simulated LLM and tool latency
+  - serialization cost of tool results, per call
+  - growth of the request (messages and tools) sent to the model
+  - throughput in iterations and tool calls per second
+
+Every run is appended to a history file and compared with the median of the
+earlier runs that used the same scenario and settings.
+
+Usage:
+    python benchmarks/loop.py [--scenario fanout ...] [--runs 3] [--iterations 10]
+                              [--fan-out 4] [--payload-kb 8] [--llm-latency-ms 0]
+                              [--tool-latency-ms 0] [--fail-on-regression]
+"""
+
+import argparse
+import asyncio
+import contextlib
+import importlib.util
+import json
+import math
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import types
+from types import SimpleNamespace
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRIPT = os.path.join(ROOT, "orb-lite.py")
+HISTORY_FILE = os.path.join(ROOT, "benchmarks", "loop-history.jsonl")
+# Earlier runs the baseline is taken from
+HISTORY_WINDOW = 5
+# Differences below this many milliseconds per iteration are treated as noise
+NOISE_FLOOR_MS = 0.05
+
+TOOL_CODE = '''import time
+
+def bench_transform(call, latency, records):
+    time.sleep(latency)
+    return {"call": call, "items": [{"id": i, "title": f"Record {i}", "body": "lorem ipsum " * 16, "tags": ["bench", "orb"]} for i in range(records)]}
+'''
+
+# ------------------------------------------------------------------------------
+# Scenarios
+# ------------------------------------------------------------------------------
+
+def composio_call(iteration, call):
+    return ["COMPOSIO_EXECUTE_ACTION", {"action": f"BENCH_FETCH_RECORDS_{call}", "params": {"iteration": iteration, "call": call}}]
+
+def fanout_plan(iteration, config):
+    return [composio_call(iteration, call) for call in range(config.fan_out)]
+
+def sequential_plan(iteration, config):
+    return [composio_call(iteration, 0)]
+
+def large_payload_plan(iteration, config):
+    return [["COMPOSIO_EXECUTE_ACTION", {"action": "BENCH_FETCH_LARGE", "params": {"iteration": iteration}}]]
+
+def dynamic_tool_plan(iteration, config):
+    if iteration == 0:
+        return [["create_or_update_tool", {
+            "name": "bench_transform",
+            "code": TOOL_CODE,
+            "description": "Benchmark tool that returns a payload after a delay.",
+            "parameters": {
+                "call": {"type": "integer", "description": "Call number."},
+                "latency": {"type": "number", "description": "Seconds to sleep."},
+                "records": {"type": "integer", "description": "Records to return."},
+            },
+        }]]
+    return [["bench_transform", {"call": call, "latency": config.tool_latency_ms / 1000, "records": len(config.payload)}]
+            for call in range(config.fan_out)]
+
+SCENARIOS = {
+    "fanout": (fanout_plan, "--fan-out parallel Composio actions per iteration"),
+    "sequential": (sequential_plan, "one Composio action per iteration"),
+    "large_payload": (large_payload_plan, "one Composio action returning 8x --payload-kb"),
+    "dynamic_tool": (dynamic_tool_plan, "create a tool, then call it --fan-out times per iteration in the sandbox"),
+}
+
+def make_payload(kilobytes):
+    """A list of record dicts whose JSON is about `kilobytes` KiB."""
+    records, size = [], 0
+    while size < kilobytes * 1024:
+        record = {"id": len(records), "title": f"Record {len(records)}", "body": "lorem ipsum " * 16, "tags": ["bench", "orb"]}
+        records.append(record)
+        size += len(json.dumps(record)) + 2
+    return records
+
+# ------------------------------------------------------------------------------
+# Fake backends
+# ------------------------------------------------------------------------------
+
+class FakeLLM:
+    """Stands in for litellm.acompletion, streaming a scripted response per call."""
+
+    def __init__(self, plan, config):
+        self.plan = plan
+        self.config = config
+        self.calls = 0
+        self.request_bytes = []
+        self.tool_calls = []
+
+    def reset(self):
+        self.calls = 0
+        self.request_bytes = []
+        self.tool_calls = []
+
+    def calls_for(self, iteration):
+        if iteration >= self.config.iterations - 1:
+            return [["task_completed", {}]]
+        return self.plan(iteration, self.config)
+
+    async def acompletion(self, model, messages, tools=None, **kwargs):
+        # LiteLLM serializes the whole request; do the same so its cost is counted
+        request = json.dumps({"model": model, "messages": messages, "tools": tools}, default=str)
+        self.request_bytes.append(len(request))
+        iteration = self.calls
+        self.calls += 1
+        calls = self.calls_for(iteration)
+        self.tool_calls.append([name for name, _ in calls])
+        latency = self.config.llm_latency_ms / 1000
+
+        def chunk(content=None, tool_calls=None):
+            return SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=content, tool_calls=tool_calls))], usage=None)
+
+        async def stream():
+            if latency:
+                await asyncio.sleep(latency)
+            yield chunk(content=f"Iteration {iteration}: continuing with the task.")
+            for index, (name, args) in enumerate(calls):
+                function = SimpleNamespace(name=name, arguments=json.dumps(args))
+                yield chunk(tool_calls=[SimpleNamespace(index=index, id=f"call_{iteration}_{index}", function=function)])
+            yield SimpleNamespace(choices=[], usage=SimpleNamespace(prompt_tokens=len(request) // 4, completion_tokens=20 + 10 * len(calls)))
+
+        return stream()
+
+class FakeToolSet:
+    """Stands in for composio_openai.ComposioToolSet."""
+
+    def __init__(self, config):
+        self.config = config
+        self.large_payload = make_payload(config.payload_kb * 8)
+
+    def get_tools(self, apps):
+        def schema(name, description):
+            return {"type": "function", "function": {"name": name, "description": description, "parameters": {
+                "type": "object",
+                "properties": {"action": {"type": "string"}, "params": {"type": "object"}, "tool": {"type": "string"}},
+            }}}
+        schemas = [
+            schema("COMPOSIO_EXECUTE_ACTION", "Execute a Composio action."),
+            schema("COMPOSIO_INITIATE_CONNECTION", "Connect a Composio app."),
+        ]
+        # Extra tools so tool selection has something to rank
+        schemas += [schema(f"BENCH_TOOL_{i}", f"Benchmark tool number {i} for records and reports.") for i in range(self.config.extra_tools)]
+        return schemas
+
+    def get_entity(self, id):
+        connection = SimpleNamespace(status="ACTIVE")
+        return SimpleNamespace(get_connection=lambda app: connection)
+
+    def execute_action(self, action, params):
+        if self.config.tool_latency_ms:
+            time.sleep(self.config.tool_latency_ms / 1000)
+        payload = self.large_payload if str(action).endswith("LARGE") else self.config.payload
+        return {"successfull": True, "data": {"action": str(action), "items": payload}}
+
+def install_fakes(llm, toolset):
+    """Registers fake litellm and composio_openai modules for orb-lite's lazy imports."""
+    litellm = types.ModuleType("litellm")
+    litellm.acompletion = llm.acompletion
+    composio = types.ModuleType("composio_openai")
+    composio.App = SimpleNamespace(COMPOSIO="composio")
+    composio.ComposioToolSet = lambda: toolset
+    sys.modules["litellm"] = litellm
+    sys.modules["composio_openai"] = composio
+
+def load_orb():
+    spec = importlib.util.spec_from_file_location("orb_lite", SCRIPT)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+# ------------------------------------------------------------------------------
+# Measurement
+# ------------------------------------------------------------------------------
+
+def simulated_seconds(orb, llm, scenario, config):
+    """The latency the fakes add: the LLM delay per call plus tool delays, by parallel waves."""
+    parallel = orb.MAX_PARALLEL_TOOL_CALLS
+    if scenario == "dynamic_tool" and orb.SANDBOX_ENABLED:
+        parallel = min(parallel, orb.SANDBOX_WORKERS)
+    total = 0.0
+    for names in llm.tool_calls:
+        total += config.llm_latency_ms / 1000
+        slow = [name for name in names if name not in ("task_completed", "create_or_update_tool")]
+        if slow:
+            total += math.ceil(len(slow) / parallel) * config.tool_latency_ms / 1000
+    return total
+
+def run_once(orb, llm, scenario, config, serialize_times, trace_memory):
+    llm.reset()
+    serialize_times.clear()
+    session = orb.Session(orb.ToolRegistry(parent=orb.registry), interactive=False, policy={"loop": "continue"}, label=scenario)
+    if trace_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        result = asyncio.run(orb.run_task(f"Benchmark scenario {scenario}", session))
+    wall = time.perf_counter() - start
+    peak = None
+    if trace_memory:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    if result["outcome"] != "completed":
+        raise RuntimeError(f"scenario {scenario} ended with {result['outcome']}")
+
+    iterations = llm.calls
+    tool_calls = sum(len(names) for names in llm.tool_calls)
+    overhead = max(0.0, wall - simulated_seconds(orb, llm, scenario, config))
+    requests = llm.request_bytes
+    return {
+        "wall_s": wall,
+        "iterations": iterations,
+        "tool_calls": tool_calls,
+        "overhead_ms_per_iteration": overhead * 1000 / iterations,
+        "serialize_ms_per_call": statistics.mean(serialize_times) * 1000 if serialize_times else 0.0,
+        "request_kb_first": requests[0] / 1024,
+        "request_kb_last": requests[-1] / 1024,
+        "request_kb_growth_per_iteration": (requests[-1] - requests[0]) / 1024 / max(1, len(requests) - 1),
+        "iterations_per_s": iterations / wall,
+        "tool_calls_per_s": tool_calls / wall,
+        "peak_memory_kb": peak / 1024 if peak is not None else None,
+    }
+
+def summarize_runs(runs):
+    """Medians across runs, so one noisy run does not decide the result."""
+    return {key: statistics.median(run[key] for run in runs) if runs[0][key] is not None else None for key in runs[0]}
+
+# ------------------------------------------------------------------------------
+# History
+# ------------------------------------------------------------------------------
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+def load_history(path):
+    try:
+        with open(path) as f:
+            return [json.loads(line) for line in f if line.strip()]
+    except (OSError, ValueError):
+        return []
+
+def baseline_for(history, scenario, settings):
+    matching = [entry for entry in history if entry["scenario"] == scenario and entry["settings"] == settings]
+    recent = matching[-HISTORY_WINDOW:]
+    if not recent:
+        return None
+    return statistics.median(entry["metrics"]["overhead_ms_per_iteration"] for entry in recent)
+
+def compare(metrics, baseline, tolerance):
+    """Returns (label, is_regression) for the overhead against the baseline."""
+    if baseline is None:
+        return "new baseline", False
+    current = metrics["overhead_ms_per_iteration"]
+    change = (current - baseline) / baseline if baseline else 0.0
+    label = f"{change:+.0%} vs {baseline:.2f} ms"
+    if current - baseline > NOISE_FLOOR_MS and change > tolerance:
+        return f"REGRESSION {label}", True
+    return label, False
+
+# ------------------------------------------------------------------------------
+# Main
+# ------------------------------------------------------------------------------
+
+def main():
+    scenario_help = "\n".join(f"  {name:<14} {description}" for name, (_, description) in sorted(SCENARIOS.items()))
+    parser = argparse.ArgumentParser(description=__doc__, epilog=f"scenarios:\n{scenario_help}", formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenario", action="append", choices=sorted(SCENARIOS), help="Scenario to run; repeatable. Defaults to all.")
+    parser.add_argument("--runs", type=int, default=3, help="Measured runs per scenario.")
+    parser.add_argument("--warmup", type=int, default=1, help="Unmeasured runs per scenario (sandbox start-up, caches).")
+    parser.add_argument("--iterations", type=int, default=10, help="Loop iterations per run, including the final task_completed.")
+    parser.add_argument("--fan-out", type=int, default=4, help="Tool calls per iteration in the fan-out scenarios.")
+    parser.add_argument("--payload-kb", type=int, default=8, help="Approximate size of each tool result.")
+    parser.add_argument("--llm-latency-ms", type=float, default=0, help="Simulated time to first chunk per completion.")
+    parser.add_argument("--tool-latency-ms", type=float, default=0, help="Simulated latency per tool call.")
+    parser.add_argument("--extra-tools", type=int, default=30, help="Additional fake Composio tools in the registry.")
+    parser.add_argument("--tracemalloc", action="store_true", help="Also report peak Python memory per run (slower).")
+    parser.add_argument("--history", default=HISTORY_FILE, help="JSONL file runs are appended to and compared against.")
+    parser.add_argument("--no-history", action="store_true", help="Neither read nor write the history file.")
+    parser.add_argument("--tolerance", type=float, default=0.15, help="Allowed relative overhead increase before flagging a regression.")
+    parser.add_argument("--fail-on-regression", action="store_true", help="Exit with status 1 if any scenario regressed.")
+    config = parser.parse_args()
+    if not 2 <= config.iterations <= 50:
+        parser.error("--iterations must be between 2 and 50 (the loop's iteration limit)")
+    config.payload = make_payload(config.payload_kb)
+    scenarios = config.scenario or sorted(SCENARIOS)
+    history_path = os.path.abspath(config.history)
+
+    # orb-lite keeps its caches in the working directory; keep them out of the repo
+    workdir = tempfile.mkdtemp(prefix="orb-lite-bench-")
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    os.environ.setdefault("ORB_TRACE", "0")
+    os.environ.setdefault("ORB_RESULT_CACHE", "0")
+    # Every scenario iteration must really run its calls; answering repeats from memory would hide the cost
+    os.environ.setdefault("ORB_DEDUPE_TOOL_CALLS", "0")
+    llm = FakeLLM(None, config)
+    install_fakes(llm, FakeToolSet(config))
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        orb = load_orb()
+
+    serialize_times = []
+    serialize_tool_result = orb.serialize_tool_result
+
+    def timed_serialize(result, budget):
+        start = time.perf_counter()
+        try:
+            return serialize_tool_result(result, budget)
+        finally:
+            serialize_times.append(time.perf_counter() - start)
+
+    orb.serialize_tool_result = timed_serialize
+
+    settings = {
+        "iterations": config.iterations, "fan_out": config.fan_out, "payload_kb": config.payload_kb,
+        "llm_latency_ms": config.llm_latency_ms, "tool_latency_ms": config.tool_latency_ms,
+        "extra_tools": config.extra_tools, "python": platform.python_version(),
+    }
+    history = [] if config.no_history else load_history(history_path)
+    regressions = []
+
+    print(f"{'scenario':<14} {'overhead/iter':>14} {'serialize/call':>15} {'request KB':>16} {'KB/iter':>8} {'iter/s':>8} {'calls/s':>8}  baseline")
+    try:
+        for scenario in scenarios:
+            llm.plan = SCENARIOS[scenario][0]
+            for _ in range(config.warmup):
+                run_once(orb, llm, scenario, config, serialize_times, False)
+            runs = [run_once(orb, llm, scenario, config, serialize_times, config.tracemalloc) for _ in range(config.runs)]
+            metrics = summarize_runs(runs)
+            label, regressed = compare(metrics, baseline_for(history, scenario, settings), config.tolerance)
+            if regressed:
+                regressions.append(scenario)
+            print(f"{scenario:<14} {metrics['overhead_ms_per_iteration']:11.2f} ms {metrics['serialize_ms_per_call']:12.3f} ms "
+                  f"{metrics['request_kb_first']:7.1f} -> {metrics['request_kb_last']:6.1f} {metrics['request_kb_growth_per_iteration']:8.1f} "
+                  f"{metrics['iterations_per_s']:8.1f} {metrics['tool_calls_per_s']:8.1f}  {label}")
+            if metrics["peak_memory_kb"] is not None:
+                print(f"{'':<14} peak traced memory {metrics['peak_memory_kb'] / 1024:.1f} MiB")
+
+            if not config.no_history:
+                entry = {"timestamp": time.time(), "revision": git_revision(), "scenario": scenario, "settings": settings, "metrics": metrics}
+                with open(history_path, "a") as f:
+                    f.write(json.dumps(entry) + "\n")
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if regressions:
+        print(f"Overhead regressed in: {', '.join(regressions)}")
+        if config.fail_on_regression:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
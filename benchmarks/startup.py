@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+"""
+Startup-time benchmark for orb-lite.
+
+Measures how long `python orb-lite.py` takes to reach the task prompt, and
+compares it with the cost of importing the heavy dependencies that used to
+sit on the startup path (composio_openai, litellm, langchain_core).
+
+Usage:
+    python benchmarks/startup.py [--runs 5]
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRIPT = os.path.join(ROOT, "orb-lite.py")
+PROMPT = b"Describe the task you want to complete"
+EAGER_IMPORTS = "import composio_openai, litellm, langchain_core.tools"
+
+
+def time_to_prompt():
+    """Starts orb-lite and returns the seconds until the task prompt is printed."""
+    start = time.perf_counter()
+    proc = subprocess.Popen(
+        [sys.executable, SCRIPT],
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        cwd=ROOT,
+    )
+    seen = b""
+    try:
+        while PROMPT not in seen:
+            chunk = proc.stdout.read1(4096)
+            if not chunk:
+                raise RuntimeError("orb-lite exited before showing the task prompt")
+            seen += chunk
+        return time.perf_counter() - start
+    finally:
+        proc.kill()
+        proc.wait()
+
+
+def time_eager_imports():
+    """Returns the seconds a fresh interpreter spends importing the heavy dependencies."""
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, "-c", EAGER_IMPORTS], cwd=ROOT, capture_output=True)
+    if result.returncode != 0:
+        return None
+    return time.perf_counter() - start
+
+
+def summarize(label, samples):
+    print(f"{label:<28} median {statistics.median(samples) * 1000:8.1f} ms   "
+          f"min {min(samples) * 1000:8.1f} ms   max {max(samples) * 1000:8.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5, help="Number of runs per measurement.")
+    args = parser.parse_args()
+
+    summarize("orb-lite to task prompt", [time_to_prompt() for _ in range(args.runs)])
+
+    eager = [time_eager_imports() for _ in range(args.runs)]
+    if None in eager:
+        print("Heavy dependencies are not importable here; skipping the eager-import baseline.")
+    else:
+        summarize("eager heavy imports", eager)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,12 +2,29 @@
 
 import os
 import json
+import asyncio
 import traceback
 import subprocess
 import sys
 import time
-from time import sleep
+import random
+import hashlib
+import math
+import re
+import marshal
+import types
+import pickle
+import shutil
+import atexit
+import threading
+import argparse
+import mmap
+import sqlite3
+import contextvars
+from collections import defaultdict, OrderedDict, Counter, deque
+from contextlib import contextmanager
 from functools import wraps
+from concurrent.futures import ThreadPoolExecutor
 import warnings
 
 # Suppress pydantic warning about removed config keys
@@ -17,9 +34,6 @@ warnings.filterwarnings("ignore", message="Valid config keys have changed in V2"
 warnings.filterwarnings("ignore", category=UserWarning, module="composio.*")
 
 from dotenv import load_dotenv
-from composio_openai import ComposioToolSet, App, Action
-from langchain_core.tools import tool
-from litellm import completion
 
 # ------------------------------------------------------------------------------
 # Environment Setup
@@ -40,40 +54,640 @@ class Colors:
     BOLD = '\033[1m'
     UNDERLINE = '\033[4m'
 
-# Initialize Composio toolset
-toolset = ComposioToolSet()
-
 # Global data
-tools = []
-available_functions = {}
 connection_cache = {}
 CONNECTIONS_FILE = ".composio.connections"
+SCHEMA_CACHE_FILE = ".composio.schemas"
+SCHEMA_CACHE_TTL = float(os.environ.get('ORB_SCHEMA_CACHE_TTL', '86400'))
 MAX_TOOL_OUTPUT_LENGTH = 5000
+# Per-tool output budgets in characters, keyed by tool or Composio action name
+TOOL_OUTPUT_BUDGETS = json.loads(os.environ.get('ORB_TOOL_OUTPUT_BUDGETS') or '{}')
 MAX_ITERATIONS_BEFORE_BREAK = 10
+# Consecutive tool-call iterations that only repeat earlier (call, result)
+# pairs before the loop detector escalates
+LOOP_NO_PROGRESS_LIMIT = int(os.environ.get('ORB_LOOP_NO_PROGRESS_LIMIT', '3'))
+# Longest repeating run of iterations recognized as a cycle
+LOOP_MAX_CYCLE = 3
+# Answer repeated identical tool calls from their earlier result
+DEDUPE_TOOL_CALLS = os.environ.get('ORB_DEDUPE_TOOL_CALLS', '1') != '0'
+MAX_PARALLEL_TOOL_CALLS = int(os.environ.get('ORB_MAX_PARALLEL_TOOL_CALLS', '8'))
+ERROR_BACKOFF_BASE = float(os.environ.get('ORB_ERROR_BACKOFF_BASE', '1'))
+ERROR_BACKOFF_MAX = float(os.environ.get('ORB_ERROR_BACKOFF_MAX', '30'))
+CONNECTION_CACHE_TTL = float(os.environ.get('ORB_CONNECTION_CACHE_TTL', '3600'))
+CONTEXT_TOKEN_BUDGET = int(os.environ.get('ORB_CONTEXT_TOKEN_BUDGET', '64000'))
+CONTEXT_KEEP_RECENT = int(os.environ.get('ORB_CONTEXT_KEEP_RECENT', '6'))
+CONTEXT_STUB_PREVIEW = 200
+RETRY_MAX_ATTEMPTS = int(os.environ.get('ORB_RETRY_MAX_ATTEMPTS', '4'))
+RETRY_BASE_DELAY = float(os.environ.get('ORB_RETRY_BASE_DELAY', '0.5'))
+RETRY_MAX_DELAY = float(os.environ.get('ORB_RETRY_MAX_DELAY', '30'))
+BREAKER_FAILURE_THRESHOLD = int(os.environ.get('ORB_BREAKER_FAILURE_THRESHOLD', '3'))
+BREAKER_COOLDOWN = float(os.environ.get('ORB_BREAKER_COOLDOWN', '60'))
+# Requests per minute per LLM provider ("llm:openai") or Composio app
+# ("composio:gmail"); a bare prefix ("composio") or "*" sets a default.
+# Limits reported in response headers are learned on top of these.
+RATE_LIMITS = json.loads(os.environ.get('ORB_RATE_LIMITS') or '{}')
+# Limiter state shared (under flock) with other orb-lite processes in this directory
+RATE_LIMIT_FILE = ".orb-lite.ratelimits.json"
+RATE_LIMIT_SHARED = os.environ.get('ORB_RATE_LIMIT_SHARED', '1') != '0'
+# Share of each bucket that batch sessions leave to interactive ones
+RATE_LIMIT_RESERVE = float(os.environ.get('ORB_RATE_LIMIT_RESERVE', '0.2'))
+# Bucket size in seconds of refill
+RATE_LIMIT_BURST_SECONDS = 10
+# Hold-back after a rate-limit error without Retry-After, doubling on repeats
+RATE_LIMIT_PENALTY = 2.0
+RATE_LIMIT_MAX_PENALTY = 60.0
+# Longest single sleep before the limiter is asked again
+RATE_LIMIT_MAX_SLEEP = 1.0
+TOOLS_DIR = ".orb-lite.tools"
+TOOL_RELOAD_ENABLED = os.environ.get('ORB_RELOAD_TOOLS', '1') != '0'
+SANDBOX_ENABLED = os.environ.get('ORB_SANDBOX_TOOLS', '1') != '0'
+SANDBOX_WORKERS = int(os.environ.get('ORB_SANDBOX_WORKERS', str(min(4, os.cpu_count() or 1))))
+SANDBOX_TIMEOUT = float(os.environ.get('ORB_SANDBOX_TIMEOUT', '60'))
+SANDBOX_MAX_CALLS_PER_WORKER = int(os.environ.get('ORB_SANDBOX_MAX_CALLS', '50'))
+SANDBOX_MEMORY_LIMIT_MB = int(os.environ.get('ORB_SANDBOX_MEMORY_MB', '1024'))
+SANDBOX_CPU_LIMIT_SECONDS = int(os.environ.get('ORB_SANDBOX_CPU_SECONDS', '300'))
+# Pickled results above this many bytes are handed over through shared memory
+SANDBOX_SHM_THRESHOLD = 1024 * 1024
+WHEEL_CACHE_DIR = ".orb-lite.wheels"
+# Longest an install request waits for other installs from the same turn
+INSTALL_BATCH_MAX_WAIT = float(os.environ.get('ORB_INSTALL_BATCH_WAIT', '2'))
+# Full copies of truncated tool results, paged with read_result/query_result
+SPILL_ENABLED = os.environ.get('ORB_SPILL', '1') != '0'
+SPILL_DIR = ".orb-lite.spill"
+# Spilled results older than this many seconds are pruned
+SPILL_TTL = float(os.environ.get('ORB_SPILL_TTL', str(7 * 86400)))
+SPILL_OPEN_MAPS = 16
+RESULT_CACHE_ENABLED = os.environ.get('ORB_RESULT_CACHE', '0') == '1'
+RESULT_CACHE_DIR = ".orb-lite.results"
+RESULT_CACHE_TTL = float(os.environ.get('ORB_RESULT_CACHE_TTL', '300'))
+# Per-action TTLs in seconds, keyed by action name or prefix (e.g. "TWITTER_")
+RESULT_CACHE_TTLS = json.loads(os.environ.get('ORB_RESULT_CACHE_TTLS') or '{}')
+RESULT_CACHE_MAX_ENTRIES = int(os.environ.get('ORB_RESULT_CACHE_MAX_ENTRIES', '256'))
+TOOL_SELECTION_TOP_K = int(os.environ.get('ORB_TOOL_TOP_K', '12'))
+# Tools sent on every request regardless of relevance
+PINNED_TOOLS = {
+    "create_or_update_tool", "install_package", "task_completed",
+    "COMPOSIO_INITIATE_CONNECTION", "COMPOSIO_EXECUTE_ACTION",
+    "read_result", "query_result",
+}
+TRACE_ENABLED = os.environ.get('ORB_TRACE', '1') != '0'
+TRACE_FILE = os.environ.get('ORB_TRACE_FILE', '.orb-lite.trace.jsonl')
+SESSIONS_DIR = ".orb-lite.sessions"
+CHECKPOINT_ENABLED = os.environ.get('ORB_CHECKPOINTS', '1') != '0'
+# Session logs are flushed on every record but fsynced at most this often (seconds)
+CHECKPOINT_FSYNC_INTERVAL = float(os.environ.get('ORB_CHECKPOINT_FSYNC_INTERVAL', '1'))
+MEMORY_ENABLED = os.environ.get('ORB_MEMORY', '1') != '0'
+MEMORY_FILE = os.environ.get('ORB_MEMORY_FILE', '.orb-lite.memory.db')
+# Notes from earlier tasks added to the start of a new task
+MEMORY_RECALL_LIMIT = int(os.environ.get('ORB_MEMORY_RECALL', '6'))
+# Characters of indexed text kept per entry, and of each remembered param value
+MEMORY_TEXT_LIMIT = 2000
+MEMORY_VALUE_PREVIEW = 80
+PREFETCH_ENABLED = os.environ.get('ORB_PREFETCH', '1') != '0'
+# Speculatively executing read-only actions is opt-in; by default only connections are warmed
+PREFETCH_RESULTS = os.environ.get('ORB_PREFETCH_RESULTS', '0') == '1'
+PREFETCH_WORKERS = int(os.environ.get('ORB_PREFETCH_WORKERS', '2'))
+# Most speculative jobs started from a single turn
+PREFETCH_MAX_PER_TURN = 4
+# Mark cache_control breakpoints in requests: "auto" for providers that need
+# them (Anthropic), "1" always, "0" never
+PROMPT_CACHE_BREAKPOINTS = os.environ.get('ORB_PROMPT_CACHE_BREAKPOINTS', 'auto')
+# Model pools by role, comma-separated: "strong" models plan and author tools,
+# "fast" models handle routine dispatch turns (defaults to the strong pool)
+STRONG_MODELS = [m.strip() for m in os.environ.get('ORB_STRONG_MODELS', MODEL_NAME).split(',') if m.strip()]
+FAST_MODELS = [m.strip() for m in os.environ.get('ORB_FAST_MODELS', '').split(',') if m.strip()] or STRONG_MODELS
+ROUTER_LATENCY_WINDOW = 50
+ROUTER_MIN_SAMPLES = 3
+HEDGE_ENABLED = os.environ.get('ORB_HEDGE', '1') != '0'
+# Seconds without a first chunk before a second model is started, or "p95"
+# to use the first model's observed p95 (at least ORB_HEDGE_MIN_DELAY)
+HEDGE_DELAY = os.environ.get('ORB_HEDGE_DELAY', 'p95')
+HEDGE_MIN_DELAY = float(os.environ.get('ORB_HEDGE_MIN_DELAY', '1'))
+# Hedge delay while a model has too few samples for a p95
+HEDGE_DEFAULT_DELAY = 5.0
+BATCH_CONCURRENCY = int(os.environ.get('ORB_BATCH_CONCURRENCY', '4'))
+# What headless sessions answer instead of prompting: authorization is
+# "skip" or "stop", a detected loop is "continue" or "stop"
+HEADLESS_POLICY = {
+    "authorization": os.environ.get('ORB_ON_AUTHORIZATION', 'skip'),
+    "loop": os.environ.get('ORB_ON_LOOP', 'stop'),
+}
+
+# Shared pool for dispatching a turn's tool calls concurrently
+tool_executor = ThreadPoolExecutor(max_workers=max(1, MAX_PARALLEL_TOOL_CALLS), thread_name_prefix="orb-tool")
+# Background pool for speculative prefetches; see Prefetcher
+prefetch_executor = ThreadPoolExecutor(max_workers=max(1, PREFETCH_WORKERS), thread_name_prefix="orb-prefetch")
+# Serializes interactive prompts raised from concurrently running tool calls
+input_lock = threading.RLock()
+# Guards connection_cache and its CONNECTIONS_FILE snapshot
+connection_lock = threading.Lock()
 
-# Automatically detect environment variables that look like API keys
+# The Composio toolset is built on first use; see get_toolset()
+_toolset = None
+_toolset_lock = threading.Lock()
+_composio_tools_registered = False
+
+# Automatically detect environment variables that look like API keys. Only
+# their names go into the prompt; tools read the values from os.environ.
 api_key_patterns = ['API_KEY', 'ACCESS_TOKEN', 'SECRET_KEY', 'TOKEN', 'APISECRET']
-available_api_keys = [
+available_api_keys = sorted(
     key for key in os.environ.keys()
     if any(pattern in key.upper() for pattern in api_key_patterns)
-]
+)
 api_keys_info = "\n".join(
-    [f"- {key}: {os.environ.get(key)}" for key in available_api_keys]
+    [f"- {key}" for key in available_api_keys]
 ) if available_api_keys else "No API keys detected. Ensure they are set as environment variables."
 
+# ------------------------------------------------------------------------------
+# Tracing
+# ------------------------------------------------------------------------------
+
+def percentile(samples, fraction):
+    """Nearest-rank percentile of a non-empty list of numbers."""
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, max(0, int(round(fraction * len(ordered))) - 1))]
+
+class Tracer:
+    """
+    Records timed spans and appends them to a JSONL file in batches.
+
+    A span is a dict that callers can annotate while it is open (tokens,
+    payload sizes, retries, outcome). Recording costs a perf_counter pair
+    and a list append; lines are written every `flush_every` spans and at
+    exit, and percentiles are only computed for the end-of-run summary.
+    """
+
+    def __init__(self, path=TRACE_FILE, enabled=TRACE_ENABLED, flush_every=64):
+        self.path = path
+        self.enabled = enabled
+        self.flush_every = flush_every
+        self._buffer = []
+        self._durations = defaultdict(list)
+        self._errors = defaultdict(int)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    @contextmanager
+    def span(self, kind, name=None, **attrs):
+        """Times the enclosed block and yields its span dict for annotation."""
+        record = {"span": kind, "name": name or kind, **attrs}
+        if not self.enabled:
+            yield record
+            return
+        stack = self._local.__dict__.setdefault("stack", [])
+        stack.append(record)
+        record["ts"] = time.time()
+        start = time.perf_counter()
+        try:
+            yield record
+            record.setdefault("outcome", "ok")
+        except BaseException as e:
+            record["outcome"] = "error"
+            record["error"] = type(e).__name__
+            raise
+        finally:
+            record["ms"] = round((time.perf_counter() - start) * 1000, 3)
+            # Coroutines sharing a thread may close spans out of order
+            stack.remove(record)
+            self._record(record)
+
+    def annotate(self, **attrs):
+        """Adds attributes to the innermost open span on this thread, if any."""
+        stack = getattr(self._local, "stack", None)
+        if stack:
+            stack[-1].update(attrs)
+
+    def _record(self, record):
+        with self._lock:
+            self._buffer.append(record)
+            key = (record["span"], record["name"])
+            self._durations[key].append(record["ms"])
+            if record["outcome"] not in ("ok", "cached"):
+                self._errors[key] += 1
+            if len(self._buffer) >= self.flush_every:
+                self._flush_locked()
+
+    def _flush_locked(self):
+        if not self._buffer:
+            return
+        try:
+            with open(self.path, "a") as f:
+                f.write("".join(json.dumps(record, default=str) + "\n" for record in self._buffer))
+        except OSError as e:
+            print(f"{Colors.WARNING}Could not write trace file: {e}{Colors.ENDC}")
+        self._buffer.clear()
+
+    def flush(self):
+        with self._lock:
+            self._flush_locked()
+
+    def summary_rows(self):
+        """Returns (span, name, count, errors, p50_ms, p95_ms, total_ms) rows, slowest total first."""
+        with self._lock:
+            rows = [
+                (kind, name, len(samples), self._errors[(kind, name)],
+                 percentile(samples, 0.5), percentile(samples, 0.95), sum(samples))
+                for (kind, name), samples in self._durations.items()
+            ]
+        return sorted(rows, key=lambda row: row[-1], reverse=True)
+
+    def print_summary(self):
+        rows = self.summary_rows()
+        if not rows:
+            return
+        print(f"{Colors.HEADER}{Colors.BOLD}Run summary{Colors.ENDC}")
+        print(f"{'span':<26} {'name':<36} {'count':>6} {'errors':>6} {'p50 ms':>10} {'p95 ms':>10} {'total ms':>11}")
+        for kind, name, count, errors, p50, p95, total in rows:
+            print(f"{kind:<26} {str(name)[:36]:<36} {count:>6} {errors:>6} {p50:>10.1f} {p95:>10.1f} {total:>11.1f}")
+
+tracer = Tracer()
+atexit.register(tracer.flush)
+
+# ------------------------------------------------------------------------------
+# Tool Registry
+# ------------------------------------------------------------------------------
+
+class ToolRegistry:
+    """
+    Registered tools indexed by name. The schema list sent to the LLM is
+    cached and only rebuilt after a registration changes it; re-registering
+    a name keeps its position. `version` moves on every change.
+
+    A registry with a `parent` overlays it: lookups fall through to the
+    parent, and tools registered here shadow the parent's without touching
+    it, so a headless session's tools stay its own.
+    """
+
+    def __init__(self, parent=None):
+        self.parent = parent
+        self._functions = {}
+        self._schemas = {}
+        self._sources = {}
+        self._schema_list = None
+        self._parent_version = None
+        self._revision = 0
+        self._lock = threading.Lock()
+
+    @property
+    def version(self):
+        if self.parent is None:
+            return self._revision
+        return (self.parent.version, self._revision)
+
+    def register(self, name, func, schema, source=None):
+        """`source` is a (content hash, code) pair for dynamically created tools."""
+        with self._lock:
+            self._functions[name] = func
+            self._schemas[name] = schema
+            if source:
+                self._sources[name] = source
+            else:
+                self._sources.pop(name, None)
+            self._schema_list = None
+            self._revision += 1
+
+    def get(self, name):
+        func = self._functions.get(name)
+        if func is None and self.parent is not None:
+            return self.parent.get(name)
+        return func
+
+    def __contains__(self, name):
+        return name in self._functions or (self.parent is not None and name in self.parent)
+
+    def __len__(self):
+        return len(self.names())
+
+    def names(self):
+        if self.parent is None:
+            return list(self._functions)
+        return list(dict.fromkeys([*self.parent.names(), *self._functions]))
+
+    def schema(self, name):
+        if name not in self._functions and self.parent is not None:
+            return self.parent.schema(name)
+        return self._schemas.get(name)
+
+    def source(self, name):
+        """The (content hash, code) of a dynamic tool, or None for built-in tools."""
+        if name not in self._functions and self.parent is not None:
+            return self.parent.source(name)
+        return self._sources.get(name)
+
+    def schemas(self):
+        """The cached list of tool schemas, in registration order, parent's first."""
+        parent_version = self.parent.version if self.parent is not None else None
+        schema_list = self._schema_list
+        if schema_list is None or self._parent_version != parent_version:
+            with self._lock:
+                if self.parent is None:
+                    schema_list = list(self._schemas.values())
+                else:
+                    merged = {schema["function"]["name"]: schema for schema in self.parent.schemas()}
+                    merged.update(self._schemas)
+                    schema_list = list(merged.values())
+                self._schema_list = schema_list
+                self._parent_version = parent_version
+        return schema_list
+
+registry = ToolRegistry()
+
+# The session running in the current task or tool thread; None outside sessions
+active_session = contextvars.ContextVar("active_session", default=None)
+
+def current_registry():
+    """The running session's registry, or the shared one outside sessions."""
+    session = active_session.get()
+    return session.registry if session else registry
+
+def tool_code_hash(code):
+    return hashlib.sha256(code.encode()).hexdigest()
+
+def compile_tool(name, code, digest=None):
+    """
+    Compiles tool source once into its own module namespace and returns the
+    tool function. Source and bytecode are persisted under TOOLS_DIR keyed by
+    content hash, so an unchanged tool is never recompiled across sessions.
+    """
+    digest = digest or tool_code_hash(code)
+    bytecode_path = os.path.join(TOOLS_DIR, f"{digest}.{sys.implementation.cache_tag}.bin")
+    try:
+        with open(bytecode_path, "rb") as f:
+            code_object = marshal.load(f)
+    except (OSError, EOFError, ValueError, TypeError):
+        code_object = compile(code, f"<orb-lite tool {name}>", "exec")
+        try:
+            os.makedirs(TOOLS_DIR, exist_ok=True)
+            with open(os.path.join(TOOLS_DIR, f"{digest}.py"), "w") as f:
+                f.write(code)
+            tmp_path = f"{bytecode_path}.{os.getpid()}.tmp"
+            with open(tmp_path, "wb") as f:
+                marshal.dump(code_object, f)
+            os.replace(tmp_path, bytecode_path)
+        except OSError as e:
+            print(f"{Colors.WARNING}Could not persist tool '{name}': {e}{Colors.ENDC}")
+
+    module = types.ModuleType(f"orb_tool_{name}")
+    exec(code_object, module.__dict__)
+    func = module.__dict__.get(name)
+    if not callable(func):
+        raise NameError(f"code does not define a function named '{name}'")
+    return func
+
+def load_tool_manifest():
+    try:
+        with open(os.path.join(TOOLS_DIR, "manifest.json")) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_tool_version(name, digest, description, parameters):
+    """Records the current version of a dynamic tool in the manifest."""
+    manifest = load_tool_manifest()
+    entry = manifest.get(name, {"versions": []})
+    if digest not in entry["versions"]:
+        entry["versions"].append(digest)
+    entry.update({"hash": digest, "description": description, "parameters": parameters, "updated_at": time.time()})
+    manifest[name] = entry
+    try:
+        os.makedirs(TOOLS_DIR, exist_ok=True)
+        write_json_atomic(os.path.join(TOOLS_DIR, "manifest.json"), manifest)
+    except OSError as e:
+        print(f"{Colors.WARNING}Could not persist tool manifest: {e}{Colors.ENDC}")
+
+def load_persisted_tools():
+    """Registers the latest version of every tool created in earlier sessions."""
+    loaded = 0
+    for name, entry in load_tool_manifest().items():
+        try:
+            with open(os.path.join(TOOLS_DIR, f"{entry['hash']}.py")) as f:
+                code = f.read()
+            func = compile_tool(name, code, entry["hash"])
+        except Exception as e:
+            print(f"{Colors.WARNING}Skipping saved tool '{name}': {e}{Colors.ENDC}")
+            continue
+        register_tool(name, func, entry["description"], entry["parameters"], quiet=True, source=(entry["hash"], code))
+        loaded += 1
+    if loaded:
+        print(f"{Colors.OKGREEN}{Colors.BOLD}Reloaded {loaded} saved tool(s){Colors.ENDC}")
+
+# ------------------------------------------------------------------------------
+# Sandboxed Tool Execution
+# ------------------------------------------------------------------------------
+
+SANDBOX_WORKER_FLAG = "--sandbox-worker"
+# Sandbox workers run this script with SANDBOX_WORKER_FLAG as their only argument
+IS_SANDBOX_WORKER = sys.argv[1:2] == [SANDBOX_WORKER_FLAG]
+
+def _apply_sandbox_limits(memory_mb, cpu_seconds):
+    try:
+        import resource
+    except ImportError:
+        return
+    for limit, value in ((resource.RLIMIT_AS, memory_mb * 1024 * 1024), (resource.RLIMIT_CPU, cpu_seconds)):
+        try:
+            resource.setrlimit(limit, (value, value))
+        except (ValueError, OSError):
+            pass
+
+def _write_frame(stream, obj):
+    data = pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
+    stream.write(len(data).to_bytes(8, "big") + data)
+    stream.flush()
+
+def _read_frame(stream):
+    header = stream.read(8)
+    if len(header) < 8:
+        raise EOFError("sandbox pipe closed")
+    size = int.from_bytes(header, "big")
+    data = stream.read(size)
+    if len(data) < size:
+        raise EOFError("sandbox pipe closed")
+    return pickle.loads(data)
+
+def _share_payload(payload):
+    """Copies a large payload into a shared memory segment that the agent unlinks after reading."""
+    from multiprocessing import shared_memory
+    try:
+        shm = shared_memory.SharedMemory(create=True, size=len(payload), track=False)
+    except TypeError:
+        # Python < 3.13 always tracks segments; hand ownership to the agent
+        from multiprocessing import resource_tracker
+        shm = shared_memory.SharedMemory(create=True, size=len(payload))
+        resource_tracker.unregister(shm._name, "shared_memory")
+    shm.buf[:len(payload)] = payload
+    name = shm.name
+    shm.close()
+    return name
+
+def sandbox_worker_main():
+    """
+    Worker loop: reads (name, hash, code, args) frames from stdin, runs the
+    tool and writes back its pickled result, inline or via shared memory
+    when large. Compiled tools are kept per content hash for the worker's
+    lifetime. Anything the tool prints goes to stderr.
+    """
+    _apply_sandbox_limits(SANDBOX_MEMORY_LIMIT_MB, SANDBOX_CPU_LIMIT_SECONDS)
+    replies = os.fdopen(os.dup(sys.stdout.fileno()), "wb")
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    requests = sys.stdin.buffer
+    functions = {}
+    while True:
+        try:
+            name, digest, code, args = _read_frame(requests)
+        except EOFError:
+            return
+        try:
+            func = functions.get(digest)
+            if func is None:
+                func = functions[digest] = compile_tool(name, code, digest)
+            result = func(**args)
+            try:
+                payload = pickle.dumps(("ok", result), protocol=pickle.HIGHEST_PROTOCOL)
+                # Classes defined by the tool itself cannot be unpickled by the agent
+                if b"orb_tool_" in payload:
+                    raise pickle.PicklingError("result references tool-local types")
+            except Exception:
+                payload = pickle.dumps(("ok", json.loads(json.dumps(result, default=str))), protocol=pickle.HIGHEST_PROTOCOL)
+        except BaseException as e:
+            payload = pickle.dumps(("error", f"{type(e).__name__}: {e}"))
+
+        if len(payload) > SANDBOX_SHM_THRESHOLD:
+            _write_frame(replies, ("shm", _share_payload(payload), len(payload)))
+        else:
+            _write_frame(replies, ("inline", payload))
+
+class SandboxWorker:
+    """One warm worker process and the pipes used to talk to it."""
+
+    def __init__(self):
+        self.process = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), SANDBOX_WORKER_FLAG],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+        )
+        self.calls = 0
+        self.timed_out = False
+
+    def _on_timeout(self):
+        # Runs on the timer thread; the calling thread reaps the process
+        self.timed_out = True
+        try:
+            self.process.kill()
+        except OSError:
+            pass
+
+    def call(self, name, digest, code, args, timeout):
+        self.calls += 1
+        timer = threading.Timer(timeout, self._on_timeout)
+        timer.daemon = True
+        timer.start()
+        try:
+            _write_frame(self.process.stdin, (name, digest, code, args))
+            kind, *reply = _read_frame(self.process.stdout)
+        except (EOFError, OSError):
+            self.kill()
+            if self.timed_out:
+                raise TimeoutError(f"Tool '{name}' timed out after {timeout:.0f}s")
+            raise RuntimeError(f"Tool '{name}' crashed its worker (exit code {self.process.returncode})")
+        finally:
+            timer.cancel()
+
+        if kind == "shm":
+            from multiprocessing import shared_memory
+            shm_name, size = reply
+            shm = shared_memory.SharedMemory(name=shm_name)
+            try:
+                payload = bytes(shm.buf[:size])
+            finally:
+                shm.close()
+                shm.unlink()
+        else:
+            payload = reply[0]
+        status, value = pickle.loads(payload)
+        if status == "error":
+            raise RuntimeError(value)
+        return value
+
+    @property
+    def alive(self):
+        return self.process.poll() is None
+
+    def kill(self):
+        try:
+            self.process.kill()
+        except OSError:
+            pass
+        self.process.wait()
+
+    def close(self):
+        try:
+            self.process.stdin.close()
+            self.process.wait(timeout=1)
+        except (OSError, subprocess.TimeoutExpired):
+            self.kill()
+
+class SandboxPool:
+    """
+    Pool of warm worker processes for dynamically created tools. Workers
+    run under `resource` memory and CPU limits and are replaced after
+    `max_calls` calls, a timeout or a crash, so a misbehaving tool never
+    blocks or takes down the agent.
+    """
+
+    def __init__(self, size=SANDBOX_WORKERS, timeout=SANDBOX_TIMEOUT, max_calls=SANDBOX_MAX_CALLS_PER_WORKER):
+        self.size = max(1, size)
+        self.timeout = timeout
+        self.max_calls = max_calls
+        self._idle = []
+        self._warmed = False
+        self._slots = threading.BoundedSemaphore(self.size)
+        self._lock = threading.Lock()
+
+    def warm(self):
+        """Starts the workers ahead of the first call; later calls are no-ops."""
+        with self._lock:
+            if self._warmed:
+                return
+            self._warmed = True
+            self._idle.extend(SandboxWorker() for _ in range(self.size))
+
+    def run(self, name, source, args):
+        digest, code = source
+        with self._slots:
+            with self._lock:
+                worker = self._idle.pop() if self._idle else None
+            if worker is None or not worker.alive:
+                worker = SandboxWorker()
+            try:
+                return worker.call(name, digest, code, args, self.timeout)
+            finally:
+                if worker.alive and worker.calls < self.max_calls:
+                    with self._lock:
+                        self._idle.append(worker)
+                else:
+                    worker.close()
+
+    def shutdown(self):
+        with self._lock:
+            workers, self._idle = self._idle, []
+        for worker in workers:
+            worker.close()
+
+sandbox_pool = SandboxPool()
+atexit.register(sandbox_pool.shutdown)
+
 # ------------------------------------------------------------------------------
 # Helper Functions
 # ------------------------------------------------------------------------------
 
-def register_tool(name, func, description, parameters):
+def register_tool(name, func, description, parameters, quiet=False, source=None, required=None):
     """
-    Registers a tool dynamically by adding it to the toolset.
+    Registers a tool dynamically by adding it to the registry.
     """
-    global tools
-    # Remove any existing definition for this tool
-    tools = [t for t in tools if t["function"]["name"] != name]
-    available_functions[name] = func
-    tools.append({
+    if source and SANDBOX_ENABLED:
+        sandbox_pool.warm()
+    current_registry().register(name, func, {
         "type": "function",
         "function": {
             "name": name,
@@ -81,30 +695,225 @@ def register_tool(name, func, description, parameters):
             "parameters": {
                 "type": "object",
                 "properties": parameters,
-                "required": list(parameters.keys())
+                "required": list(parameters.keys()) if required is None else required
             }
         }
-    })
-    print(f"{Colors.OKGREEN}{Colors.BOLD}Registered tool:{Colors.ENDC} {name}")
+    }, source)
+    session = active_session.get()
+    if source and session and session.log:
+        session.log.append({"type": "tool", "name": name, "hash": source[0], "description": description, "parameters": parameters})
+    if not quiet and not IS_SANDBOX_WORKER:
+        print(f"{Colors.OKGREEN}{Colors.BOLD}Registered tool:{Colors.ENDC} {name}")
 
 def create_or_update_tool(name, code, description, parameters):
     """
-    Dynamically creates or updates a tool using Python code.
+    Dynamically creates or updates a tool using Python code. The code runs
+    in its own module namespace, and each version is persisted so later
+    sessions can reload it. Tools created in a session with its own registry
+    (batch tasks) stay out of the manifest and are not reloaded.
     """
     try:
-        exec(code, globals())
-        register_tool(name, globals()[name], description, parameters)
+        digest = tool_code_hash(code)
+        func = compile_tool(name, code, digest)
+        register_tool(name, func, description, parameters, source=(digest, code))
+        if current_registry() is registry:
+            save_tool_version(name, digest, description, parameters)
         return f"Tool '{name}' created/updated successfully."
     except Exception as e:
         return f"Error creating/updating tool '{name}': {e}"
 
+def requirement_satisfied(requirement):
+    """True if an installed distribution already satisfies the requirement string."""
+    from importlib import metadata
+    try:
+        from packaging.requirements import Requirement, InvalidRequirement
+    except ImportError:
+        match = re.fullmatch(r"\s*([A-Za-z0-9][A-Za-z0-9._-]*)\s*", requirement)
+        if not match:
+            # Cannot evaluate version specifiers without packaging
+            return False
+        name, specifier = match.group(1), None
+    else:
+        try:
+            parsed = Requirement(requirement)
+        except InvalidRequirement:
+            return False
+        name, specifier = parsed.name, parsed.specifier
+    try:
+        version = metadata.version(name)
+    except metadata.PackageNotFoundError:
+        return False
+    return not specifier or specifier.contains(version, prereleases=True)
+
+class InstallManager:
+    """
+    Coalesces package installs. Requests from one turn join a single batch,
+    which runs as soon as every install the turn asked for (see `release`)
+    has arrived, or after INSTALL_BATCH_MAX_WAIT. Requirements that are
+    already installed are skipped. The rest are installed in one resolver
+    run, with `uv pip` when available, from a local wheel cache that is
+    filled on first use so rebuilding the same environment later works
+    offline. Wheels are built with pip, run through `uv tool run` in
+    venvs that have no pip of their own.
+    """
+
+    def __init__(self, wheel_dir=WHEEL_CACHE_DIR, max_wait=INSTALL_BATCH_MAX_WAIT):
+        self.wheel_dir = wheel_dir
+        self.max_wait = max_wait
+        self._batch = None
+        self._expected = None
+        self._arrived = set()
+        self._lock = threading.Lock()
+
+    def install(self, requirement):
+        """Joins the current batch and blocks until it has been installed."""
+        requirement = requirement.strip()
+        satisfied = requirement_satisfied(requirement)
+        with self._lock:
+            self._arrived.add(requirement)
+            if not satisfied:
+                batch = self._batch
+                if batch is None:
+                    batch = self._batch = {"requirements": [], "done": threading.Event(), "results": {}}
+                    timer = threading.Timer(self.max_wait, self._flush, args=(batch,))
+                    timer.daemon = True
+                    timer.start()
+                if requirement not in batch["requirements"]:
+                    batch["requirements"].append(requirement)
+            ready = self._ready_locked()
+        if ready:
+            self._flush_in_background(ready)
+        if satisfied:
+            return f"Package '{requirement}' is already installed."
+        batch["done"].wait()
+        return batch["results"][requirement]
+
+    def release(self, expected):
+        """
+        Tells the manager which requirements the current turn asked for; the
+        batch is installed once all of them have arrived.
+        """
+        with self._lock:
+            self._expected = {requirement.strip() for requirement in expected}
+            ready = self._ready_locked()
+        if ready:
+            self._flush_in_background(ready)
+
+    def _ready_locked(self):
+        if self._expected is None or not self._expected <= self._arrived:
+            return None
+        self._expected = None
+        self._arrived = set()
+        return self._batch
+
+    def _flush_in_background(self, batch):
+        threading.Thread(target=self._flush, args=(batch,), daemon=True).start()
+
+    def _flush(self, batch):
+        with self._lock:
+            if self._batch is not batch:
+                return
+            self._batch = None
+        try:
+            batch["results"].update(self._install_batch(batch["requirements"]))
+        finally:
+            for requirement in batch["requirements"]:
+                batch["results"].setdefault(requirement, f"Error installing package '{requirement}': install did not complete")
+            batch["done"].set()
+
+    @staticmethod
+    def _installer():
+        if shutil.which("uv"):
+            return ["uv", "pip", "install", "--python", sys.executable], "uv"
+        return [sys.executable, "-m", "pip", "install"], "pip"
+
+    @staticmethod
+    def _wheel_builder():
+        """The command that builds wheels into the cache, or None when no pip is available."""
+        import importlib.util
+        if importlib.util.find_spec("pip"):
+            return [sys.executable, "-m", "pip", "wheel"]
+        if shutil.which("uv"):
+            # uv-created venvs ship without pip; run it as a uv tool for the same interpreter
+            return ["uv", "tool", "run", "--python", sys.executable, "--from", "pip", "pip", "wheel"]
+        return None
+
+    def _run(self, command):
+        completed = subprocess.run(command, capture_output=True, text=True)
+        return completed.returncode == 0, (completed.stderr or completed.stdout).strip()[-500:]
+
+    def _install_offline(self, requirements):
+        if not os.path.isdir(self.wheel_dir):
+            return False, "no wheel cache"
+        command, _ = self._installer()
+        return self._run(command + ["--no-index", "--find-links", self.wheel_dir] + requirements)
+
+    def _install_batch(self, requirements):
+        start = time.perf_counter()
+        installer = self._installer()[1]
+        print(f"{Colors.OKBLUE}Installing {', '.join(requirements)} with {installer}...{Colors.ENDC}")
+        with tracer.span("install_package", ",".join(requirements), packages=len(requirements), installer=installer) as span:
+            ok, output = self._install_offline(requirements)
+            span["source"] = "wheel_cache"
+            if not ok:
+                # Fill the wheel cache, then install from it; fall back to a plain online install
+                builder = self._wheel_builder()
+                if builder is None:
+                    print(f"{Colors.WARNING}pip is not available, so wheels are not cached; reinstalling will need the network{Colors.ENDC}")
+                else:
+                    os.makedirs(self.wheel_dir, exist_ok=True)
+                    built, output = self._run(builder + ["--quiet", "--wheel-dir", self.wheel_dir] + requirements)
+                    if built:
+                        ok, output = self._install_offline(requirements)
+                    else:
+                        print(f"{Colors.WARNING}Could not cache wheels for {', '.join(requirements)}: {output[-200:]}{Colors.ENDC}")
+                span["source"] = "index"
+                if not ok:
+                    command, _ = self._installer()
+                    ok, output = self._run(command + requirements)
+            if not ok:
+                span["outcome"] = "error"
+        import importlib
+        importlib.invalidate_caches()
+        elapsed = time.perf_counter() - start
+        batched = f" (batched with {len(requirements) - 1} other package(s))" if len(requirements) > 1 else ""
+
+        if ok:
+            return {r: f"Package '{r}' installed successfully in {elapsed:.1f}s{batched}." for r in requirements}
+        if len(requirements) == 1:
+            return {requirements[0]: f"Error installing package '{requirements[0]}' after {elapsed:.1f}s: {output}"}
+        # Install one by one so a bad requirement does not fail the others
+        return {r: self._install_batch([r])[r] for r in requirements}
+
+install_manager = InstallManager()
+
+def parse_tool_arguments(tool_call):
+    """A tool call's decoded arguments, or {} if they are not a JSON object."""
+    try:
+        args = json.loads(tool_call["function"]["arguments"] or "{}")
+    except (json.JSONDecodeError, TypeError):
+        return {}
+    return args if isinstance(args, dict) else {}
+
+def requested_packages(tool_calls):
+    """Package names requested by a turn's install_package calls."""
+    packages = []
+    for tool_call in tool_calls:
+        if tool_call["function"]["name"] != "install_package":
+            continue
+        package_name = parse_tool_arguments(tool_call).get("package_name")
+        if isinstance(package_name, str) and package_name.strip():
+            packages.append(package_name)
+    return packages
+
 def install_package(package_name):
     """
-    Installs a Python package dynamically using pip.
+    Installs a Python package dynamically, coalescing installs from the same
+    turn and skipping requirements that are already satisfied.
     """
+    session = active_session.get()
     try:
-        subprocess.check_call([sys.executable, "-m", "pip", "install", package_name])
-        return f"Package '{package_name}' installed successfully."
+        return (session.installer if session else install_manager).install(package_name)
     except Exception as e:
         return f"Error installing package '{package_name}': {e}"
 
@@ -114,97 +923,1592 @@ def task_completed():
     """
     return "Task marked as completed."
 
+class _BoundedWalker:
+    """
+    Copies a tool result while spending at most `budget` characters of
+    escaped JSON, so oversized payloads are never serialized in full. Long strings are cut
+    and long lists/dicts end in a {"_truncated": ...} marker.
+    """
+
+    MAX_DEPTH = 32
+    # Room reserved for a truncation marker once the budget is nearly spent
+    MARKER_RESERVE = 40
+
+    def __init__(self, budget):
+        self.remaining = budget
+        self.omitted_items = 0
+        self.omitted_keys = 0
+        self.truncated_strings = 0
+
+    @property
+    def truncated(self):
+        return bool(self.omitted_items or self.omitted_keys or self.truncated_strings)
+
+    def walk(self, value, depth=0):
+        if value is None or isinstance(value, (bool, int, float)):
+            self.remaining -= len(json.dumps(value))
+            return value
+        if isinstance(value, str):
+            return self._string(value)
+        if depth >= self.MAX_DEPTH:
+            return self._string(str(value))
+        if isinstance(value, dict):
+            return self._dict(value, depth)
+        if isinstance(value, (list, tuple, set)):
+            return self._list(list(value), depth)
+        if hasattr(value, "model_dump"):
+            return self.walk(value.model_dump(), depth + 1)
+        return self._string(str(value))
+
+    def _string(self, value):
+        # Budget the escaped form: json.dumps turns one CJK char into 6 and an emoji into 12
+        allowed = max(0, self.remaining - 2)
+        if len(value) <= allowed:
+            size = len(json.dumps(value))
+            if size <= self.remaining:
+                self.remaining -= size
+                return value
+        room = max(0, allowed - self.MARKER_RESERVE)
+        kept = value[:room]
+        escaped = len(json.dumps(kept)) - 2
+        while escaped > room:
+            kept = kept[:len(kept) * room // escaped]
+            escaped = len(json.dumps(kept)) - 2
+        self.truncated_strings += 1
+        self.remaining = 0
+        return f"{kept}...[+{len(value) - len(kept)} chars]"
+
+    def _dict(self, value, depth):
+        self.remaining -= 2
+        out = {}
+        items = list(value.items())
+        for position, (key, item) in enumerate(items):
+            if self.remaining <= self.MARKER_RESERVE:
+                self.omitted_keys += len(items) - position
+                out["_truncated"] = {"omitted_keys": len(items) - position}
+                self.remaining -= len(json.dumps(out["_truncated"])) + 16
+                break
+            key = str(key)
+            # The key plus ": " and the ", " before the next entry
+            self.remaining -= len(json.dumps(key)) + 4
+            out[key] = self._child(item, depth)
+        return out
+
+    def _child(self, item, depth):
+        # Keep room for this container's own truncation marker while the item is walked
+        self.remaining -= self.MARKER_RESERVE
+        try:
+            return self.walk(item, depth + 1)
+        finally:
+            self.remaining += self.MARKER_RESERVE
+
+    def _list(self, value, depth):
+        self.remaining -= 2
+        out = []
+        for position, item in enumerate(value):
+            if self.remaining <= self.MARKER_RESERVE:
+                self.omitted_items += len(value) - position
+                out.append({"_truncated": {"omitted_items": len(value) - position}})
+                self.remaining -= len(json.dumps(out[-1]))
+                break
+            # The ", " before the next item
+            self.remaining -= 2
+            out.append(self._child(item, depth))
+        return out
+
+def tool_output_budget(function_name, args=None):
+    """Looks up the output budget for a tool, or for the Composio action it executes."""
+    if args and function_name == "COMPOSIO_EXECUTE_ACTION":
+        action = args.get("action") or args.get("action_name")
+        if action in TOOL_OUTPUT_BUDGETS:
+            return TOOL_OUTPUT_BUDGETS[action]
+    return TOOL_OUTPUT_BUDGETS.get(function_name, MAX_TOOL_OUTPUT_LENGTH)
+
+def truncation_envelope_size(max_length):
+    """Characters the "_spilled" handle, "result" wrapper and "_truncated" summary can add to a truncated result."""
+    widest = 10 ** 12
+    return len(json.dumps({
+        "_spilled": {"handle": "0" * 16, "chars": widest, "read_with": "read_result, query_result"},
+        "result": None,
+        "_truncated": {"budget": max_length, "omitted_items": widest, "omitted_keys": widest, "truncated_strings": widest},
+    })) - len("null")
+
 def serialize_tool_result(tool_result, max_length=MAX_TOOL_OUTPUT_LENGTH):
     """
-    Serializes tool output into a JSON-friendly string, truncating if necessary.
+    Serializes tool output into a JSON string of at most `max_length`
+    characters. Oversized results are truncated structurally, so the output
+    stays valid JSON and carries a "_truncated" summary for the model. The
+    full result goes to the spill store first, and the output leads with its
+    handle so read_result and query_result can page through the rest.
+    """
+    walker = _BoundedWalker(max_length)
+    bounded = walker.walk(tool_result)
+    if not walker.truncated:
+        return json.dumps(bounded, default=str)
+
+    spilled = spill_store.spill(tool_result)
+    # Walk again, leaving room for the spill handle and the summary; nested
+    # truncation markers can still overshoot, so shrink until it fits
+    budget = max_length - truncation_envelope_size(max_length)
+    while True:
+        walker = _BoundedWalker(max(0, budget))
+        bounded = walker.walk(tool_result)
+        if not isinstance(bounded, dict):
+            bounded = {"result": bounded}
+        if spilled:
+            # First, so the handle survives context compaction previews
+            handle, size = spilled
+            bounded = {"_spilled": {"handle": handle, "chars": size, "read_with": "read_result, query_result"}, **bounded}
+        bounded["_truncated"] = {
+            "budget": max_length,
+            "omitted_items": walker.omitted_items,
+            "omitted_keys": walker.omitted_keys,
+            "truncated_strings": walker.truncated_strings,
+        }
+        content = json.dumps(bounded, default=str)
+        if len(content) <= max_length or budget <= 0:
+            return content
+        budget -= len(content) - max_length
+
+def get_toolset():
+    """
+    Returns the shared ComposioToolSet, importing composio_openai and
+    building the toolset on first use to keep it off the startup path.
+    """
+    global _toolset
+    if _toolset is None:
+        with _toolset_lock:
+            if _toolset is None:
+                from composio_openai import ComposioToolSet
+                _toolset = ComposioToolSet()
+    return _toolset
+
+def write_json_atomic(path, data):
+    """Writes JSON to a temporary file and renames it over `path`."""
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+def load_connection_cache():
+    """
+    Loads persisted connection statuses from CONNECTIONS_FILE, skipping
+    entries whose TTL has already expired.
     """
     try:
-        serialized_result = json.dumps(tool_result)
-    except TypeError:
-        serialized_result = str(tool_result)
-    if len(serialized_result) > max_length:
-        return (
-            serialized_result[:max_length] +
-            f"\n\n{Colors.WARNING}(Note: Result was truncated to {max_length} characters out of {len(serialized_result)} total characters.){Colors.ENDC}"
-        )
-    else:
-        return serialized_result
+        with open(CONNECTIONS_FILE) as f:
+            persisted = json.load(f)
+    except (OSError, ValueError):
+        return
+    now = time.time()
+    with connection_lock:
+        for app_name, entry in persisted.items():
+            if isinstance(entry, dict) and now - entry.get("checked_at", 0) < CONNECTION_CACHE_TTL:
+                connection_cache[app_name] = entry
 
-def check_existing_connection(app_name):
-    """Check if we already have an active connection for a specific app."""
+def save_connection_cache():
+    """Atomically writes the connection cache to CONNECTIONS_FILE. Caller holds connection_lock."""
     try:
-        entity = toolset.get_entity(id="default")
-        connection = entity.get_connection(app=app_name)
-        return connection and getattr(connection, 'status', 'ACTIVE') == 'ACTIVE'
-    except:
+        write_json_atomic(CONNECTIONS_FILE, connection_cache)
+    except OSError as e:
+        print(f"{Colors.WARNING}Could not persist connection cache: {e}{Colors.ENDC}")
+
+def invalidate_connection(app_name):
+    """Drops a cached connection status, e.g. after an unauthorized error."""
+    if not app_name:
+        return
+    with connection_lock:
+        if connection_cache.pop(app_name.lower(), None) is not None:
+            save_connection_cache()
+
+def app_for_action(action_name):
+    """Derives the Composio app from an action name, e.g. GMAIL_FETCH_EMAILS -> gmail."""
+    return str(action_name).split("_", 1)[0].lower() if action_name else None
+
+def is_known_app(app_name):
+    """Whether Composio has an app by this name, so words like HTTP_ERROR are never checked remotely."""
+    try:
+        from composio_openai import App
+    except ImportError:
         return False
+    return bool(app_name) and hasattr(App, str(app_name).upper())
 
-def retry_on_timeout(max_retries=3, delay=2):
+def check_existing_connection(app_name):
     """
-    Decorator to retry functions on timeout or server errors.
+    Check if we already have an active connection for a specific app.
+
+    Active connections are cached for CONNECTION_CACHE_TTL seconds and
+    persisted to CONNECTIONS_FILE; inactive ones are always re-checked so a
+    freshly completed authorization is picked up.
+    """
+    key = app_name.lower()
+    with tracer.span("check_existing_connection", key) as span:
+        with connection_lock:
+            entry = connection_cache.get(key)
+            if entry and time.time() - entry.get("checked_at", 0) < CONNECTION_CACHE_TTL:
+                span["outcome"] = "cached"
+                return entry.get("active", False)
+
+        try:
+            entity = get_toolset().get_entity(id="default")
+            connection = entity.get_connection(app=app_name)
+            active = bool(connection and getattr(connection, 'status', 'ACTIVE') == 'ACTIVE')
+        except Exception as e:
+            span["outcome"] = "error"
+            span["error"] = str(e)[:200]
+            return False
+
+        span["active"] = active
+        if active:
+            with connection_lock:
+                connection_cache[key] = {"active": True, "checked_at": time.time()}
+                save_connection_cache()
+        return active
+
+# ------------------------------------------------------------------------------
+# Retries and Circuit Breaking
+# ------------------------------------------------------------------------------
+
+# Exception class names (litellm, httpx, builtins) that are worth retrying
+RETRYABLE_EXCEPTIONS = {
+    "RateLimitError", "Timeout", "TimeoutError", "ReadTimeout", "ConnectTimeout",
+    "APIConnectionError", "ConnectionError", "ServiceUnavailableError",
+    "InternalServerError", "APIError", "RemoteProtocolError",
+}
+# Exception class names that will fail the same way on every attempt
+TERMINAL_EXCEPTIONS = {
+    "AuthenticationError", "PermissionDeniedError", "BadRequestError", "NotFoundError",
+    "ContextWindowExceededError", "ContentPolicyViolationError", "UnsupportedParamsError",
+    "ValueError", "TypeError", "KeyError",
+}
+RETRYABLE_ERROR_MARKERS = (
+    "timeout", "timed out", "rate limit", "ratelimit", "too many requests",
+    "temporarily", "overloaded", "connection reset", "connection aborted", "connection error",
+)
+RETRYABLE_STATUS_CODES = {408, 409, 425, 429, 500, 502, 503, 504, 520, 522, 524}
+# An HTTP status named as such in an error message ("status 503", "HTTP 429", "code: 502"),
+# so ids, limits and counts that merely contain those digits do not match
+STATUS_IN_MESSAGE = re.compile(r"\b(?:status|http|code)\D{0,3}(\d{3})\b", re.IGNORECASE)
+
+def message_status_codes(message):
+    """The HTTP status codes an error message names explicitly."""
+    return {int(code) for code in STATUS_IN_MESSAGE.findall(str(message))}
+
+def response_headers(obj):
+    """The HTTP response headers carried by a LiteLLM response, stream or exception, if any."""
+    hidden = getattr(obj, "_hidden_params", None)
+    return (
+        (hidden.get("additional_headers") or hidden.get("headers") if isinstance(hidden, dict) else None)
+        or getattr(obj, "headers", None)
+        or getattr(getattr(obj, "response", None), "headers", None)
+        or getattr(obj, "litellm_response_headers", None)
+        or getattr(obj, "_response_headers", None)
+    )
+
+def retry_after_seconds(error):
+    """Reads a Retry-After (or retry-after-ms) hint from an exception's response headers."""
+    headers = response_headers(error)
+    if not headers:
+        return None
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        value = headers.get("retry-after") or headers.get("Retry-After")
+        if value is None:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            from email.utils import parsedate_to_datetime
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError, AttributeError):
+        return None
+
+def classify_error(error):
+    """
+    Classifies an exception or an error message from a tool result.
+
+    Returns (retryable, retry_after). Unknown exceptions are assumed to be
+    transient; unknown error messages are assumed to be terminal, since
+    they usually describe a bad request.
+    """
+    if isinstance(error, BaseException):
+        status = getattr(error, "status_code", None) or getattr(getattr(error, "response", None), "status_code", None)
+        if isinstance(status, int):
+            return status in RETRYABLE_STATUS_CODES, retry_after_seconds(error)
+        name = type(error).__name__
+        if name in TERMINAL_EXCEPTIONS:
+            return False, None
+        if name in RETRYABLE_EXCEPTIONS or isinstance(error, (TimeoutError, ConnectionError)):
+            return True, retry_after_seconds(error)
+        message = str(error).lower()
+        return not any(marker in message for marker in ("unauthorized", "forbidden", "invalid")), retry_after_seconds(error)
+    message = str(error).lower()
+    retryable = any(marker in message for marker in RETRYABLE_ERROR_MARKERS)
+    return retryable or bool(message_status_codes(message) & RETRYABLE_STATUS_CODES), None
+
+class RetryPolicy:
+    """Exponential back-off with full jitter, capped at `max_delay` and honouring Retry-After."""
+
+    def __init__(self, max_attempts=RETRY_MAX_ATTEMPTS, base_delay=RETRY_BASE_DELAY, max_delay=RETRY_MAX_DELAY):
+        self.max_attempts = max(1, max_attempts)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def delay(self, attempt, retry_after=None):
+        """Seconds to wait before retry number `attempt` (1-based)."""
+        if retry_after is not None:
+            return min(retry_after, self.max_delay)
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling a dependency whose circuit breaker is open."""
+
+class CircuitBreaker:
+    """
+    Per-key circuit breaker. After `threshold` consecutive failed calls the
+    circuit opens and calls are refused for `cooldown` seconds; then a single
+    trial call is let through, and its outcome closes or re-opens the circuit.
+    """
+
+    def __init__(self, threshold=BREAKER_FAILURE_THRESHOLD, cooldown=BREAKER_COOLDOWN):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self._failures = defaultdict(int)
+        self._opened_at = {}
+        self._trial_running = set()
+        self._lock = threading.Lock()
+
+    def check(self, key):
+        """Raises CircuitOpenError if calls for `key` are currently refused."""
+        with self._lock:
+            opened_at = self._opened_at.get(key)
+            if opened_at is None:
+                return
+            remaining = self.cooldown - (time.monotonic() - opened_at)
+            if remaining > 0 or key in self._trial_running:
+                raise CircuitOpenError(f"Circuit open for '{key}' after repeated failures; retry in {max(remaining, 0):.0f}s")
+            self._trial_running.add(key)
+
+    def record_success(self, key):
+        with self._lock:
+            self._failures.pop(key, None)
+            self._opened_at.pop(key, None)
+            self._trial_running.discard(key)
+
+    def release(self, key):
+        """Gives back a trial call that was let through but never made."""
+        with self._lock:
+            self._trial_running.discard(key)
+
+    def record_failure(self, key):
+        with self._lock:
+            self._failures[key] += 1
+            self._trial_running.discard(key)
+            if key in self._opened_at or self._failures[key] >= self.threshold:
+                self._opened_at[key] = time.monotonic()
+                print(f"{Colors.FAIL}Circuit opened for '{key}' for {self.cooldown:.0f}s{Colors.ENDC}")
+
+default_retry_policy = RetryPolicy()
+circuit_breaker = CircuitBreaker()
+
+def retry_with_policy(policy=default_retry_policy, breaker_key=None):
+    """
+    Decorator that retries a function per `policy`. Both raised exceptions
+    and {"error": ...} results are classified, and terminal errors are
+    returned at once. When `breaker_key(*args)` names a circuit, the call is
+    refused while that circuit is open and its outcome is recorded.
+    Exhausted or refused calls return a {"successfull": False, "error": ...}
+    dict.
     """
     def decorator(func):
         @wraps(func)
         def wrapper(*args, **kwargs):
-            retries = 0
-            while retries < max_retries:
+            key = breaker_key(*args) if breaker_key else None
+            if key:
+                try:
+                    circuit_breaker.check(key)
+                except CircuitOpenError as e:
+                    tracer.annotate(outcome="circuit_open")
+                    return {"successfull": False, "error": str(e)}
+
+            attempt = 0
+            while True:
+                error, retryable, retry_after = None, False, None
                 try:
                     result = func(*args, **kwargs)
-                    # Check for error/timeouts in the result
-                    print(f"Retry Decorator Result: {result}") # Debug print in decorator
-                    if isinstance(result, dict):
-                        error_msg = result.get("error", "") # Get error safely
-                        if error_msg and isinstance(error_msg, str) and ("timeout" in error_msg.lower() or "524" in error_msg): # Safe .lower() call
-                            raise TimeoutError(error_msg)
-                    return result
+                    if isinstance(result, dict) and result.get("error"):
+                        error = result["error"]
+                        retryable, retry_after = classify_error(error)
                 except Exception as e:
-                    retries += 1
-                    if retries == max_retries:
-                        print(f"{Colors.FAIL}Failed after {max_retries} retries: {str(e)}{Colors.ENDC}")
-                        return {"successfull": False, "error": f"Failed after {max_retries} retries: {str(e)}"}
-                    print(f"{Colors.WARNING}Retry {retries}/{max_retries} after error: {str(e)}{Colors.ENDC}")
-                    time.sleep(delay)
-            return result
+                    result = {"successfull": False, "error": str(e)}
+                    error = e
+                    retryable, retry_after = classify_error(e)
+
+                tracer.annotate(retries=attempt)
+                if error is None or not retryable:
+                    if key:
+                        circuit_breaker.record_success(key)
+                    return result
+
+                attempt += 1
+                if attempt >= policy.max_attempts:
+                    print(f"{Colors.FAIL}Failed after {attempt} attempts: {error}{Colors.ENDC}")
+                    if key:
+                        circuit_breaker.record_failure(key)
+                    return {"successfull": False, "error": f"Failed after {attempt} attempts: {error}"}
+                wait = policy.delay(attempt, retry_after)
+                print(f"{Colors.WARNING}Retry {attempt}/{policy.max_attempts - 1} in {wait:.1f}s after error: {error}{Colors.ENDC}")
+                time.sleep(wait)
         return wrapper
     return decorator
 
-@retry_on_timeout()
-def execute_composio_action(action_name, params):
-    """Execute Composio action with retry logic."""
+# ------------------------------------------------------------------------------
+# Rate Limits
+# ------------------------------------------------------------------------------
+
+RATE_LIMIT_HEADER_PATTERN = re.compile(
+    r"^(?:llm_provider-)?(?:x|anthropic)-ratelimit-(?:(limit|remaining|reset)-(requests|tokens)|(requests|tokens)-(limit|remaining|reset))$"
+)
+
+def parse_reset(value):
+    """Seconds until a rate-limit window resets, from "20ms" / "6m0s" / "1.5" / an RFC 3339 time."""
+    value = str(value).strip()
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    parts = re.findall(r"(\d+(?:\.\d+)?)(ms|s|m|h)", value)
+    if parts and "".join(number + unit for number, unit in parts) == value:
+        scale = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+        return sum(float(number) * scale[unit] for number, unit in parts)
     try:
-        print(f"Executing Composio action: {action_name} with params: {params}")
+        from datetime import datetime
+        return max(0.0, datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp() - time.time())
+    except ValueError:
+        return None
+
+def parse_rate_limit_headers(headers):
+    """
+    Reads OpenAI-style (x-ratelimit-*) and Anthropic-style
+    (anthropic-ratelimit-*) headers into {"requests": {...}, "tokens": {...}},
+    each with "limit", "remaining" and "reset" (seconds) where present.
+    """
+    limits = {}
+    try:
+        items = list(headers.items())
+    except AttributeError:
+        return limits
+    for name, value in items:
+        match = RATE_LIMIT_HEADER_PATTERN.match(str(name).lower())
+        if not match:
+            continue
+        field = match.group(1) or match.group(4)
+        resource = match.group(2) or match.group(3)
+        try:
+            parsed = parse_reset(value) if field == "reset" else float(value)
+        except (TypeError, ValueError):
+            continue
+        if parsed is not None:
+            limits.setdefault(resource, {})[field] = parsed
+    return limits
+
+def is_rate_limit_error(error):
+    if isinstance(error, BaseException):
+        status = getattr(error, "status_code", None) or getattr(getattr(error, "response", None), "status_code", None)
+        if status == 429 or "ratelimit" in type(error).__name__.lower():
+            return True
+    message = str(error).lower()
+    return any(marker in message for marker in ("rate limit", "ratelimit", "too many requests")) \
+        or 429 in message_status_codes(message)
+
+def provider_for_model(model):
+    """The provider a LiteLLM model name goes to, e.g. anthropic/claude-3-5-sonnet -> anthropic, gpt-4o -> openai."""
+    if "/" in model:
+        return model.split("/", 1)[0]
+    name = model.lower()
+    if "claude" in name:
+        return "anthropic"
+    if name.startswith(("gpt", "o1", "o3", "o4", "chatgpt")):
+        return "openai"
+    return re.split(r"[-.:]", name, 1)[0]
+
+class RateLimiter:
+    """
+    Token buckets per LLM provider ("llm:openai") and per Composio app
+    ("composio:gmail"), shared by every session in the process and, through
+    a flock'd state file, by every orb-lite process in the directory.
 
-        result = toolset.execute_action(
+    A key has a bucket once it has a rate: configured in RATE_LIMITS, or
+    learned from x-ratelimit-* / anthropic-ratelimit-* response headers,
+    whose remaining counts also drain the bucket. A rate-limit error, or a
+    header reporting nothing remaining, blocks the key for everyone until
+    it resets, so sessions wait together instead of retrying into the same
+    limit. Batch sessions leave RATE_LIMIT_RESERVE of each bucket to
+    interactive ones and wait while an interactive session in this process
+    is queued for the same key.
+    """
+
+    PRIORITY_POLL = 0.05
+
+    def __init__(self, limits=RATE_LIMITS, path=RATE_LIMIT_FILE, shared=RATE_LIMIT_SHARED, reserve=RATE_LIMIT_RESERVE):
+        self.limits = limits
+        self.path = path
+        self.shared = shared
+        self.reserve = reserve
+        self._state = {}
+        self._lock = threading.Lock()
+        # Interactive callers queued per key, which batch callers yield to
+        self._interactive_waiting = Counter()
+
+    def _rpm(self, key, entry):
+        for candidate in (key, key.split(":", 1)[0], "*"):
+            if candidate in self.limits:
+                return float(self.limits[candidate])
+        return entry.get("rpm")
+
+    @contextmanager
+    def _locked(self):
+        """The limiter state, locked across threads and processes, and saved on exit."""
+        with self._lock:
+            try:
+                import fcntl
+            except ImportError:
+                fcntl = None
+            if not self.shared or fcntl is None:
+                yield self._state
+                return
+            try:
+                f = open(self.path, "a+")
+            except OSError:
+                yield self._state
+                return
+            with f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                f.seek(0)
+                saved = f.read()
+                try:
+                    self._state = json.loads(saved or "{}")
+                except json.JSONDecodeError:
+                    self._state = {}
+                yield self._state
+                # Most admissions only read: rewrite the file when something changed
+                updated = json.dumps(self._state)
+                if updated != saved:
+                    f.seek(0)
+                    f.truncate()
+                    f.write(updated)
+                    f.flush()
+
+    def _admit(self, key, interactive):
+        """Takes a token for `key` and returns 0, or returns the seconds to wait."""
+        now = time.time()
+        with self._locked() as state:
+            entry = state.get(key, {})
+            blocked = entry.get("blocked_until", 0) - now
+            if blocked > 0:
+                return blocked
+            rpm = self._rpm(key, entry)
+            if not rpm:
+                return 0.0
+            rate = rpm / 60
+            capacity = max(1.0, rate * RATE_LIMIT_BURST_SECONDS)
+            tokens = min(capacity, entry.get("tokens", capacity) + max(0.0, now - entry.get("updated", now)) * rate)
+            floor = 0.0 if interactive else min(capacity * self.reserve, capacity - 1)
+            entry["updated"] = now
+            state[key] = entry
+            if tokens >= 1 + floor:
+                entry["tokens"] = tokens - 1
+                return 0.0
+            entry["tokens"] = tokens
+            return (1 + floor - tokens) / rate
+
+    def _waits(self, key, interactive):
+        """Yields how long to sleep, with jitter, until a request for `key` is admitted."""
+        while True:
+            if not interactive and self._interactive_waiting[key]:
+                wait = self.PRIORITY_POLL
+            else:
+                wait = self._admit(key, interactive)
+            if wait <= 0:
+                return
+            yield min(wait, RATE_LIMIT_MAX_SLEEP) * random.uniform(1.0, 1.1)
+
+    @contextmanager
+    def _queued(self, key, interactive):
+        if interactive:
+            with self._lock:
+                self._interactive_waiting[key] += 1
+        try:
+            yield
+        finally:
+            if interactive:
+                with self._lock:
+                    self._interactive_waiting[key] -= 1
+
+    def _report(self, key, session, waited):
+        if waited:
+            session.metrics["rate_limit_waits"] += 1
+            session.metrics["rate_limit_wait_ms"] += int(waited * 1000)
+            tracer.annotate(rate_limit_wait_ms=round(waited * 1000, 1))
+            if waited >= 1:
+                print(f"{Colors.WARNING}{session.prefix}Waited {waited:.1f}s for the {key} rate limit{Colors.ENDC}")
+
+    def acquire(self, key):
+        """Blocks the calling thread until a request for `key` may be sent."""
+        session = current_session()
+        waited = 0.0
+        with self._queued(key, session.interactive):
+            for wait in self._waits(key, session.interactive):
+                time.sleep(wait)
+                waited += wait
+        self._report(key, session, waited)
+
+    async def acquire_async(self, key):
+        """Waits, without blocking the event loop, until a request for `key` may be sent."""
+        session = current_session()
+        waited = 0.0
+        with self._queued(key, session.interactive):
+            for wait in self._waits(key, session.interactive):
+                await asyncio.sleep(wait)
+                waited += wait
+        self._report(key, session, waited)
+
+    def observe_headers(self, key, headers):
+        """Learns `key`'s request limit and what remains of it from response headers."""
+        limits = parse_rate_limit_headers(headers) if headers else {}
+        if not limits:
+            return
+        now = time.time()
+        with self._locked() as state:
+            entry = state.setdefault(key, {})
+            requests = limits.get("requests", {})
+            if requests.get("limit"):
+                # Providers report request limits per minute
+                entry["rpm"] = requests["limit"]
+            if "remaining" in requests:
+                rpm = self._rpm(key, entry)
+                if rpm:
+                    current = entry.get("tokens", requests["remaining"]) + max(0.0, now - entry.get("updated", now)) * rpm / 60
+                    entry["tokens"] = min(current, requests["remaining"])
+                    entry["updated"] = now
+            for resource in limits.values():
+                if resource.get("remaining", 1) <= 0 and resource.get("reset"):
+                    entry["blocked_until"] = max(entry.get("blocked_until", 0), now + resource["reset"])
+
+    def observe_error(self, key, error):
+        """After a rate-limit error, holds back every request for `key` until it should clear."""
+        if not is_rate_limit_error(error):
+            return
+        self.observe_headers(key, response_headers(error))
+        retry_after = retry_after_seconds(error) if isinstance(error, BaseException) else None
+        now = time.time()
+        with self._locked() as state:
+            entry = state.setdefault(key, {})
+            # Limited again soon after the last hold-back ended: back off longer
+            recent = now < entry.get("blocked_until", 0) + entry.get("penalty", 0)
+            penalty = min(RATE_LIMIT_MAX_PENALTY, entry.get("penalty", RATE_LIMIT_PENALTY) * 2) if recent else RATE_LIMIT_PENALTY
+            entry["penalty"] = penalty
+            entry["blocked_until"] = max(entry.get("blocked_until", 0), now + (retry_after if retry_after is not None else penalty))
+            entry["tokens"] = 0.0
+            entry["updated"] = now
+        print(f"{Colors.WARNING}Rate limited on {key}; holding requests for {entry['blocked_until'] - now:.1f}s{Colors.ENDC}")
+
+rate_limiter = RateLimiter()
+
+# ------------------------------------------------------------------------------
+# Prompt Assembly
+# ------------------------------------------------------------------------------
+
+# Model name fragments of providers that only cache at explicit breakpoints
+BREAKPOINT_PROVIDERS = ("claude", "anthropic")
+
+# id(schema) -> (schema, key-sorted copy)
+_canonical_schemas = {}
+
+def canonical_schema(schema):
+    """The schema with keys sorted at every level, computed once per schema object."""
+    cached = _canonical_schemas.get(id(schema))
+    if cached is None or cached[0] is not schema:
+        cached = _canonical_schemas[id(schema)] = (schema, json.loads(canonical_json(schema)))
+    return cached[1]
+
+def canonical_tools(tool_schemas):
+    """
+    Tool schemas in a byte-stable order: pinned tools first, then the rest,
+    each sorted by name. The pinned tools go out on every request, so the
+    prefix they form stays cacheable when the selected tools change.
+    """
+    return sorted(
+        (canonical_schema(schema) for schema in tool_schemas),
+        key=lambda schema: (schema["function"]["name"] not in PINNED_TOOLS, schema["function"]["name"])
+    )
+
+def uses_cache_breakpoints(model):
+    if PROMPT_CACHE_BREAKPOINTS != "auto":
+        return PROMPT_CACHE_BREAKPOINTS == "1"
+    return any(provider in model.lower() for provider in BREAKPOINT_PROVIDERS)
+
+def _with_cache_control(message):
+    content = message.get("content")
+    if isinstance(content, str) and content:
+        blocks = [{"type": "text", "text": content, "cache_control": {"type": "ephemeral"}}]
+    elif isinstance(content, list) and content:
+        blocks = content[:-1] + [{**content[-1], "cache_control": {"type": "ephemeral"}}]
+    else:
+        return message
+    return {**message, "content": blocks}
+
+def add_cache_breakpoints(model, messages, tool_schemas):
+    """
+    Returns request copies of `messages` and `tool_schemas` with
+    cache_control breakpoints after the pinned tools, after the system
+    prompt and on the latest message, for models that need them. Other
+    providers cache stable prefixes on their own and get the inputs as is.
+    The conversation history itself is never modified.
+    """
+    if not uses_cache_breakpoints(model):
+        return messages, tool_schemas
+    tools = list(tool_schemas)
+    pinned = [index for index, schema in enumerate(tools) if schema["function"]["name"] in PINNED_TOOLS]
+    if pinned:
+        tools[pinned[-1]] = {**tools[pinned[-1]], "cache_control": {"type": "ephemeral"}}
+    request = list(messages)
+    request[0] = _with_cache_control(request[0])
+    if len(request) > 1:
+        request[-1] = _with_cache_control(request[-1])
+    return request, tools
+
+# ------------------------------------------------------------------------------
+# Model Routing
+# ------------------------------------------------------------------------------
+
+def completion_role(messages):
+    """
+    "strong" for turns that plan or author tools: after the task or any new
+    user message, after a failed tool call, and after creating a tool or
+    installing a package. "fast" for routine turns after successful tool
+    results.
+    """
+    if messages[-1].get("role") != "tool":
+        return "strong"
+    index = len(messages) - 1
+    while index > 0 and messages[index].get("role") == "tool":
+        content = messages[index].get("content") or ""
+        if content.startswith('"Error') or '"error":' in content[:500]:
+            return "strong"
+        index -= 1
+    authoring = {"create_or_update_tool", "install_package"}
+    if any(tc["function"]["name"] in authoring for tc in messages[index].get("tool_calls", [])):
+        return "strong"
+    return "fast"
+
+async def _open_completion(model, messages, tool_schemas):
+    """Starts a streamed completion and waits for its first chunk."""
+    from litellm import acompletion
+
+    limit_key = f"llm:{provider_for_model(model)}"
+    await rate_limiter.acquire_async(limit_key)
+    start = time.perf_counter()
+    messages, tool_schemas = add_cache_breakpoints(model, messages, tool_schemas)
+    try:
+        response = await acompletion(
+            model=model, messages=messages, tools=tool_schemas, tool_choice="auto",
+            stream=True, stream_options={"include_usage": True}, drop_params=True
+        )
+    except Exception as e:
+        rate_limiter.observe_error(limit_key, e)
+        raise
+    rate_limiter.observe_headers(limit_key, response_headers(response))
+    iterator = response.__aiter__()
+    try:
+        first_chunk = await iterator.__anext__()
+    except StopAsyncIteration:
+        first_chunk = None
+    return iterator, first_chunk, time.perf_counter() - start
+
+async def _close_stream(iterator):
+    close = getattr(iterator, "aclose", None)
+    if close:
+        try:
+            await close()
+        except Exception:
+            pass
+
+class ModelRouter:
+    """
+    Opens each turn's completion stream on a model from the role's pool.
+
+    Models are tried in order of their observed p95 time to first chunk;
+    models with fewer than ROUTER_MIN_SAMPLES samples go first, so every
+    model gets measured. If the first model has not streamed a chunk within
+    the hedge delay, the next one is started as well. Whichever streams
+    first wins and the other is cancelled. Retryable errors such as rate
+    limits fail over to the next model at once. Models whose circuit is
+    open are skipped.
+    """
+
+    def __init__(self, pools, hedge=HEDGE_ENABLED, hedge_delay=HEDGE_DELAY):
+        self.pools = pools
+        self.hedge = hedge
+        self.fixed_hedge_delay = None if hedge_delay == "p95" else float(hedge_delay)
+        self._latencies = defaultdict(lambda: deque(maxlen=ROUTER_LATENCY_WINDOW))
+
+    def record_latency(self, model, seconds):
+        self._latencies[model].append(seconds)
+
+    def p95(self, model):
+        samples = list(self._latencies[model])
+        return percentile(samples, 0.95) if len(samples) >= ROUTER_MIN_SAMPLES else None
+
+    def candidates(self, role):
+        models = self.pools.get(role) or self.pools["strong"]
+        # Stable sort: unmeasured models keep their configured order
+        return sorted(models, key=lambda model: self.p95(model) or 0.0)
+
+    def hedge_delay(self, model):
+        if self.fixed_hedge_delay is not None:
+            return self.fixed_hedge_delay
+        p95 = self.p95(model)
+        return max(HEDGE_MIN_DELAY, p95) if p95 is not None else HEDGE_DEFAULT_DELAY
+
+    async def open(self, role, messages, tool_schemas, span):
+        """
+        Returns (model, response iterator, first chunk, seconds to first
+        chunk) from the first model to start streaming. Raises the last
+        error if no model does.
+        """
+        queue = self.candidates(role)
+        pending = {}
+        errors = []
+        hedged = False
+
+        def launch():
+            while queue:
+                model = queue.pop(0)
+                try:
+                    circuit_breaker.check(f"llm:{model}")
+                except CircuitOpenError as e:
+                    errors.append(e)
+                    continue
+                task = asyncio.ensure_future(_open_completion(model, messages, tool_schemas))
+                pending[task] = (model, time.perf_counter())
+                return model
+            return None
+
+        current = launch()
+        try:
+            while pending:
+                timeout = self.hedge_delay(current) if self.hedge and not hedged and queue else None
+                done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    hedged = True
+                    backup = launch()
+                    if backup:
+                        print(f"{Colors.WARNING}{current} has not responded in {timeout:.1f}s; also trying {backup}{Colors.ENDC}")
+                        span["hedged"] = backup
+                        current = backup
+                    continue
+
+                winner = None
+                for task in done:
+                    model, _ = pending.pop(task)
+                    try:
+                        iterator, first_chunk, latency = task.result()
+                    except Exception as e:
+                        errors.append(e)
+                        retryable, _ = classify_error(e)
+                        span.setdefault("failed_models", []).append(model)
+                        if not retryable:
+                            circuit_breaker.release(f"llm:{model}")
+                            continue
+                        circuit_breaker.record_failure(f"llm:{model}")
+                        if not pending:
+                            backup = launch()
+                            if backup:
+                                print(f"{Colors.WARNING}{model} failed ({type(e).__name__}); failing over to {backup}{Colors.ENDC}")
+                                span["failovers"] = span.get("failovers", 0) + 1
+                                current = backup
+                        continue
+                    if winner is None:
+                        winner = (model, iterator, first_chunk, latency)
+                    else:
+                        await _close_stream(iterator)
+                        circuit_breaker.release(f"llm:{model}")
+                    self.record_latency(model, latency)
+                if winner:
+                    circuit_breaker.record_success(f"llm:{winner[0]}")
+                    return winner
+        finally:
+            # Losers count as at least as slow as they were when cancelled
+            for task, (model, started) in pending.items():
+                task.cancel()
+                self.record_latency(model, time.perf_counter() - started)
+                circuit_breaker.release(f"llm:{model}")
+        if errors:
+            raise errors[-1]
+        raise RuntimeError(f"No models configured for role '{role}'")
+
+model_router = ModelRouter({"strong": STRONG_MODELS, "fast": FAST_MODELS})
+
+# ------------------------------------------------------------------------------
+# Result Cache
+# ------------------------------------------------------------------------------
+
+# Action name words that mark an action as reading data; only these are cached
+READ_ACTION_WORDS = {
+    "GET", "GETS", "LIST", "LISTS", "FETCH", "FETCHES", "SEARCH", "SEARCHES",
+    "READ", "READS", "FIND", "FINDS",
+}
+# Action name words that mark an action as having side effects, even next to a read word
+MUTATING_ACTION_WORDS = {
+    "ADD", "APPEND", "APPROVE", "ARCHIVE", "CANCEL", "CLEAR", "COMMENT", "CREATE",
+    "DELETE", "DISABLE", "EDIT", "ENABLE", "EXECUTE", "FOLLOW", "FORK", "FORWARD",
+    "INITIATE", "INSERT", "INVITE", "LIKE", "MARK", "MERGE", "MODIFY", "MOVE", "PATCH",
+    "PIN", "POST", "PUT", "REACT", "REMOVE", "REPLACE", "REPLY", "RETWEET", "RUN",
+    "SEND", "SET", "SHARE", "STAR", "START", "STOP", "TRIGGER", "UNFOLLOW", "UPDATE",
+    "UPLOAD", "UPSERT", "WRITE",
+}
+
+def is_read_only_action(action_name):
+    """
+    True if a word of the action name (after the app prefix) is a read verb
+    and none suggests a side effect, in any inflection (SENDS, DELETES).
+    Unrecognized actions are treated as mutating.
+    """
+    words = str(action_name).upper().split("_")[1:]
+    stems = {stem for word in words for stem in (word, word[:-1], word[:-2]) if stem}
+    return any(word in READ_ACTION_WORDS for word in words) and not stems & MUTATING_ACTION_WORDS
+
+def canonical_json(value):
+    """Stable JSON encoding used for cache keys and fingerprints."""
+    return json.dumps(value, sort_keys=True, separators=(",", ":"), default=str)
+
+class ResultCache:
+    """
+    Opt-in cache for read-only Composio action results, keyed on the action
+    name and canonicalized params. Entries live in an in-memory LRU and in
+    one JSON file each under `directory`, and expire per RESULT_CACHE_TTLS
+    (longest matching prefix) or RESULT_CACHE_TTL.
+    """
+
+    def __init__(self, directory=RESULT_CACHE_DIR, enabled=RESULT_CACHE_ENABLED, max_entries=RESULT_CACHE_MAX_ENTRIES):
+        self.directory = directory
+        self.enabled = enabled
+        self.max_entries = max_entries
+        self.stats = {"hits": 0, "misses": 0, "bypassed": 0}
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(action_name, params):
+        return hashlib.sha256(f"{action_name}\0{canonical_json(params)}".encode()).hexdigest()
+
+    @staticmethod
+    def ttl(action_name):
+        matches = [prefix for prefix in RESULT_CACHE_TTLS if str(action_name).startswith(prefix)]
+        return RESULT_CACHE_TTLS[max(matches, key=len)] if matches else RESULT_CACHE_TTL
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.json")
+
+    def get(self, action_name, params):
+        """Returns (hit, result); mutating actions always miss and are counted as bypassed."""
+        if not self.enabled:
+            return False, None
+        if not is_read_only_action(action_name):
+            with self._lock:
+                self.stats["bypassed"] += 1
+            return False, None
+
+        key = self.key(action_name, params)
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is None:
+                try:
+                    with open(self._path(key)) as f:
+                        entry = json.load(f)
+                except (OSError, ValueError):
+                    entry = None
+            if entry and entry["expires_at"] > now:
+                self._remember(key, entry)
+                self.stats["hits"] += 1
+                return True, entry["result"]
+            if entry:
+                self._memory.pop(key, None)
+                try:
+                    os.remove(self._path(key))
+                except OSError:
+                    pass
+            self.stats["misses"] += 1
+            return False, None
+
+    def put(self, action_name, params, result):
+        """Stores a successful read-only result."""
+        if not self.enabled or not is_read_only_action(action_name):
+            return
+        if isinstance(result, dict) and (result.get("error") or result.get("successfull") is False):
+            return
+        key = self.key(action_name, params)
+        entry = {"action": action_name, "expires_at": time.time() + self.ttl(action_name), "result": result}
+        with self._lock:
+            self._remember(key, entry)
+            try:
+                os.makedirs(self.directory, exist_ok=True)
+                write_json_atomic(self._path(key), entry)
+            except (OSError, TypeError):
+                pass
+
+    def _remember(self, key, entry):
+        self._memory[key] = entry
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            evicted, _ = self._memory.popitem(last=False)
+            try:
+                os.remove(self._path(evicted))
+            except OSError:
+                pass
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.stats)
+
+    def report(self, since):
+        """Prints hits/misses/bypasses accumulated since an earlier snapshot."""
+        if not self.enabled:
+            return
+        now = self.snapshot()
+        delta = {name: now[name] - since.get(name, 0) for name in now}
+        lookups = delta["hits"] + delta["misses"]
+        rate = f"{100 * delta['hits'] / lookups:.0f}%" if lookups else "n/a"
+        print(f"{Colors.OKBLUE}Result cache: {delta['hits']} hits, {delta['misses']} misses ({rate} hit rate), {delta['bypassed']} mutating calls bypassed{Colors.ENDC}")
+
+result_cache = ResultCache()
+
+@retry_with_policy(breaker_key=lambda action_name, params: f"composio:{app_for_action(action_name)}")
+def execute_composio_action(action_name, params):
+    """
+    Execute Composio action with retry logic. Exceptions propagate to the
+    retry policy, which classifies them; the app's circuit breaker stops
+    calls to an app that keeps failing.
+    """
+    print(f"Executing Composio action: {action_name} with params: {params}")
+
+    limit_key = f"composio:{app_for_action(action_name)}"
+    rate_limiter.acquire(limit_key)
+    try:
+        result = get_toolset().execute_action(
             action=action_name,
             params=params
         )
+    except Exception as e:
+        rate_limiter.observe_error(limit_key, e)
+        raise
 
-        print(f"Composio action result: {result}") # Debug print in action function
+    # If we get None result, it actually succeeded for Composio actions
+    if result is None:
+        return {"successfull": True}
 
-        # If we get None result, it actually succeeded for Composio actions
-        if result is None:
-            return {"successfull": True}
+    # Handle explicit errors in result dict
+    if isinstance(result, dict) and result.get("error"):
+        if "No metadata found for enum" in str(result.get("error")):
+            print(f"{Colors.WARNING}Invalid action name: {action_name}{Colors.ENDC}")
+        else:
+            print(f"{Colors.WARNING}Action error: {result['error']}{Colors.ENDC}")
+        # Returned rather than raised; the retry policy classifies it
+        rate_limiter.observe_error(limit_key, result["error"])
+        return result
 
-        # Handle explicit errors in result dict
-        if isinstance(result, dict) and result.get("error"):
-            if "No metadata found for enum" in str(result.get("error")):
-                print(f"{Colors.WARNING}Invalid action name: {action_name}{Colors.ENDC}")
-            else:
-                print(f"{Colors.WARNING}Action error: {result['error']}{Colors.ENDC}")
-            # Do not raise exception here, let retry handle it
-            return result # Return error dict for retry logic to handle
-        elif result is None: # Treat explicit None as error after debug print
-            return {"successfull": False, "error": "Composio action returned None unexpectedly."} # Return error dict
+    return result
 
-        return result
+# ------------------------------------------------------------------------------
+# Speculative Prefetch
+# ------------------------------------------------------------------------------
 
-    except Exception as e:
-        print(f"{Colors.FAIL}Action execution error: {str(e)}{Colors.ENDC}")
-        return {"error": str(e)}
+ACTION_NAME_PATTERN = re.compile(r"\b([A-Z][A-Z0-9]*_[A-Z0-9_]*[A-Z0-9])\b")
+# action="X", params={...} or "action": "X", "params": {...} in plan text
+PLANNED_CALL_PATTERN = re.compile(r"""["']?action["']?\s*[=:]\s*["']([A-Z][A-Z0-9_]+)["']\s*,\s*["']?params["']?\s*[=:]\s*(?=\{)""")
+
+def connection_known_active(app_name):
+    with connection_lock:
+        entry = connection_cache.get(app_name.lower())
+    return bool(entry and entry.get("active") and time.time() - entry.get("checked_at", 0) < CONNECTION_CACHE_TTL)
+
+class Prefetcher:
+    """
+    Speculative work for a session's next turn, run on prefetch_executor.
+
+    Apps named in the model's plan text get their connection status and
+    the Composio toolset warmed. With `results` (ORB_PREFETCH_RESULTS=1),
+    read-only actions that can be predicted exactly are also executed in
+    the background:
+    - calls spelled out in the plan text with their params
+    - calls that failed as unauthorized, once their app is connected
+    A matching call in the next turn claims the result instead of executing.
+    Work that is not claimed by the end of that turn is cancelled, or
+    counted as wasted if it already ran. Names that are not Composio apps,
+    and apps found not connected, are not checked again for INACTIVE_TTL
+    seconds.
+    """
+
+    INACTIVE_TTL = 300
+
+    def __init__(self, metrics, enabled=PREFETCH_ENABLED, results=PREFETCH_RESULTS):
+        self.metrics = metrics
+        self.enabled = enabled
+        self.results = results
+        self._turn = 0
+        self._actions = {}
+        self._connections = {}
+        # app name -> when it was last found unknown or not connected
+        self._inactive = {}
+        self._after_auth = defaultdict(dict)
+        self._lock = threading.Lock()
+
+    def _count(self, name, amount=1):
+        with self._lock:
+            self.metrics[f"prefetch_{name}"] += amount
+
+    def warm_connection(self, app_name):
+        if not self.enabled or not app_name or connection_known_active(app_name):
+            return
+        with self._lock:
+            future = self._connections.get(app_name)
+            if future and not future.done():
+                return
+            if time.monotonic() - self._inactive.get(app_name, float("-inf")) < self.INACTIVE_TTL:
+                return
+            self._connections[app_name] = prefetch_executor.submit(self._check_connection, app_name)
+        self._count("connections")
+
+    def _check_connection(self, app_name):
+        active = is_known_app(app_name) and check_existing_connection(app_name)
+        if not active:
+            with self._lock:
+                self._inactive[app_name] = time.monotonic()
+        return active
+
+    def prefetch_action(self, action, params):
+        if not (self.enabled and self.results and is_read_only_action(action)):
+            return
+        key = (action, canonical_json(params))
+        with self._lock:
+            if key in self._actions:
+                return
+            entry = self._actions[key] = {"turn": self._turn, "started": time.perf_counter()}
+            entry["future"] = prefetch_executor.submit(self._run_action, action, params, entry)
+        self._count("started")
+
+    @staticmethod
+    def _run_action(action, params, entry):
+        with tracer.span("prefetch", action) as span:
+            if not check_existing_connection(app_for_action(action)):
+                span["outcome"] = "not_connected"
+                return False, None
+            start = time.perf_counter()
+            result = execute_composio_action(action, params)
+            entry["duration"] = time.perf_counter() - start
+            if isinstance(result, dict) and (result.get("error") or result.get("successfull") is False):
+                span["outcome"] = "error"
+                return False, None
+            return True, result
+
+    def claim(self, action, params):
+        """Returns (hit, result) for a call this session prefetched, waiting for it if still running."""
+        with self._lock:
+            entry = self._actions.pop((action, canonical_json(params)), None)
+        if entry is None:
+            return False, None
+        waited = time.perf_counter()
+        try:
+            ok, result = entry["future"].result()
+        except Exception:
+            ok, result = False, None
+        waited = time.perf_counter() - waited
+        if not ok:
+            self._count("failed")
+            return False, None
+        self._count("used")
+        self._count("saved_ms", round(max(0.0, entry.get("duration", 0.0) - waited) * 1000))
+        return True, result
+
+    def observe_plan(self, content, tool_calls=()):
+        """Speculates on the actions named in a turn's text, skipping calls the turn already makes."""
+        if not self.enabled or not content:
+            return
+        in_flight = set()
+        for tool_call in tool_calls:
+            args = parse_tool_arguments(tool_call)
+            in_flight.add((args.get("action") or args.get("action_name"), canonical_json(args.get("params", {}))))
+
+        planned = []
+        decoder = json.JSONDecoder()
+        for match in PLANNED_CALL_PATTERN.finditer(content):
+            try:
+                params, _ = decoder.raw_decode(content, match.end())
+            except ValueError:
+                continue
+            if isinstance(params, dict) and (match.group(1), canonical_json(params)) not in in_flight:
+                planned.append((match.group(1), params))
+        for action, params in planned[:PREFETCH_MAX_PER_TURN]:
+            self.prefetch_action(action, params)
+
+        apps = []
+        for name in ACTION_NAME_PATTERN.findall(content):
+            app_name = app_for_action(name)
+            if not name.startswith("COMPOSIO_") and app_name not in apps:
+                apps.append(app_name)
+        for app_name in apps[:PREFETCH_MAX_PER_TURN]:
+            self.warm_connection(app_name)
+
+    def observe_results(self, outcomes):
+        """
+        Remembers read-only calls that failed as unauthorized, and prefetches
+        them once a connection check for their app succeeds.
+        """
+        if not self.enabled:
+            return
+        for function_name, args, result in outcomes:
+            if not isinstance(args, dict) or not isinstance(result, dict):
+                continue
+            if function_name == "COMPOSIO_EXECUTE_ACTION":
+                action = args.get("action") or args.get("action_name")
+                error = str(result.get("error", "")).lower()
+                if action and ("unauthorized" in error or result.get("authorization_required")):
+                    params = args.get("params", {})
+                    self._after_auth[app_for_action(action)][(action, canonical_json(params))] = (action, params)
+            elif function_name == "COMPOSIO_INITIATE_CONNECTION" and args.get("tool"):
+                data = result.get("data") or {}
+                if data.get("active_connection") or (result.get("successfull") and not data.get("response_data")):
+                    self.connection_ready(args["tool"])
+
+    def connection_ready(self, app_name):
+        """An app was connected or authorized: warm it and rerun its unauthorized calls."""
+        app_name = str(app_name).lower()
+        with self._lock:
+            self._inactive.pop(app_name, None)
+        self.warm_connection(app_name)
+        for action, params in self._after_auth.pop(app_name, {}).values():
+            self.prefetch_action(action, params)
+
+    def end_turn(self):
+        """Drops speculation from before the turn that just ended."""
+        with self._lock:
+            self._turn += 1
+            stale = [key for key, entry in self._actions.items() if entry["turn"] < self._turn - 1]
+            entries = [self._actions.pop(key) for key in stale]
+        self._discard(entries)
+
+    def close(self):
+        with self._lock:
+            entries = list(self._actions.values())
+            self._actions.clear()
+        self._discard(entries)
+
+    def _discard(self, entries):
+        for entry in entries:
+            self._count("cancelled" if entry["future"].cancel() else "wasted")
+
+    def summary(self):
+        started = self.metrics.get("prefetch_started", 0)
+        if not started and not self.metrics.get("prefetch_connections", 0):
+            return None
+        return (f"Prefetch: {started} speculative calls, {self.metrics.get('prefetch_used', 0)} used, "
+                f"{self.metrics.get('prefetch_wasted', 0)} wasted, {self.metrics.get('prefetch_cancelled', 0)} cancelled "
+                f"({self.metrics.get('prefetch_saved_ms', 0)} ms saved); "
+                f"{self.metrics.get('prefetch_connections', 0)} connection checks warmed")
+
+# ------------------------------------------------------------------------------
+# Argument Validation
+# ------------------------------------------------------------------------------
+
+# Argument names models mix up; a missing property is filled from another name in its group
+ARGUMENT_ALIASES = (
+    ("action", "action_name", "actionName"),
+    ("params", "parameters", "arguments", "args"),
+    ("text", "content", "body"),
+    ("package_name", "package"),
+)
+# Python type names sometimes written into dynamic tool schemas
+SCHEMA_TYPE_NAMES = {"str": "string", "int": "integer", "float": "number", "bool": "boolean", "dict": "object", "list": "array"}
+JSON_TYPE_CHECKS = {
+    "string": lambda value: isinstance(value, str),
+    "integer": lambda value: isinstance(value, int) and not isinstance(value, bool),
+    "number": lambda value: isinstance(value, (int, float)) and not isinstance(value, bool),
+    "boolean": lambda value: isinstance(value, bool),
+    "object": lambda value: isinstance(value, dict),
+    "array": lambda value: isinstance(value, list),
+    "null": lambda value: value is None,
+}
+MAX_ARGUMENT_ERRORS = 5
+
+def json_type(value):
+    for name in ("boolean", "integer", "number", "string", "object", "array", "null"):
+        if JSON_TYPE_CHECKS[name](value):
+            return name
+    return type(value).__name__
+
+def schema_types(schema):
+    """The known JSON types a schema allows, or None for any."""
+    declared = schema.get("type") if isinstance(schema, dict) else None
+    if declared is None:
+        return None
+    names = [SCHEMA_TYPE_NAMES.get(name, name) for name in (declared if isinstance(declared, list) else [declared])]
+    return [name for name in names if name in JSON_TYPE_CHECKS] or None
+
+def compile_validator(schema):
+    """
+    Compiles a JSON schema into a function `validate(value, path)` returning
+    a list of error strings. Covers what tool schemas use: type, enum,
+    required, properties, additionalProperties, items, anyOf/oneOf and
+    minimum/maximum. Other keywords are accepted without checking.
+    """
+    if not isinstance(schema, dict):
+        return lambda value, path: []
+    checks = []
+    types = schema_types(schema)
+    if types:
+        allowed = [JSON_TYPE_CHECKS[name] for name in types]
+        expected = " or ".join(types)
+        def check_type(value, path, errors):
+            if not any(check(value) for check in allowed):
+                errors.append(f"{path}: expected {expected}, got {json_type(value)}")
+                return False
+        checks.append(check_type)
+    if isinstance(schema.get("enum"), list):
+        options = schema["enum"]
+        def check_enum(value, path, errors):
+            if value not in options:
+                errors.append(f"{path}: must be one of {json.dumps(options)[:120]}")
+        checks.append(check_enum)
+    for keyword, fails in (("minimum", lambda value, bound: value < bound), ("maximum", lambda value, bound: value > bound)):
+        if isinstance(schema.get(keyword), (int, float)):
+            def check_bound(value, path, errors, keyword=keyword, bound=schema[keyword], fails=fails):
+                if JSON_TYPE_CHECKS["number"](value) and fails(value, bound):
+                    errors.append(f"{path}: {keyword} is {bound}")
+            checks.append(check_bound)
+    properties = schema.get("properties") if isinstance(schema.get("properties"), dict) else {}
+    required = [name for name in schema.get("required") or [] if isinstance(name, str)]
+    additional = schema.get("additionalProperties")
+    if properties or required or additional is not None:
+        property_validators = {name: compile_validator(subschema) for name, subschema in properties.items()}
+        additional_validator = compile_validator(additional) if isinstance(additional, dict) else None
+        def check_object(value, path, errors):
+            if not isinstance(value, dict):
+                return
+            for name in required:
+                if name not in value:
+                    errors.append(f"{path}.{name}: required")
+            for name, item in value.items():
+                if name in property_validators:
+                    errors.extend(property_validators[name](item, f"{path}.{name}"))
+                elif additional is False:
+                    errors.append(f"{path}.{name}: unexpected")
+                elif additional_validator:
+                    errors.extend(additional_validator(item, f"{path}.{name}"))
+        checks.append(check_object)
+    if isinstance(schema.get("items"), dict):
+        item_validator = compile_validator(schema["items"])
+        def check_items(value, path, errors):
+            if isinstance(value, list):
+                for index, item in enumerate(value):
+                    errors.extend(item_validator(item, f"{path}[{index}]"))
+        checks.append(check_items)
+    for keyword in ("anyOf", "oneOf"):
+        if isinstance(schema.get(keyword), list):
+            alternatives = [compile_validator(subschema) for subschema in schema[keyword]]
+            def check_alternatives(value, path, errors, alternatives=alternatives):
+                if alternatives and all(alternative(value, path) for alternative in alternatives):
+                    errors.append(f"{path}: matches none of the allowed schemas")
+            checks.append(check_alternatives)
+
+    def validate(value, path="$"):
+        errors = []
+        for check in checks:
+            # A wrong type makes the remaining checks noise
+            if check(value, path, errors) is False:
+                break
+        return errors
+    return validate
+
+# id(schema) -> (schema, validator), over validators shared by schema content hash
+_validators_by_id = {}
+_validators_by_hash = {}
+
+def validator_for(schema):
+    """The compiled validator for a schema, built once per distinct schema."""
+    cached = _validators_by_id.get(id(schema))
+    if cached is None or cached[0] is not schema:
+        digest = hashlib.sha256(canonical_json(schema).encode()).hexdigest()
+        validator = _validators_by_hash.get(digest)
+        if validator is None:
+            validator = _validators_by_hash[digest] = compile_validator(schema)
+        cached = _validators_by_id[id(schema)] = (schema, validator)
+    return cached[1]
+
+# Parsed SCHEMA_CACHE_FILE, reloaded when the file changes: (mtime, {action: parameters})
+_action_schemas = (None, {})
+# Apps whose schemas this process has already tried to fetch for argument checks
+_action_schema_apps = set()
+
+def cached_action_schema(action):
+    """
+    The parameters schema of a Composio action. Its app's schemas are
+    fetched into the local cache on first use, once per process.
+    """
+    if not action:
+        return None
+    schemas = _load_action_schemas()
+    app = app_for_action(action)
+    if action not in schemas and app not in _action_schema_apps:
+        _action_schema_apps.add(app)
+        try:
+            load_composio_tool_schemas(app)
+        except Exception as e:
+            print(f"{Colors.WARNING}Could not fetch Composio schemas for '{app}': {e}{Colors.ENDC}")
+            return None
+        schemas = _load_action_schemas()
+    return schemas.get(action)
+
+def _load_action_schemas():
+    """Every action schema in SCHEMA_CACHE_FILE, by action name."""
+    global _action_schemas
+    try:
+        mtime = os.path.getmtime(SCHEMA_CACHE_FILE)
+    except OSError:
+        return {}
+    if _action_schemas[0] != mtime:
+        schemas = {}
+        try:
+            with open(SCHEMA_CACHE_FILE) as f:
+                for entry in json.load(f).values():
+                    for tool in entry.get("tools", []):
+                        function = tool.get("function", {}) if isinstance(tool, dict) else {}
+                        if function.get("name"):
+                            schemas[function["name"]] = function.get("parameters")
+        except (OSError, ValueError, AttributeError):
+            pass
+        _action_schemas = (mtime, schemas)
+    return _action_schemas[1]
+
+def _coerce(value, types):
+    """A value converted to one of `types` when it is an obvious encoding of it, else None."""
+    if isinstance(value, str):
+        text = value.strip()
+        if ("object" in types or "array" in types) and text[:1] in "[{":
+            try:
+                parsed = json.loads(text)
+            except json.JSONDecodeError:
+                return None
+            return parsed if json_type(parsed) in types else None
+        if "integer" in types and re.fullmatch(r"-?\d+", text):
+            return int(text)
+        if "number" in types and re.fullmatch(r"-?\d+(\.\d+)?([eE][-+]?\d+)?", text):
+            return float(text)
+        if "boolean" in types and text.lower() in ("true", "false"):
+            return text.lower() == "true"
+    elif "string" in types and JSON_TYPE_CHECKS["number"](value):
+        return str(value)
+    return None
+
+def repair_arguments(schema, args, repairs, path="$"):
+    """
+    Returns a copy of `args` with common mistakes fixed: a missing property
+    filled from an alias (action_name -> action, content -> text) and
+    values JSON-encoded as strings, or given as the wrong scalar type,
+    converted. Each repair is appended to `repairs`.
+    """
+    properties = schema.get("properties") if isinstance(schema, dict) and isinstance(schema.get("properties"), dict) else {}
+    if not isinstance(args, dict) or not properties:
+        return args
+    args = dict(args)
+    for name in properties:
+        if name in args:
+            continue
+        group = next((group for group in ARGUMENT_ALIASES if name in group), ())
+        alias = next((key for key in group if key in args and key not in properties), None)
+        if alias:
+            args[name] = args.pop(alias)
+            repairs.append(f"{path}.{alias}->{name}")
+    for name, subschema in properties.items():
+        if name not in args or not isinstance(subschema, dict):
+            continue
+        types = schema_types(subschema)
+        if types and not any(JSON_TYPE_CHECKS[t](args[name]) for t in types):
+            coerced = _coerce(args[name], types)
+            if coerced is not None:
+                repairs.append(f"{path}.{name}:{json_type(args[name])}->{json_type(coerced)}")
+                args[name] = coerced
+        if isinstance(args[name], dict):
+            args[name] = repair_arguments(subschema, args[name], repairs, f"{path}.{name}")
+    return args
+
+def describe_parameters(schema):
+    """A one-line summary of a parameters schema, e.g. "text: string (required), title: string"."""
+    properties = schema.get("properties") or {}
+    required = set(schema.get("required") or [])
+    parts = [
+        f"{name}: {'|'.join(schema_types(subschema) or ['any'])}{' (required)' if name in required else ''}"
+        for name, subschema in properties.items()
+    ]
+    return ", ".join(parts)
+
+def check_arguments(function_name, args):
+    """
+    Repairs and validates a tool call's arguments against the tool's schema
+    and, for COMPOSIO_EXECUTE_ACTION, against the action's cached schema,
+    before anything runs. Returns (args, None), or (args, an error result
+    naming each problem) when the call should not be made.
+    """
+    session = current_session()
+    schema = session.registry.schema(function_name)
+    if schema is None:
+        return args, None
+    repairs = []
+    if isinstance(args, str):
+        # Arguments encoded twice
+        coerced = _coerce(args, ["object"])
+        if coerced is not None:
+            args = coerced
+            repairs.append("$:string->object")
+    if not isinstance(args, dict):
+        return args, {"error": f"Invalid arguments for '{function_name}': expected a JSON object, got {json_type(args)}."}
+
+    parameters = schema["function"].get("parameters") or {}
+    args = repair_arguments(parameters, args, repairs)
+    errors = validator_for(parameters)(args)
+    checked = parameters
+    if not errors and function_name == "COMPOSIO_EXECUTE_ACTION":
+        action = args.get("action") or args.get("action_name")
+        action_schema = cached_action_schema(action)
+        params = args.get("params", {})
+        if isinstance(params, str) and _coerce(params, ["object"]) is not None:
+            params = args["params"] = _coerce(params, ["object"])
+            repairs.append("$.params:string->object")
+        if action_schema and isinstance(params, dict):
+            args["params"] = repair_arguments(action_schema, params, repairs, "$.params")
+            errors = validator_for(action_schema)(args["params"], "$.params")
+            checked = action_schema
+
+    if repairs:
+        session.metrics["argument_repairs"] += len(repairs)
+        for repair in repairs:
+            # "$.params.content->text" counts as content->text, "$.count:string->integer" as string->integer
+            session.metrics["argument_repair:" + repair.rsplit(".", 1)[-1].split(":")[-1]] += 1
+        tracer.annotate(argument_repairs=repairs)
+        print(f"{Colors.WARNING}Repaired arguments for {function_name}: {', '.join(repairs)}{Colors.ENDC}")
+    if not errors:
+        return args, None
+    session.metrics["argument_errors"] += 1
+    tracer.annotate(outcome="invalid_arguments")
+    shown = "; ".join(errors[:MAX_ARGUMENT_ERRORS]) + (f"; +{len(errors) - MAX_ARGUMENT_ERRORS} more" if len(errors) > MAX_ARGUMENT_ERRORS else "")
+    return args, {"error": f"Invalid arguments for '{function_name}', not executed: {shown}. Expected: {describe_parameters(checked)[:400]}"}
 
 def call_tool(function_name, args):
     """Calls a registered tool and handles errors gracefully."""
-    func = available_functions.get(function_name)
+    session = current_session()
+    func = session.registry.get(function_name)
     if not func:
         print(f"{Colors.FAIL}{Colors.BOLD}Error:{Colors.ENDC} Tool '{function_name}' not found.")
         return f"Tool '{function_name}' not found."
@@ -227,52 +2531,412 @@ def call_tool(function_name, args):
                 return {"error": "Missing 'action' field in COMPOSIO_EXECUTE_ACTION"}
             
             params = args.get("params", {})
-            return execute_composio_action(action, params)
+            with tracer.span("execute_composio_action", action) as span:
+                hit, result = session.prefetcher.claim(action, params)
+                if hit:
+                    span["outcome"] = "prefetched"
+                    print(f"{Colors.OKGREEN}Using prefetched result for {action}{Colors.ENDC}")
+                    return result
+                hit, result = result_cache.get(action, params)
+                if hit:
+                    span["outcome"] = "cached"
+                    print(f"{Colors.OKGREEN}Using cached result for {action}{Colors.ENDC}")
+                    return result
+                result = execute_composio_action(action, params)
+                if isinstance(result, dict) and result.get("error"):
+                    span["outcome"] = "error"
+                    span["error"] = str(result["error"])[:200]
+                else:
+                    result_cache.put(action, params, result)
+            if isinstance(result, dict) and "unauthorized" in str(result.get("error", "")).lower():
+                invalidate_connection(app_for_action(action))
+            return result
         
         # Execute other functions normally
-        result = func(**args)
+        source = session.registry.source(function_name)
+        if source and SANDBOX_ENABLED:
+            result = sandbox_pool.run(function_name, source, args)
+        else:
+            result = func(**args)
         
         # Handle authorization responses
         if isinstance(result, dict):
             if result.get("data") and result["data"].get("response_data", {}).get("redirect_url"):
-                auth_url = result["data"]["response_data"]["redirect_url"]
-                instruction = result["data"].get("instruction", "Please complete authorization")
-                print(f"{Colors.WARNING}{Colors.BOLD}Authorization Required:{Colors.ENDC}")
-                print(f"{Colors.WARNING}URL: {auth_url}{Colors.ENDC}")
+                with input_lock:
+                    auth_url = result["data"]["response_data"]["redirect_url"]
+                    instruction = result["data"].get("instruction", "Please complete authorization")
+                    print(f"{Colors.WARNING}{Colors.BOLD}Authorization Required:{Colors.ENDC}")
+                    print(f"{Colors.WARNING}URL: {auth_url}{Colors.ENDC}")
 
-                user_choice = input(f"""{Colors.WARNING}{Colors.BOLD}Choose action:{Colors.ENDC}
+                    user_choice = session.choose("authorization", f"""{Colors.WARNING}{Colors.BOLD}Choose action:{Colors.ENDC}
 1: Complete authorization ({auth_url})
 2: Skip tool ({function_name}) authorization
 3: Redirect agent with new instructions
 4: Stop task
-Enter choice (1-4): """)
-
-                if user_choice == "1":
-                    print(f"{Colors.WARNING}Please complete authorization at the URL provided.{Colors.ENDC}")
-                    input("Press Enter after completing authorization...")
-                    return {"authorization_completed": True, "tool": function_name}
-                elif user_choice == "2":
-                    return {"skip_tool": True, "tool": function_name}
-                elif user_choice == "3":
-                    new_instructions = input("Enter new instructions: ")
-                    return {"redirect": True, "new_instructions": new_instructions}
-                elif user_choice == "4":
-                    return {"stop_task": True}
-                else:
-                    print(f"{Colors.WARNING}Invalid choice. Defaulting to skip tool.{Colors.ENDC}")
-                    return {"skip_tool": True, "tool": function_name}
+Enter choice (1-4): """, {"1": "authorize", "2": "skip", "3": "redirect", "4": "stop"}, default="skip")
+
+                    if user_choice == "authorize":
+                        print(f"{Colors.WARNING}Please complete authorization at the URL provided.{Colors.ENDC}")
+                        session.ask("Press Enter after completing authorization...")
+                        return {"authorization_completed": True, "tool": function_name}
+                    elif user_choice == "redirect":
+                        new_instructions = session.ask("Enter new instructions: ")
+                        return {"redirect": True, "new_instructions": new_instructions}
+                    elif user_choice == "stop":
+                        return {"stop_task": True}
+                    else:
+                        return {"skip_tool": True, "tool": function_name}
+
+            # If we see an explicit unauthorized error
+            elif "unauthorized" in str(result.get("error", "")).lower():
+                invalidate_connection(args.get("tool"))
+                print(f"{Colors.WARNING}{Colors.BOLD}Authorization Required:{Colors.ENDC} {result['error']}")
+                return {"authorization_required": True, "error": result["error"]}
+
+        return result
+
+    except Exception as e:
+        error_message = str(e)
+        print(f"{Colors.FAIL}{Colors.BOLD}Error:{Colors.ENDC} Error executing '{function_name}': {e}")
+        return f"Error executing '{function_name}': {e}"
+
+def run_tool_call(tool_call):
+    """
+    Decodes a tool call's arguments, runs it through call_tool and serializes
+    the result. Returns (result, serialized content).
+    """
+    function_name = tool_call["function"]["name"]
+    arguments = tool_call["function"]["arguments"] or "{}"
+    with tracer.span("call_tool", function_name, args_bytes=len(arguments)) as span:
+        try:
+            args = json.loads(arguments)
+        except json.JSONDecodeError as e:
+            args = None
+            result = f"Invalid JSON arguments for '{function_name}': {e}"
+        else:
+            args, invalid = check_arguments(function_name, args)
+            result = invalid or call_tool(function_name, args)
+        content = serialize_tool_result(result, tool_output_budget(function_name, args if isinstance(args, dict) else None))
+        span["result_bytes"] = len(content)
+        if content.startswith('{"_spilled"'):
+            span["spilled"] = True
+        if isinstance(result, dict) and result.get("error"):
+            span["outcome"] = "error"
+    return result, content
+
+def start_tool_call(tool_call):
+    """
+    Schedules a fully streamed tool call on the shared tool pool and returns
+    an awaitable for its result. The call runs in the caller's session.
+    """
+    context = contextvars.copy_context()
+    return asyncio.get_running_loop().run_in_executor(tool_executor, context.run, run_tool_call, tool_call)
+
+# Tools whose effects later calls in the same turn may rely on; they run after the calls before them
+ORDERED_TOOLS = {"install_package", "create_or_update_tool"}
+# Result keys that end or redirect a turn; calls queued behind such a result are not run
+TURN_CONTROL_KEYS = ("authorization_completed", "skip_tool", "redirect", "stop_task", "authorization_required")
+
+async def start_tool_call_after(tool_call, earlier):
+    """
+    Runs a tool call once the `earlier` calls of its turn have finished,
+    unless one of them stopped or redirected the turn.
+    """
+    for outcome in await asyncio.gather(*earlier, return_exceptions=True):
+        result = outcome[0] if isinstance(outcome, tuple) else None
+        if isinstance(result, dict) and any(result.get(key) for key in TURN_CONTROL_KEYS):
+            result = {"error": "Not run: an earlier call in this turn stopped or redirected the turn."}
+            return result, json.dumps(result)
+    return await start_tool_call(tool_call)
+
+async def stream_completion(messages, on_tool_call=None, tool_schemas=None, role=None):
+    """
+    Streams a completion, printing content tokens as they arrive.
+
+    Each tool call is handed to `on_tool_call` as soon as its arguments are
+    complete, i.e. when the stream moves on to the next tool call or ends.
+    Returns the assembled assistant message as a dict. `tool_schemas`
+    defaults to every registered tool and is sent in canonical order;
+    `role` picks the model pool and defaults to completion_role(messages).
+    """
+    register_composio_actions()
+    tool_registry = current_registry()
+    if tool_schemas is None:
+        tool_schemas = tool_registry.schemas()
+    tool_schemas = canonical_tools(tool_schemas)
+    role = role or completion_role(messages)
+    with tracer.span("completion", role, role=role, messages=len(messages), tools=len(tool_schemas), tools_registered=len(tool_registry)) as span:
+        attempt = 0
+        while True:
+            try:
+                model, response, first_chunk, latency = await model_router.open(role, messages, tool_schemas, span)
+                break
+            except Exception as e:
+                retryable, retry_after = classify_error(e)
+                if isinstance(e, CircuitOpenError) or not retryable:
+                    raise
+                attempt += 1
+                span["retries"] = attempt
+                if attempt >= default_retry_policy.max_attempts:
+                    raise
+                wait = default_retry_policy.delay(attempt, retry_after)
+                print(f"{Colors.WARNING}LLM retry {attempt}/{default_retry_policy.max_attempts - 1} in {wait:.1f}s after error: {e}{Colors.ENDC}")
+                await asyncio.sleep(wait)
+        # Output streams from here on and tools may start; a failure is never replayed
+        span["name"] = model
+        span["first_chunk_ms"] = round(latency * 1000, 3)
+        message = await _stream_completion(response, first_chunk, on_tool_call, span)
+        span["response_chars"] = len(message["content"] or "")
+        span["tool_calls"] = len(message.get("tool_calls", []))
+    session = active_session.get()
+    if session:
+        session.metrics["prompt_tokens"] += span.get("prompt_tokens") or 0
+        session.metrics["completion_tokens"] += span.get("completion_tokens") or 0
+        session.metrics["cached_prompt_tokens"] += span.get("cached_tokens") or 0
+        if span.get("cache_write_tokens"):
+            session.metrics["cache_write_tokens"] += span["cache_write_tokens"]
+        session.metrics[f"model:{model}"] += 1
+        if span.get("hedged"):
+            session.metrics["hedges"] += 1
+        if span.get("failovers"):
+            session.metrics["failovers"] += span["failovers"]
+    return message
+
+async def _stream_completion(response, first_chunk, on_tool_call, span):
+    session = active_session.get()
+    echo = session is None or session.echo
+    content_parts = []
+    tool_calls = {}
+    finished = set()
+
+    def finish(index):
+        if index in finished:
+            return
+        finished.add(index)
+        if on_tool_call:
+            on_tool_call(tool_calls[index])
+
+    async def chunks():
+        if first_chunk is not None:
+            yield first_chunk
+        async for chunk in response:
+            yield chunk
+
+    async for chunk in chunks():
+        usage = getattr(chunk, "usage", None)
+        if usage:
+            span["prompt_tokens"] = getattr(usage, "prompt_tokens", None)
+            span["completion_tokens"] = getattr(usage, "completion_tokens", None)
+            # OpenAI-style prompt_tokens_details.cached_tokens, or Anthropic's cache_read_input_tokens
+            details = getattr(usage, "prompt_tokens_details", None)
+            span["cached_tokens"] = getattr(details, "cached_tokens", None) or getattr(usage, "cache_read_input_tokens", None) or 0
+            if getattr(usage, "cache_creation_input_tokens", None):
+                span["cache_write_tokens"] = usage.cache_creation_input_tokens
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta
+        if getattr(delta, "content", None):
+            if echo:
+                if not content_parts:
+                    print(f"{Colors.OKCYAN}{Colors.BOLD}LLM Response:{Colors.ENDC}")
+                print(delta.content, end="", flush=True)
+            content_parts.append(delta.content)
+        for tc_delta in getattr(delta, "tool_calls", None) or []:
+            index = tc_delta.index if tc_delta.index is not None else len(tool_calls)
+            if index not in tool_calls:
+                # A new tool call starting means every earlier one is fully streamed
+                for earlier in sorted(tool_calls):
+                    finish(earlier)
+                tool_calls[index] = {"id": None, "type": "function", "function": {"name": "", "arguments": ""}}
+            entry = tool_calls[index]
+            if tc_delta.id:
+                entry["id"] = tc_delta.id
+            if tc_delta.function:
+                if tc_delta.function.name:
+                    entry["function"]["name"] += tc_delta.function.name
+                if tc_delta.function.arguments:
+                    entry["function"]["arguments"] += tc_delta.function.arguments
+
+    if content_parts and echo:
+        print("\n")
+    for index in sorted(tool_calls):
+        finish(index)
+
+    message = {"role": "assistant", "content": "".join(content_parts) or None}
+    if tool_calls:
+        message["tool_calls"] = [tool_calls[index] for index in sorted(tool_calls)]
+    return message
+
+# ------------------------------------------------------------------------------
+# Spill Store
+# ------------------------------------------------------------------------------
+
+SPILL_HANDLE_PATTERN = re.compile(r"^[0-9a-f]{16}$")
+JSONPATH_TOKEN_PATTERN = re.compile(r"""(\.\.?)([^.\[\]]+)|(\.\.)?\[\s*(\*|-?\d+|-?\d*\s*:\s*-?\d*|'[^']*'|"[^"]*")\s*\]""")
+
+def spill_default(value):
+    """json.dumps fallback matching what _BoundedWalker shows the model."""
+    if hasattr(value, "model_dump"):
+        return value.model_dump()
+    if isinstance(value, (set, tuple)):
+        return list(value)
+    return str(value)
+
+class SpillStore:
+    """
+    Content-addressed store for the full JSON of tool results that were too
+    large for their output budget. Each result is written once to
+    `directory/<handle>.json`, where the handle is a prefix of the SHA-256
+    of the JSON, and read back through a small pool of read-only memory
+    maps, so paging a large result costs a slice rather than a file read.
+    Results are ASCII JSON, so character offsets equal byte offsets.
+    """
+
+    def __init__(self, directory=SPILL_DIR, enabled=SPILL_ENABLED, ttl=SPILL_TTL, max_open=SPILL_OPEN_MAPS):
+        self.directory = directory
+        self.enabled = enabled
+        self.ttl = ttl
+        self.max_open = max_open
+        self._maps = OrderedDict()
+        self._lock = threading.Lock()
+        self._pruned = False
+
+    def _path(self, handle):
+        return os.path.join(self.directory, f"{handle}.json")
+
+    def spill(self, value):
+        """Stores a result and returns (handle, size in chars), or None when disabled or on failure."""
+        if not self.enabled:
+            return None
+        try:
+            data = json.dumps(value, default=spill_default).encode("ascii")
+            handle = hashlib.sha256(data).hexdigest()[:16]
+            path = self._path(handle)
+            if not os.path.exists(path):
+                os.makedirs(self.directory, exist_ok=True)
+                tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+                with open(tmp_path, "wb") as f:
+                    f.write(data)
+                os.replace(tmp_path, path)
+            self._prune()
+            return handle, len(data)
+        except (OSError, TypeError, ValueError) as e:
+            print(f"{Colors.WARNING}Could not spill tool result: {e}{Colors.ENDC}")
+            return None
+
+    def _prune(self):
+        """Deletes expired results, once per process."""
+        if self._pruned:
+            return
+        self._pruned = True
+        cutoff = time.time() - self.ttl
+        for entry in os.scandir(self.directory):
+            try:
+                if entry.stat().st_mtime < cutoff:
+                    os.remove(entry.path)
+            except OSError:
+                continue
+
+    def _map(self, handle):
+        if not SPILL_HANDLE_PATTERN.match(str(handle)):
+            raise KeyError(handle)
+        with self._lock:
+            mapped = self._maps.get(handle)
+            if mapped is not None:
+                self._maps.move_to_end(handle)
+                return mapped
+            try:
+                with open(self._path(handle), "rb") as f:
+                    mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except (OSError, ValueError):
+                raise KeyError(handle)
+            self._maps[handle] = mapped
+            while len(self._maps) > self.max_open:
+                self._maps.popitem(last=False)[1].close()
+            return mapped
+
+    def read(self, handle, offset, limit):
+        """Returns (text, total size) for `limit` chars of a spilled result from `offset`."""
+        mapped = self._map(handle)
+        return mapped[offset:offset + limit].decode("ascii"), len(mapped)
+
+    def load(self, handle):
+        """The spilled result, decoded."""
+        return json.loads(self._map(handle)[:])
+
+spill_store = SpillStore()
+
+def jsonpath_query(value, path):
+    """
+    Evaluates a small JSONPath subset: `$`, `.key`, `['key']`, `[n]`, `[*]`,
+    `.*`, `[start:end]` and `..key` (recursive descent). Returns the matches.
+    """
+    path = path.strip()
+    path = path[1:] if path.startswith("$") else path
+    if path and not path.startswith((".", "[")):
+        path = "." + path
+    matches = [value]
+    position = 0
+    while position < len(path):
+        token = JSONPATH_TOKEN_PATTERN.match(path, position)
+        if not token:
+            raise ValueError(f"unsupported JSONPath near '{path[position:]}'")
+        position = token.end()
+        if ".." in (token.group(1), token.group(3)):
+            matches = [node for match in matches for node in _descendants(match)]
+        key, index = token.group(2), token.group(4)
+        selected = []
+        for match in matches:
+            if key == "*" or index == "*":
+                selected.extend(match.values() if isinstance(match, dict) else match if isinstance(match, list) else [])
+            elif key is not None or index[0] in "'\"":
+                name = key if key is not None else index[1:-1]
+                if isinstance(match, dict) and name in match:
+                    selected.append(match[name])
+            elif ":" in index:
+                if isinstance(match, list):
+                    start, _, end = index.partition(":")
+                    selected.extend(match[int(start) if start.strip() else None:int(end) if end.strip() else None])
+            elif isinstance(match, list) and -len(match) <= int(index) < len(match):
+                selected.append(match[int(index)])
+        matches = selected
+    return matches
 
-            # If we see an explicit unauthorized error
-            elif "unauthorized" in str(result.get("error", "")).lower():
-                print(f"{Colors.WARNING}{Colors.BOLD}Authorization Required:{Colors.ENDC} {result['error']}")
-                return {"authorization_required": True, "error": result["error"]}
+def _descendants(value):
+    """The value and every container or leaf nested in it, depth first."""
+    yield value
+    children = value.values() if isinstance(value, dict) else value if isinstance(value, list) else ()
+    for child in children:
+        yield from _descendants(child)
 
-        return result
+def read_result(handle, offset=0, limit=4000):
+    """
+    Reads `limit` characters of a spilled tool result's JSON from `offset`.
+    The page is shrunk if needed so it fits the tool's output budget.
+    """
+    try:
+        offset, limit = max(0, int(offset)), max(1, int(limit))
+        budget = tool_output_budget("read_result") - 300
+        text, total = spill_store.read(handle, offset, limit)
+        # JSON escaping inflates the page, so shrink it until it fits
+        while len(json.dumps(text)) > budget and len(text) > 1:
+            text = text[:max(1, len(text) * budget // len(json.dumps(text)) - 1)]
+    except KeyError:
+        return {"error": f"Unknown result handle '{handle}'."}
+    except (TypeError, ValueError) as e:
+        return {"error": f"Invalid offset or limit: {e}"}
+    end = offset + len(text)
+    return {"handle": handle, "offset": offset, "total_chars": total, "next_offset": end if end < total else None, "text": text}
 
-    except Exception as e:
-        error_message = str(e)
-        print(f"{Colors.FAIL}{Colors.BOLD}Error:{Colors.ENDC} Error executing '{function_name}': {e}")
-        return f"Error executing '{function_name}': {e}"
+def query_result(handle, path):
+    """Selects parts of a spilled tool result with a JSONPath expression, e.g. $.data.messages[0:5].subject."""
+    try:
+        matches = jsonpath_query(spill_store.load(handle), path)
+    except KeyError:
+        return {"error": f"Unknown result handle '{handle}'."}
+    except ValueError as e:
+        return {"error": f"Invalid JSONPath '{path}': {e}"}
+    return {"handle": handle, "path": path, "count": len(matches), "matches": matches}
 
 # ------------------------------------------------------------------------------
 # Register Basic Tools
@@ -295,7 +2959,7 @@ register_tool(
                     "type": {"type": "string", "description": "Data type of the parameter."},
                     "description": {"type": "string", "description": "Description of the parameter."}
                 },
-                "required": ["type", "description"]
+                "required": ["type"]
             }
         }
     }
@@ -317,30 +2981,912 @@ register_tool(
     {}
 )
 
+register_tool(
+    "read_result",
+    read_result,
+    "Pages through the full JSON of a truncated tool result by its _spilled handle, without calling the tool again.",
+    {
+        "handle": {"type": "string", "description": "The handle from the result's _spilled field."},
+        "offset": {"type": "integer", "description": "Character offset to start from (0 for the start)."},
+        "limit": {"type": "integer", "description": "Number of characters to read."}
+    },
+    required=["handle"]
+)
+
+register_tool(
+    "query_result",
+    query_result,
+    "Extracts parts of a truncated tool result by its _spilled handle with a JSONPath expression.",
+    {
+        "handle": {"type": "string", "description": "The handle from the result's _spilled field."},
+        "path": {"type": "string", "description": "JSONPath, e.g. $.data.messages[0:5].subject or $..id."}
+    }
+)
+
+def composio_version():
+    """Returns the installed Composio version, used to key the schema cache."""
+    from importlib import metadata
+    for distribution in ("composio-core", "composio-openai"):
+        try:
+            return metadata.version(distribution)
+        except metadata.PackageNotFoundError:
+            continue
+    return "unknown"
+
+def load_composio_tool_schemas(app_name="composio"):
+    """
+    Returns the tool schemas for a Composio app, served from SCHEMA_CACHE_FILE
+    while fresh. Entries are keyed by app and Composio version, so upgrading
+    Composio refetches them.
+    """
+    key = f"{app_name}@{composio_version()}"
+    try:
+        with open(SCHEMA_CACHE_FILE) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        cache = {}
+
+    entry = cache.get(key)
+    if entry and time.time() - entry.get("fetched_at", 0) < SCHEMA_CACHE_TTL:
+        return entry["tools"]
+
+    from composio_openai import App
+    schemas = get_toolset().get_tools(apps=[getattr(App, app_name.upper())])
+    cache = {k: v for k, v in cache.items() if not k.startswith(f"{app_name}@")}
+    cache[key] = {"fetched_at": time.time(), "tools": schemas}
+    try:
+        write_json_atomic(SCHEMA_CACHE_FILE, cache)
+    except (OSError, TypeError) as e:
+        print(f"{Colors.WARNING}Could not persist Composio schema cache: {e}{Colors.ENDC}")
+    return schemas
+
+def run_composio_tool(tool_name, **kwargs):
+    """Runs one of the directly registered Composio tools within the Composio app's rate limit."""
+    limit_key = f"composio:{app_for_action(tool_name)}"
+    rate_limiter.acquire(limit_key)
+    try:
+        return get_toolset().execute_action(action=tool_name, params=kwargs)
+    except Exception as e:
+        rate_limiter.observe_error(limit_key, e)
+        raise
+
 # Incorporate only specific Composio actions we need
 def register_composio_actions():
-    """Register Composio tools directly."""
-    composio_tools = toolset.get_tools(apps=[App.COMPOSIO])
-    for tool in composio_tools:
-        tools.append(tool)
+    """
+    Register Composio tools directly. Deferred until the first LLM call so
+    startup never waits on the schema fetch; later calls are no-ops.
+    """
+    global _composio_tools_registered
+    if _composio_tools_registered:
+        return
+    for tool in load_composio_tool_schemas("composio"):
         name = tool['function']['name']
-        available_functions[name] = lambda tool_name=name, **kwargs: toolset.execute_action(
-            action=tool_name,
-            params=kwargs
+        registry.register(name, lambda tool_name=name, **kwargs: run_composio_tool(tool_name, **kwargs), tool)
+    _composio_tools_registered = True
+
+load_connection_cache()
+
+# ------------------------------------------------------------------------------
+# Tool Selection
+# ------------------------------------------------------------------------------
+
+TOKEN_STOPWORDS = {"a", "an", "and", "the", "to", "of", "for", "in", "on", "with", "is", "it", "by", "or", "as", "be", "this", "that"}
+
+def tokenize(text):
+    """Lower-cased word tokens, splitting snake_case and camelCase."""
+    text = re.sub(r"([a-z0-9])([A-Z])", r"\1 \2", str(text or ""))
+    return [token for token in re.findall(r"[a-z0-9]+", text.lower()) if token not in TOKEN_STOPWORDS]
+
+class ToolIndex:
+    """
+    Offline BM25 index over registered tool names and descriptions.
+
+    `select` returns the pinned tools, any tools explicitly expanded for the
+    task, and the top-k tools most relevant to the query, in registry order.
+    Below `top_k` plus the pinned count, every tool is sent.
+    """
+
+    def __init__(self, top_k=TOOL_SELECTION_TOP_K, pinned=PINNED_TOOLS, k1=1.2, b=0.75):
+        self.top_k = top_k
+        self.pinned = set(pinned)
+        self.k1 = k1
+        self.b = b
+        self._built_for = None
+        self._docs = []
+        self._df = Counter()
+        self._avgdl = 0.0
+
+    def _build(self, tool_schemas, version=None):
+        key = version if version is not None else (id(tool_schemas), len(tool_schemas))
+        if key == self._built_for:
+            return
+        self._docs = []
+        self._df = Counter()
+        for schema in tool_schemas:
+            function = schema["function"]
+            # Names carry the most signal, so they are counted twice
+            terms = Counter(tokenize(function["name"]) * 2 + tokenize(function.get("description", "")))
+            self._docs.append((function["name"], terms, sum(terms.values())))
+            self._df.update(terms.keys())
+        self._avgdl = sum(length for _, _, length in self._docs) / max(1, len(self._docs))
+        self._built_for = key
+
+    def scores(self, query, tool_schemas, version=None):
+        """Returns {tool name: BM25 score} for the query."""
+        self._build(tool_schemas, version)
+        query_terms = set(tokenize(query))
+        count = len(self._docs)
+        result = {}
+        for name, terms, length in self._docs:
+            score = 0.0
+            for term in query_terms:
+                tf = terms.get(term)
+                if not tf:
+                    continue
+                idf = math.log(1 + (count - self._df[term] + 0.5) / (self._df[term] + 0.5))
+                score += idf * tf * (self.k1 + 1) / (tf + self.k1 * (1 - self.b + self.b * length / self._avgdl))
+            result[name] = score
+        return result
+
+    def select(self, query, tool_schemas, expanded=(), version=None):
+        if len(tool_schemas) <= self.top_k + len(self.pinned):
+            return tool_schemas
+        keep = self.pinned | set(expanded)
+        scores = self.scores(query, tool_schemas, version)
+        ranked = sorted((name for name, score in scores.items() if score > 0 and name not in keep), key=lambda name: -scores[name])
+        keep.update(ranked[:self.top_k])
+        return [schema for schema in tool_schemas if schema["function"]["name"] in keep]
+
+
+def selection_query(messages, recent=6):
+    """Text used to rank tools: the task plus the latest user and assistant messages."""
+    texts = [messages[1].get("content") or ""] if len(messages) > 1 else []
+    for message in messages[-recent:]:
+        if message.get("role") in ("user", "assistant") and isinstance(message.get("content"), str):
+            texts.append(message["content"])
+    return "\n".join(texts)
+
+# ------------------------------------------------------------------------------
+# Context Window
+# ------------------------------------------------------------------------------
+
+class ContextWindow:
+    """
+    Keeps a conversation within a token budget.
+
+    Old tool outputs are compacted into short stubs first, then old assistant
+    text. The system prompt, the task message and the most recent
+    `keep_recent` messages are never touched, and no message is removed, so
+    every tool_call_id keeps its tool response.
+    """
+
+    def __init__(self, budget=CONTEXT_TOKEN_BUDGET, keep_recent=CONTEXT_KEEP_RECENT, model=MODEL_NAME):
+        self.budget = budget
+        self.keep_recent = keep_recent
+        self.model = model
+        self.total_saved = 0
+        # id(message) -> (content object the count was taken from, token count)
+        self._counts = {}
+        self._token_counter = None
+
+    def _count_fn(self):
+        if self._token_counter is None:
+            try:
+                from litellm import token_counter
+                self._token_counter = lambda message: token_counter(model=self.model, messages=[message])
+            except ImportError:
+                self._token_counter = lambda message: len(json.dumps(message, default=str)) // 4
+        return self._token_counter
+
+    def count(self, message):
+        """Returns the token count of a single message, cached until its content changes."""
+        content = message.get("content")
+        cached = self._counts.get(id(message))
+        if cached and cached[0] is content:
+            return cached[1]
+        try:
+            tokens = self._count_fn()(message)
+        except Exception:
+            tokens = len(json.dumps(message, default=str)) // 4
+        self._counts[id(message)] = (content, tokens)
+        return tokens
+
+    def total(self, messages):
+        return sum(self.count(message) for message in messages)
+
+    @staticmethod
+    def is_compacted(message):
+        content = message.get("content")
+        return isinstance(content, str) and content.startswith('{"compacted": true')
+
+    def _stub(self, message, tokens):
+        content = message.get("content") or ""
+        stub = {"compacted": True, "original_tokens": tokens, "preview": content[:CONTEXT_STUB_PREVIEW]}
+        if message.get("name"):
+            stub["tool"] = message["name"]
+        return json.dumps(stub)
+
+    def fit(self, messages):
+        """
+        Compacts `messages` in place until they fit the budget.
+
+        Returns (tokens_after, tokens_saved, compacted_indices).
+        """
+        tokens = self.total(messages)
+        if tokens <= self.budget:
+            return tokens, 0, []
+
+        before = tokens
+        compacted = []
+        # messages[0] is the system prompt and messages[1] the task
+        candidates = range(2, max(2, len(messages) - self.keep_recent))
+        for role in ("tool", "assistant"):
+            for index in candidates:
+                if tokens <= self.budget:
+                    break
+                message = messages[index]
+                if message.get("role") != role or not message.get("content") or self.is_compacted(message):
+                    continue
+                old_tokens = self.count(message)
+                stub = self._stub(message, old_tokens)
+                if len(stub) >= len(message["content"]):
+                    continue
+                message["content"] = stub
+                tokens += self.count(message) - old_tokens
+                compacted.append(index)
+
+        saved = before - tokens
+        self.total_saved += saved
+        return tokens, saved, compacted
+
+# ------------------------------------------------------------------------------
+# Loop Detection
+# ------------------------------------------------------------------------------
+
+# Built-in tools that only read; repeating one with the same arguments returns the same result
+READ_ONLY_TOOLS = {"read_result", "query_result"}
+
+def is_read_only_call(key):
+    """Whether a call key names a call that only reads, so it is safe to answer from memory."""
+    name, arguments, _ = key
+    if name in READ_ONLY_TOOLS:
+        return True
+    if name != "COMPOSIO_EXECUTE_ACTION":
+        return False
+    try:
+        action = json.loads(arguments).get("action")
+    except (TypeError, AttributeError, json.JSONDecodeError):
+        return False
+    return bool(action) and is_read_only_action(action)
+
+def is_failed_result(result):
+    """Whether a tool result reports an error rather than an answer."""
+    if isinstance(result, dict):
+        return bool(result.get("error")) or result.get("successfull") is False
+    return isinstance(result, str) and result.startswith(("Error", "Tool '")) and not result.endswith("successfully.")
+
+class ProgressTracker:
+    """
+    Notices when a task stops making progress.
+
+    Every tool call is fingerprinted as (tool name, canonical arguments, code
+    hash for dynamic tools) and every outcome as that key plus a hash of the
+    serialized result. An iteration makes progress when it produces an
+    outcome not seen before in the task. `record_turn` reports a no-progress
+    streak or a repeating cycle of iterations; `answer` returns the earlier
+    result for an identical read-only call so it is not executed again.
+    Failed results are never reused, and any call that is not read-only
+    drops everything remembered so far.
+    """
+
+    def __init__(self, no_progress_limit=LOOP_NO_PROGRESS_LIMIT, max_cycle=LOOP_MAX_CYCLE, dedupe=DEDUPE_TOOL_CALLS):
+        self.no_progress_limit = no_progress_limit
+        self.max_cycle = max_cycle
+        self.dedupe = dedupe
+        # read-only call key -> (iteration, result, content) of its last successful execution
+        self._calls = {}
+        self._outcomes = set()
+        self._turns = []
+        self.streak = 0
+        self.wasted = 0
+        self.duplicates = 0
+        self.escalations = 0
+
+    @staticmethod
+    def call_key(tool_call, registry):
+        name = tool_call["function"]["name"]
+        try:
+            arguments = canonical_json(json.loads(tool_call["function"].get("arguments") or "{}"))
+        except json.JSONDecodeError:
+            arguments = tool_call["function"].get("arguments")
+        source = registry.source(name)
+        return (name, arguments, source[0] if source else None)
+
+    def answer(self, key):
+        """The (result, content) to reuse for a repeated call, or None to execute it."""
+        entry = self._calls.get(key)
+        if not self.dedupe or entry is None:
+            return None
+        first_iteration, result, content = entry
+        self.duplicates += 1
+        try:
+            previous = json.loads(content)
+        except (TypeError, json.JSONDecodeError):
+            previous = content
+        return result, json.dumps({
+            "repeated_call": f"Identical to the call in iteration {first_iteration + 1}; not executed again. "
+                             "Repeating it will return the same result.",
+            "result": previous
+        })
+
+    def forget(self):
+        """Drops remembered results after new input (authorization, redirect) may have changed them."""
+        self._calls.clear()
+
+    def record_turn(self, iteration, calls):
+        """
+        Records one iteration's (key, result, content, answered) calls and
+        returns a description of the loop it completes, or None.
+        """
+        outcomes = []
+        progress = False
+        for key, result, content, answered in calls:
+            if answered and key in self._calls:
+                # Fingerprint the reused result, not the note wrapped around it
+                content = self._calls[key][2]
+            outcome = (key, hashlib.sha256(str(content).encode()).hexdigest())
+            outcomes.append(outcome)
+            if not answered:
+                if is_read_only_call(key) and not is_failed_result(result):
+                    self._calls[key] = (iteration, result, content)
+                progress = progress or outcome not in self._outcomes
+            self._outcomes.add(outcome)
+        self._turns.append(frozenset(outcomes))
+        # Any call that may write (an action, a dynamic tool, an install) can change what reads return
+        if any(not is_read_only_call(key) for key, _, _, _ in calls):
+            self.forget()
+
+        if progress:
+            self.streak = 0
+            return None
+        self.streak += 1
+        self.wasted += 1
+        if self.streak >= self.no_progress_limit:
+            return f"{self.streak} iterations in a row repeated earlier calls with the same results"
+        # The last `period` iterations repeat the `period` before them and none made progress
+        for period in range(1, self.max_cycle + 1):
+            if self.streak >= period and len(self._turns) >= 2 * period \
+                    and self._turns[-period:] == self._turns[-2 * period:-period]:
+                return f"the last {period} iteration(s) repeated the {period} before them"
+        return None
+
+    def corrective_message(self, reason, calls):
+        """A compact instruction telling the model which calls to stop repeating."""
+        repeated = sorted({f"{key[0]}({key[1]})"[:120] for key, _, _, _ in calls})
+        return (
+            f"Loop detected: {reason}. Repeated calls: {'; '.join(repeated)}. "
+            "Do not call them again with the same arguments. Use the results you already have, "
+            "change the arguments, try a different tool or approach, or call task_completed "
+            "explaining why the task cannot be finished."
         )
 
-# Replace the existing Composio tools registration with our new function
-register_composio_actions()
+    def reset(self):
+        """Starts a fresh streak after an escalation."""
+        self.streak = 0
+        self._turns.clear()
+
+# ------------------------------------------------------------------------------
+# Sessions
+# ------------------------------------------------------------------------------
+
+class Session:
+    """
+    State for one conversation: the tool registry it registers into, its tool
+    index and package installer, how it answers prompts, and its metrics.
+
+    Interactive sessions ask the user; headless ones answer every prompt from
+    `policy` (see HEADLESS_POLICY) and do not echo streamed output.
+    """
+
+    def __init__(self, tool_registry, interactive=True, policy=None, label=None):
+        self.registry = tool_registry
+        self.tool_index = ToolIndex()
+        self.installer = InstallManager()
+        self.interactive = interactive
+        self.echo = interactive
+        self.policy = {**HEADLESS_POLICY, **(policy or {})}
+        self.label = label
+        self.metrics = Counter()
+        self.prefetcher = Prefetcher(self.metrics)
+        # The checkpoint log of the task currently running, if any
+        self.log = None
+
+    @property
+    def prefix(self):
+        return f"[{self.label}] " if self.label is not None else ""
+
+    def choose(self, kind, prompt, options, default):
+        """
+        Returns the action for a `kind` of decision. `options` maps the
+        user's input to an action; invalid input falls back to `default`.
+        """
+        if not self.interactive:
+            action = self.policy.get(kind, default)
+            self.metrics[f"policy_{kind}_{action}"] += 1
+            print(f"{Colors.WARNING}{self.prefix}Headless policy for {kind}: {action}{Colors.ENDC}")
+            return action
+        with input_lock:
+            choice = input(prompt).strip()
+        if choice not in options:
+            print(f"{Colors.WARNING}Invalid choice. Defaulting to {default}.{Colors.ENDC}")
+            return default
+        return options[choice]
+
+    def ask(self, prompt):
+        """Free-text input; headless sessions never choose an action that needs it."""
+        if not self.interactive:
+            return ""
+        with input_lock:
+            return input(prompt)
+
+# The session for calls made outside run_task, e.g. tools run directly
+default_session = Session(registry)
+
+def current_session():
+    return active_session.get() or default_session
+
+def load_batch_tasks(source):
+    """
+    Reads headless tasks from a JSONL file, or stdin for "-". Each line is
+    either a JSON string or an object with a "task", an optional "id" and an
+    optional "policy" overriding HEADLESS_POLICY for that task.
+    """
+    stream = sys.stdin if source == "-" else open(source)
+    tasks = []
+    try:
+        for number, line in enumerate(stream, 1):
+            line = line.strip()
+            if not line:
+                continue
+            entry = json.loads(line)
+            if isinstance(entry, str):
+                entry = {"task": entry}
+            if not isinstance(entry, dict) or not isinstance(entry.get("task"), str):
+                raise ValueError(f"{source}:{number}: expected a string or an object with a 'task'")
+            entry.setdefault("id", str(number))
+            tasks.append(entry)
+    finally:
+        if stream is not sys.stdin:
+            stream.close()
+    return tasks
+
+async def run_batch(tasks, output_path, concurrency=BATCH_CONCURRENCY, policy=None):
+    """
+    Runs tasks headlessly, up to `concurrency` at a time, each in its own
+    session with a private message history and tool registry. One result
+    line per task is written to `output_path` as it finishes.
+    """
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+    cache_stats = result_cache.snapshot()
+
+    with open(output_path, "w") as output:
+        async def run_one(entry):
+            async with semaphore:
+                session = Session(
+                    ToolRegistry(parent=registry), interactive=False,
+                    policy={**(policy or {}), **entry.get("policy", {})}, label=entry["id"]
+                )
+                start = time.perf_counter()
+                try:
+                    result = await run_task(entry["task"], session)
+                except Exception as e:
+                    traceback.print_exc()
+                    result = {"outcome": "error", "error": f"{type(e).__name__}: {e}"}
+                record = {
+                    "id": entry["id"],
+                    "task": entry["task"],
+                    **result,
+                    "elapsed_s": round(time.perf_counter() - start, 3),
+                    "metrics": dict(session.metrics),
+                }
+                output.write(json.dumps(record, default=str) + "\n")
+                output.flush()
+                print(f"{Colors.OKBLUE}{session.prefix}{record['outcome']} in {record['elapsed_s']:.1f}s{Colors.ENDC}")
+                return record
+
+        records = await asyncio.gather(*(run_one(entry) for entry in tasks))
+
+    result_cache.report(cache_stats)
+    outcomes = Counter(record["outcome"] for record in records)
+    print(f"{Colors.OKGREEN}{Colors.BOLD}Batch finished:{Colors.ENDC} {len(records)} tasks ("
+          + ", ".join(f"{count} {outcome}" for outcome, count in sorted(outcomes.items()))
+          + f"); results in {output_path}")
+    return records
+
+# ------------------------------------------------------------------------------
+# Checkpoints
+# ------------------------------------------------------------------------------
+
+def new_session_id():
+    return f"{time.strftime('%Y%m%d-%H%M%S')}-{os.urandom(3).hex()}"
+
+def session_log_path(session_id):
+    return os.path.join(SESSIONS_DIR, f"{session_id}.jsonl")
+
+class SessionLog:
+    """
+    Append-only JSONL checkpoint of one task, under SESSIONS_DIR.
+
+    Records are "start", "message" (each new message, by index), "compact"
+    (a compaction stub replacing an earlier message's content), "tool_result"
+    (a tool call that finished before its turn was committed), "tool" (a
+    dynamic tool registered, by content hash), "iteration" (loop counters
+    after each iteration) and "end". Every record is flushed to the OS;
+    fsyncs happen in the background at most every CHECKPOINT_FSYNC_INTERVAL.
+    """
+
+    def __init__(self, session_id):
+        self.session_id = session_id
+        self.path = session_log_path(session_id)
+        os.makedirs(SESSIONS_DIR, exist_ok=True)
+        self._file = open(self.path, "a")
+        self._logged = 0
+        self._last_fsync = time.monotonic()
+        self._syncing = False
+        self._lock = threading.Lock()
+
+    def append(self, record):
+        with self._lock:
+            self._file.write(json.dumps(record, default=str) + "\n")
+            self._file.flush()
+            if not self._syncing and time.monotonic() - self._last_fsync >= CHECKPOINT_FSYNC_INTERVAL:
+                self._syncing = True
+                threading.Thread(target=self._fsync, daemon=True).start()
+
+    def _fsync(self):
+        try:
+            os.fsync(self._file.fileno())
+        except (OSError, ValueError):
+            pass
+        finally:
+            self._last_fsync = time.monotonic()
+            self._syncing = False
+
+    def start(self, task, messages):
+        self.append({"type": "start", "task": task, "model": MODEL_NAME, "created_at": time.time()})
+        # The system prompt and the task are rebuilt from the start record
+        self._logged = len(messages)
+
+    def resume(self, messages, logged):
+        """Continues a log whose first `logged` messages are already recorded, writing the rest."""
+        self._logged = logged
+        self.sync_messages(messages)
+
+    def sync_messages(self, messages):
+        """Writes the messages appended since the last sync."""
+        for index in range(self._logged, len(messages)):
+            self.append({"type": "message", "index": index, "message": messages[index]})
+        self._logged = len(messages)
+
+    def compact(self, messages, indices):
+        for index in indices:
+            if index < self._logged:
+                self.append({"type": "compact", "index": index, "content": messages[index]["content"]})
+
+    def track(self, tool_call, future):
+        """Records the tool call's result as soon as it finishes."""
+        def done(future):
+            if future.cancelled() or future.exception():
+                return
+            self.append({"type": "tool_result", "tool_call_id": tool_call["id"], "name": tool_call["function"]["name"], "content": future.result()[1]})
+        if future.done():
+            # Reused results arrive already resolved; record them before the turn can end
+            done(future)
+        else:
+            future.add_done_callback(done)
+        return future
+
+    def commit(self, **counters):
+        self.append({"type": "iteration", **counters})
+
+    def end(self, outcome):
+        self.append({"type": "end", "outcome": outcome})
+
+    def close(self):
+        with self._lock:
+            try:
+                self._file.flush()
+                os.fsync(self._file.fileno())
+            except (OSError, ValueError):
+                pass
+            self._file.close()
+
+def load_session_log(session_id):
+    """
+    Rebuilds a task's state from its session log: the messages with their
+    compactions applied, the latest loop counters, the dynamic tools by
+    hash, and the outcome if the task ended. A tool call whose turn was
+    never committed gets its logged result, or an interrupted marker.
+    """
+    state = {"task": None, "counters": {}, "tools": {}, "outcome": None}
+    logged, compactions, tool_results = {}, {}, {}
+    with open(session_log_path(session_id)) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # A torn final write from a crash
+                break
+            kind = record.get("type")
+            if kind == "start":
+                state["task"] = record["task"]
+            elif kind == "message":
+                logged[record["index"]] = record["message"]
+                compactions.pop(record["index"], None)
+            elif kind == "compact":
+                compactions[record["index"]] = record["content"]
+            elif kind == "tool_result":
+                tool_results[record["tool_call_id"]] = record
+            elif kind == "tool":
+                state["tools"][record["name"]] = record
+            elif kind == "iteration":
+                state["counters"] = record
+            elif kind == "end":
+                state["outcome"] = record["outcome"]
+    if state["task"] is None:
+        raise ValueError(f"session '{session_id}' has no start record")
+
+    messages = task_messages(state["task"])
+    for index in sorted(index for index in logged if index >= len(messages)):
+        if index > len(messages):
+            # Replies made up by an earlier resume that did not log them
+            answer_pending_calls(messages, tool_results)
+        messages.append(logged[index])
+    for index, content in compactions.items():
+        if index < len(messages):
+            messages[index]["content"] = content
+    # Everything so far is in the log; replies added below are written when the task resumes
+    state["logged"] = len(messages)
+    answer_pending_calls(messages, tool_results)
+    state["messages"] = messages
+    return state
+
+def answer_pending_calls(messages, tool_results):
+    """
+    Gives every unanswered call of the last turn its logged result, or an
+    interrupted marker. Only the last turn can be uncommitted; it is an
+    assistant message and the results so far.
+    """
+    last = max(index for index, message in enumerate(messages) if message.get("role") != "tool")
+    answered = {message.get("tool_call_id") for message in messages[last + 1:]}
+    for tool_call in messages[last].get("tool_calls", []) if messages[last].get("role") == "assistant" else []:
+        if tool_call["id"] in answered:
+            continue
+        record = tool_results.get(tool_call["id"])
+        messages.append({
+            "role": "tool",
+            "name": tool_call["function"]["name"],
+            "tool_call_id": tool_call["id"],
+            "content": record["content"] if record else json.dumps({"error": "Interrupted before this tool call finished. Call it again if it is still needed."})
+        })
+
+def restore_tool(name, record):
+    """Registers a persisted tool version ({"hash", "description", "parameters"}) in the running session."""
+    try:
+        with open(os.path.join(TOOLS_DIR, f"{record['hash']}.py")) as f:
+            code = f.read()
+        func = compile_tool(name, code, record["hash"])
+    except Exception as e:
+        print(f"{Colors.WARNING}Could not restore tool '{name}': {e}{Colors.ENDC}")
+        return False
+    register_tool(name, func, record["description"], record["parameters"], quiet=True, source=(record["hash"], code))
+    return True
+
+def restore_session_tools(state):
+    """Registers the dynamic tools a resumed task had created, in the running session."""
+    for name, record in state["tools"].items():
+        restore_tool(name, record)
+
+# ------------------------------------------------------------------------------
+# Long-Term Memory
+# ------------------------------------------------------------------------------
+
+def preview_params(params):
+    """A copy of action params with long values shortened, for remembering as an example."""
+    if not isinstance(params, dict):
+        return params
+    preview = {}
+    for key, value in params.items():
+        text = value if isinstance(value, str) else canonical_json(value)
+        preview[key] = value if len(text) <= MEMORY_VALUE_PREVIEW else text[:MEMORY_VALUE_PREVIEW] + "..."
+    return preview
+
+class MemoryStore:
+    """
+    Long-term memory across tasks, in a local SQLite database.
+
+    Three kinds of entries are kept: Composio actions that succeeded (with an
+    example of their params), dynamic tools that were created (with the hash
+    of their code under TOOLS_DIR) and task outcomes. Each entry is indexed
+    with the words of the tasks it served, so `recall` finds what similar
+    earlier tasks used through an FTS5 query ranked by BM25, or by word
+    overlap where SQLite lacks FTS5.
+    """
+
+    def __init__(self, path=MEMORY_FILE, enabled=MEMORY_ENABLED):
+        self.path = path
+        self.enabled = enabled
+        self._db = None
+        self._fts = False
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if self._db is None:
+            db = sqlite3.connect(self.path, check_same_thread=False)
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS memories (id INTEGER PRIMARY KEY, kind TEXT NOT NULL, "
+                "key TEXT NOT NULL UNIQUE, text TEXT NOT NULL, detail TEXT NOT NULL, "
+                "uses INTEGER NOT NULL DEFAULT 1, updated REAL NOT NULL)"
+            )
+            try:
+                db.execute("CREATE VIRTUAL TABLE IF NOT EXISTS memories_fts USING fts5(text)")
+                self._fts = True
+            except sqlite3.OperationalError:
+                self._fts = False
+            db.commit()
+            self._db = db
+        return self._db
+
+    def _upsert(self, db, kind, key, text, detail):
+        row = db.execute("SELECT id, text FROM memories WHERE key = ?", (key,)).fetchone()
+        if row:
+            # Keep the words of every task the entry served, newest first
+            if text not in row[1]:
+                text = f"{text} {row[1]}"[:MEMORY_TEXT_LIMIT]
+            else:
+                text = row[1]
+            rowid = row[0]
+            db.execute(
+                "UPDATE memories SET text = ?, detail = ?, uses = uses + 1, updated = ? WHERE id = ?",
+                (text, canonical_json(detail), time.time(), rowid)
+            )
+        else:
+            rowid = db.execute(
+                "INSERT INTO memories (kind, key, text, detail, updated) VALUES (?, ?, ?, ?, ?)",
+                (kind, key, text[:MEMORY_TEXT_LIMIT], canonical_json(detail), time.time())
+            ).lastrowid
+        if self._fts:
+            db.execute("DELETE FROM memories_fts WHERE rowid = ?", (rowid,))
+            db.execute("INSERT INTO memories_fts (rowid, text) VALUES (?, ?)", (rowid, text))
+
+    def record_task(self, task, outcome, iterations, tokens, actions, tools):
+        """
+        Remembers a finished task: its outcome, the actions that succeeded
+        ({action: params}) and the tools it created ({name: record}).
+        """
+        if not self.enabled or not task:
+            return
+        words = " ".join(tokenize(task))
+        with self._lock:
+            try:
+                db = self._connect()
+                for action, params in actions.items():
+                    param_names = sorted(params) if isinstance(params, dict) else []
+                    self._upsert(db, "action", f"action:{action}:{','.join(param_names)}",
+                                 f"{' '.join(tokenize(action))} {words}", {"action": action, "params": preview_params(params)})
+                for name, record in tools.items():
+                    self._upsert(db, "tool", f"tool:{name}",
+                                 f"{' '.join(tokenize(name))} {' '.join(tokenize(record['description']))} {words}",
+                                 {"tool": name, **record})
+                self._upsert(db, "task", "task:" + hashlib.sha256(words.encode()).hexdigest()[:16], words, {
+                    "task": task[:200], "outcome": outcome, "iterations": iterations, "tokens": tokens,
+                    "actions": sorted(actions), "tools": sorted(tools)
+                })
+                db.commit()
+            except sqlite3.Error as e:
+                print(f"{Colors.WARNING}Could not update memory: {e}{Colors.ENDC}")
+
+    def recall(self, task, limit=MEMORY_RECALL_LIMIT):
+        """The (kind, detail) entries most relevant to a task, best first."""
+        terms = list(dict.fromkeys(tokenize(task)))
+        if not self.enabled or not terms or limit <= 0 or not os.path.exists(self.path):
+            return []
+        with self._lock:
+            try:
+                db = self._connect()
+                if self._fts:
+                    rows = db.execute(
+                        "SELECT m.kind, m.detail FROM memories_fts JOIN memories m ON m.id = memories_fts.rowid "
+                        "WHERE memories_fts MATCH ? ORDER BY bm25(memories_fts) LIMIT ?",
+                        (" OR ".join(f'"{term}"' for term in terms), limit)
+                    ).fetchall()
+                else:
+                    query = set(terms)
+                    scored = []
+                    for kind, text, detail in db.execute("SELECT kind, text, detail FROM memories"):
+                        overlap = len(query & set(text.split()))
+                        if overlap:
+                            scored.append((overlap, kind, detail))
+                    scored.sort(key=lambda row: row[0], reverse=True)
+                    rows = [(kind, detail) for _, kind, detail in scored[:limit]]
+            except sqlite3.Error as e:
+                print(f"{Colors.WARNING}Could not read memory: {e}{Colors.ENDC}")
+                return []
+        return [(kind, json.loads(detail)) for kind, detail in rows]
+
+def memory_message(entries):
+    """The note listing recalled entries, sent as a user message after the task."""
+    lines = []
+    for kind, detail in entries:
+        if kind == "action":
+            lines.append(f"- COMPOSIO_EXECUTE_ACTION worked with action=\"{detail['action']}\", params={canonical_json(detail['params'])}")
+        elif kind == "tool":
+            lines.append(f"- Tool {detail['tool']}({', '.join(detail.get('parameters', {}))}) exists: {detail['description']}")
+        else:
+            used = ", ".join(detail["actions"] + detail["tools"]) or "no tools"
+            lines.append(f"- Similar task \"{detail['task']}\" ended {detail['outcome']} after {detail['iterations']} "
+                         f"iteration(s) using {used}")
+    return "Notes from earlier tasks (reuse what fits; verify before relying on them):\n" + "\n".join(lines)
+
+memory_store = MemoryStore()
 
 # ------------------------------------------------------------------------------
 # Main Loop
 # ------------------------------------------------------------------------------
 
-def run_main_loop(user_input):
-    messages = [
-        {
-            "role": "system",
-            "content": """
+async def run_main_loop(user_input, resume=None):
+    """
+    Runs the interactive session: one task after another, for as long as the
+    user continues after a completed task. Tools created along the way stay
+    registered for the next task. `resume` continues a checkpointed task first.
+    """
+    session = Session(registry)
+    while True:
+        cache_stats = result_cache.snapshot()
+        try:
+            result = await run_task(user_input, session, resume)
+            resume = None
+        finally:
+            result_cache.report(cache_stats)
+            prompt_tokens = session.metrics["prompt_tokens"]
+            if prompt_tokens:
+                cached = session.metrics["cached_prompt_tokens"]
+                print(f"{Colors.OKBLUE}Prompt cache: {cached} of {prompt_tokens} prompt tokens served from cache ({100 * cached / prompt_tokens:.0f}%){Colors.ENDC}")
+            prefetch_summary = session.prefetcher.summary()
+            if prefetch_summary:
+                print(f"{Colors.OKBLUE}{prefetch_summary}{Colors.ENDC}")
+        if result["outcome"] != "completed":
+            return
+
+        user_choice = session.choose("completion", f"""{Colors.OKGREEN}{Colors.BOLD}Task Completed. Choose action:{Colors.ENDC}
+1: Continue with a new request
+2: Exit
+Enter choice (1-2): """, {"1": "continue", "2": "exit"}, default="exit")
+        if user_choice != "continue":
+            print(f"{Colors.WARNING}{Colors.BOLD}Exiting.{Colors.ENDC}")
+            return
+        user_input = session.ask(f"{Colors.BOLD}Describe your next task: {Colors.ENDC}")
+
+async def run_task(user_input, session=None, resume=None):
+    """
+    Works on a single task in `session` until it completes, is stopped, needs
+    authorization, or runs out of iterations. Returns a dict with the
+    "outcome", the "iterations" used, the agent's "final_message" and the
+    checkpoint "session" id. With `resume`, the task and its state are
+    rebuilt from that session's log instead.
+    """
+    session = session or Session(registry)
+    token = active_session.set(session)
+    try:
+        return await _run_task(user_input, session, resume)
+    finally:
+        active_session.reset(token)
+        if session.log:
+            session.log.close()
+            session.log = None
+
+# Static across iterations and sessions so providers can cache it as a prefix
+SYSTEM_PROMPT = """
 You are an AI agent that can dynamically create and use tools to perform tasks.
 You have access to a set of tools, including:
 - create_or_update_tool: Creates or updates a Python tool
@@ -363,7 +3909,6 @@ Error Handling:
 
 Available Resources:
 - Composio platform access (Twitter, Gmail, etc)
-- API keys: """ + api_keys_info + """
 
 Best Practices:
 - Use proper parameter names (action, params)
@@ -385,111 +3930,281 @@ COMPOSIO_EXECUTE_ACTION(
         "text": "Your Content"  # Note: it's 'text', not 'content'
     }
 )
-"""
-        },
+
+API keys available to tools as environment variables (values are never shown; read them with os.environ["NAME"] in tool code):
+""" + api_keys_info + "\n"
+
+def task_messages(user_input):
+    """The system prompt and the task every conversation starts with."""
+    return [
+        {"role": "system", "content": SYSTEM_PROMPT},
         {"role": "user", "content": user_input}
     ]
 
+async def _run_task(user_input, session, resume=None):
     iteration, max_iterations = 0, 50
     iterations_without_tool_call = 0
     last_agent_message_content = None
     last_tool_result = None
+    error_backoff = 0
+    context = ContextWindow()
+    progress = ProgressTracker()
+    # Tools the model reached for outside the selected set, or created this task
+    expanded_tools = set()
+    # What this task teaches long-term memory: {action: params} that succeeded, tools it created
+    learned_actions = {}
+    created_tools = set()
+    tokens_before = session.metrics["prompt_tokens"] + session.metrics["completion_tokens"]
+    task = user_input
+
+    if resume:
+        state = load_session_log(resume)
+        if state["outcome"]:
+            print(f"{Colors.WARNING}{Colors.BOLD}Session {resume} already ended: {state['outcome']}.{Colors.ENDC}")
+            return {"outcome": state["outcome"], "iterations": state["counters"].get("iteration", 0),
+                    "final_message": state["counters"].get("last_agent_message"), "session": resume}
+        messages = state["messages"]
+        task = state["task"]
+        counters = state["counters"]
+        iteration = counters.get("iteration", 0)
+        iterations_without_tool_call = counters.get("iterations_without_tool_call", 0)
+        last_agent_message_content = counters.get("last_agent_message")
+        expanded_tools.update(counters.get("expanded_tools", []))
+        restore_session_tools(state)
+        session_id = resume
+        print(f"{Colors.OKGREEN}{Colors.BOLD}Resuming session {resume}{Colors.ENDC} at iteration {iteration + 1} "
+              f"with {len(messages)} messages and {len(state['tools'])} restored tool(s)")
+    else:
+        messages = task_messages(user_input)
+        session_id = new_session_id()
+
+    log = session.log = SessionLog(session_id) if CHECKPOINT_ENABLED else None
+    if log:
+        if resume:
+            log.resume(messages, state["logged"])
+        else:
+            log.start(user_input, messages)
+            print(f"{Colors.OKBLUE}{session.prefix}Checkpointing to session {session_id} (resume with --resume {session_id}){Colors.ENDC}")
+
+    if not resume:
+        recalled = memory_store.recall(task)
+        if recalled:
+            # Recalled tools are offered this task even if the index would not pick them
+            for kind, detail in recalled:
+                if kind == "tool" and (detail["tool"] in session.registry or restore_tool(detail["tool"], detail)):
+                    expanded_tools.add(detail["tool"])
+            messages.append({"role": "user", "content": memory_message(recalled)})
+            session.metrics["memory_recalled"] += len(recalled)
+            print(f"{Colors.OKBLUE}{session.prefix}Recalled {len(recalled)} note(s) from earlier tasks{Colors.ENDC}")
+            if log:
+                log.sync_messages(messages)
+
+    def finish(outcome):
+        used = min(iteration + 1, max_iterations)
+        session.metrics["iterations"] += used
+        if progress.wasted or progress.duplicates:
+            session.metrics["wasted_iterations"] += progress.wasted
+            session.metrics["repeated_calls"] += progress.duplicates
+            session.metrics["loop_escalations"] += progress.escalations
+            print(f"{Colors.WARNING}{session.prefix}Loop detector: {progress.wasted} wasted iteration(s), "
+                  f"{progress.duplicates} repeated call(s) answered from earlier results{Colors.ENDC}")
+        session.prefetcher.close()
+        tools = {}
+        for name in created_tools:
+            source, schema = session.registry.source(name), session.registry.schema(name)
+            if source and schema:
+                function = schema["function"]
+                tools[name] = {"hash": source[0], "description": function["description"],
+                               "parameters": function["parameters"]["properties"]}
+        tokens = session.metrics["prompt_tokens"] + session.metrics["completion_tokens"] - tokens_before
+        memory_store.record_task(task, outcome, used, tokens, learned_actions, tools)
+        if log:
+            log.sync_messages(messages)
+            log.end(outcome)
+        return {"outcome": outcome, "iterations": used, "final_message": last_agent_message_content,
+                "session": session_id, "wasted_iterations": progress.wasted}
+
+    def decide_on_loop():
+        """Asks whether to continue, redirect or stop; headless sessions apply the loop policy."""
+        loop_options = {"1": "continue", "2": "redirect", "3": "stop"}
+        if (isinstance(last_tool_result, dict) and last_tool_result.get("authorization_required")):
+            return session.choose("loop", f"""{Colors.WARNING}{Colors.BOLD}Authorization Required for Composio Tool:{Colors.ENDC}
+Last tool error: {last_tool_result.get("error")}
+Choose action:
+1: Continue iteration
+2: Redirect agent with new instructions
+3: Stop task
+Enter choice (1-3): """, loop_options, default="continue")
+        return session.choose("loop", f"""{Colors.WARNING}{Colors.BOLD}Choose action:{Colors.ENDC}
+1: Continue iteration
+2: Redirect agent with new instructions
+3: Stop task
+Enter choice (1-3): """, loop_options, default="continue")
+
+    async def settle_started_calls(turn_start):
+        """
+        After a turn fails, waits for the tool calls it had already started and
+        records them with their results, so the model sees they ran instead of
+        issuing them (and their side effects) again. `turn_start` is the index
+        of the turn's assistant message, or None if it was never appended.
+        """
+        session.installer.release(requested_packages(
+            tool_call for tool_call in dispatched if tool_call["id"] not in answered
+        ))
+        results = await asyncio.gather(*pending_tool_calls, return_exceptions=True)
+        if turn_start is None:
+            turn_start = len(messages)
+            messages.append({"role": "assistant", "content": None, "tool_calls": list(dispatched)})
+        recorded = {message.get("tool_call_id") for message in messages[turn_start:] if message.get("role") == "tool"}
+        for tool_call, outcome in zip(dispatched, results):
+            if tool_call["id"] in recorded:
+                continue
+            if isinstance(outcome, BaseException):
+                content = json.dumps({"error": f"Tool call failed: {outcome}"})
+            else:
+                content = outcome[1]
+            messages.append({"role": "tool", "name": tool_call["function"]["name"], "tool_call_id": tool_call["id"], "content": content})
+        print(f"{Colors.WARNING}{session.prefix}Recorded {len(dispatched)} tool call(s) started before the error{Colors.ENDC}")
 
     while iteration < max_iterations:
-        print(f"{Colors.HEADER}{Colors.BOLD}Iteration {iteration + 1} running...{Colors.ENDC}")
+        print(f"{Colors.HEADER}{Colors.BOLD}{session.prefix}Iteration {iteration + 1} running...{Colors.ENDC}")
+        # Tool calls start running while the rest of the response streams in
+        pending_tool_calls = []
+        dispatched = []
+        call_keys = []
+        answered = set()
+        turn_start = None
+        # Calls after an ordered call wait for it (`gate`); consecutive ordered calls to one tool run together
+        gate, group, group_earlier = [], None, []
         try:
-            response = completion(model=MODEL_NAME, messages=messages, tools=tools, tool_choice="auto")
-            response_message = response.choices[0].message
+            context_tokens, tokens_saved, compacted = context.fit(messages)
+            if tokens_saved:
+                print(f"{Colors.OKBLUE}Context: {context_tokens} tokens after compacting {len(compacted)} messages (saved {tokens_saved} tokens){Colors.ENDC}")
+            if log and compacted:
+                log.compact(messages, compacted)
 
-            # Print the LLM content if any
-            if response_message.content:
-                print(f"{Colors.OKCYAN}{Colors.BOLD}LLM Response:{Colors.ENDC}\n{response_message.content}\n")
-                last_agent_message_content = response_message.content
+            register_composio_actions()
+            selected_tools = session.tool_index.select(
+                selection_query(messages), session.registry.schemas(), expanded_tools, session.registry.version
+            )
+            selected_names = {schema["function"]["name"] for schema in selected_tools}
+            turn_tools = set(session.registry.names())
+
+            def dispatch(tool_call):
+                nonlocal gate, group, group_earlier
+                dispatched.append(tool_call)
+                key = progress.call_key(tool_call, session.registry)
+                call_keys.append(key)
+                previous = progress.answer(key)
+                if previous is None:
+                    name = tool_call["function"]["name"]
+                    if name in ORDERED_TOOLS or name not in turn_tools:
+                        # Installs, tool changes and tools that may not exist yet wait for every earlier call
+                        if name != group:
+                            group, group_earlier, gate = name, list(pending_tool_calls), []
+                        earlier = group_earlier
+                    else:
+                        group, earlier = None, gate
+                    future = asyncio.ensure_future(start_tool_call_after(tool_call, earlier)) if earlier else start_tool_call(tool_call)
+                    if group is not None:
+                        gate.append(future)
+                else:
+                    # Identical to an earlier call: reuse its result instead of running it again
+                    print(f"{Colors.WARNING}{session.prefix}Repeated call to {key[0]}; reusing its earlier result{Colors.ENDC}")
+                    answered.add(tool_call["id"])
+                    future = asyncio.get_running_loop().create_future()
+                    future.set_result(previous)
+                pending_tool_calls.append(log.track(tool_call, future) if log else future)
+
+            response_message = await stream_completion(messages, on_tool_call=dispatch, tool_schemas=selected_tools)
+            error_backoff = 0
+            # Every install_package call of this turn has been scheduled
+            session.installer.release(requested_packages(
+                tool_call for tool_call in response_message.get("tool_calls", []) if tool_call["id"] not in answered
+            ))
+
+            if response_message["content"]:
+                last_agent_message_content = response_message["content"]
 
             # Add LLM response to conversation
+            turn_start = len(messages)
             messages.append(response_message)
+            if log:
+                log.sync_messages(messages)
+            session.prefetcher.observe_plan(response_message["content"], response_message.get("tool_calls", []))
 
-            if response_message.tool_calls:
+            if response_message.get("tool_calls"):
                 # Reset the no-tool-call counter
                 iterations_without_tool_call = 0
                 authorization_needed = False
                 tool_call_failed = False
 
-                # Process each tool call in the response
-                for tool_call in response_message.tool_calls:
-                    function_name = tool_call.function.name
-                    args = json.loads(tool_call.function.arguments)
-                    tool_result = call_tool(function_name, args)
-                    last_tool_result = tool_result
-
-                    # Handle special dict return signals
-                    if isinstance(tool_result, dict):
-                        if tool_result.get("authorization_completed"):
-                            messages.append({
-                                "role": "tool",
-                                "name": function_name,
-                                "tool_call_id": tool_call.id,
-                                "content": serialize_tool_result(tool_result)
-                            })
-                            messages.append({
-                                "role": "user",
-                                "content": f"Authorization completed for {tool_result['tool']}. Please proceed with the task."
-                            })
-                            break
-                        elif tool_result.get("skip_tool"):
-                            messages.append({
-                                "role": "tool",
-                                "name": function_name,
-                                "tool_call_id": tool_call.id,
-                                "content": serialize_tool_result(tool_result)
-                            })
-                            messages.append({
-                                "role": "user",
-                                "content": f"Please try an alternative approach without using {tool_result['tool']}."
-                            })
-                            break
-                        elif tool_result.get("redirect"):
-                            messages.append({
-                                "role": "tool",
-                                "name": function_name,
-                                "tool_call_id": tool_call.id,
-                                "content": serialize_tool_result(tool_result)
-                            })
-                            messages.append({
-                                "role": "user",
-                                "content": tool_result["new_instructions"]
-                            })
-                            break
-                        elif tool_result.get("stop_task"):
-                            messages.append({
-                                "role": "tool",
-                                "name": function_name,
-                                "tool_call_id": tool_call.id,
-                                "content": serialize_tool_result(tool_result)
-                            })
-                            print(f"{Colors.WARNING}{Colors.BOLD}Task stopped by user.{Colors.ENDC}")
-                            return
-                        elif tool_result.get("authorization_required"):
-                            # Add tool response for authorization required
-                            messages.append({
-                                "role": "tool",
-                                "name": function_name,
-                                "tool_call_id": tool_call.id,
-                                "content": serialize_tool_result(tool_result)
-                            })
-                            print(f"{Colors.WARNING}{Colors.BOLD}Authorization required. Please try again.{Colors.ENDC}")
-                            authorization_needed = True
-                            break
+                # Results come back in call order regardless of completion order
+                results = await asyncio.gather(*pending_tool_calls)
+                outcomes = [
+                    (tool_call, tool_call["function"]["name"], result)
+                    for tool_call, (result, _) in zip(response_message["tool_calls"], results)
+                ]
+                session.prefetcher.observe_results(
+                    (function_name, parse_tool_arguments(tool_call), result) for tool_call, function_name, result in outcomes
+                )
 
-                    # For normal returns, record the result as a tool message
-                    serialized_tool_result = serialize_tool_result(tool_result)
+                # Every tool_call_id gets its tool message, in the original order
+                for tool_call, (tool_result, content) in zip(response_message["tool_calls"], results):
+                    last_tool_result = tool_result
+                    function_name = tool_call["function"]["name"]
+                    session.metrics["tool_calls"] += 1
+                    if isinstance(tool_result, dict) and tool_result.get("error"):
+                        session.metrics["tool_errors"] += 1
+                    elif function_name == "COMPOSIO_EXECUTE_ACTION" and tool_call["id"] not in answered \
+                            and not (isinstance(tool_result, dict) and tool_result.get("successfull") is False):
+                        arguments = parse_tool_arguments(tool_call)
+                        if arguments.get("action"):
+                            learned_actions[arguments["action"]] = arguments.get("params") or {}
+                    if function_name not in selected_names and function_name in session.registry:
+                        expanded_tools.add(function_name)
+                    elif function_name == "create_or_update_tool" and "successfully" in str(tool_result):
+                        created = parse_tool_arguments(tool_call).get("name")
+                        if created:
+                            expanded_tools.add(created)
+                            created_tools.add(created)
                     messages.append({
                         "role": "tool",
-                        "name": function_name,
-                        "tool_call_id": tool_call.id,
-                        "content": serialized_tool_result
+                        "name": tool_call["function"]["name"],
+                        "tool_call_id": tool_call["id"],
+                        "content": content
                     })
 
+                # The first special signal in call order decides how the turn continues
+                for tool_call, function_name, tool_result in outcomes:
+                    if not isinstance(tool_result, dict):
+                        continue
+                    if tool_result.get("authorization_completed"):
+                        messages.append({
+                            "role": "user",
+                            "content": f"Authorization completed for {tool_result['tool']}. Please proceed with the task."
+                        })
+                        break
+                    elif tool_result.get("skip_tool"):
+                        messages.append({
+                            "role": "user",
+                            "content": f"Please try an alternative approach without using {tool_result['tool']}."
+                        })
+                        break
+                    elif tool_result.get("redirect"):
+                        messages.append({
+                            "role": "user",
+                            "content": tool_result["new_instructions"]
+                        })
+                        break
+                    elif tool_result.get("stop_task"):
+                        print(f"{Colors.WARNING}{Colors.BOLD}{session.prefix}Task stopped.{Colors.ENDC}")
+                        return finish("stopped")
+                    elif tool_result.get("authorization_required"):
+                        print(f"{Colors.WARNING}{Colors.BOLD}Authorization required. Please try again.{Colors.ENDC}")
+                        authorization_needed = True
+                        break
+
                     # Specifically handle connection initiation
                     if function_name == "COMPOSIO_INITIATE_CONNECTION" and isinstance(tool_result, dict):
                         if tool_result.get("data") and tool_result["data"].get("instruction"):
@@ -497,7 +4212,7 @@ COMPOSIO_EXECUTE_ACTION(
                             print(f"{Colors.WARNING}{Colors.BOLD}Authorization Required: {tool_result['data']['instruction']}{Colors.ENDC}")
                             print(f"{Colors.WARNING}{Colors.BOLD}Authorization URL: {tool_result['data']['response_data']['redirect_url']}{Colors.ENDC}")
 
-                            user_break_input = input(f"""{Colors.WARNING}{Colors.BOLD}Authorization Required for Composio Tool:{Colors.ENDC}
+                            user_break_input = session.choose("authorization", f"""{Colors.WARNING}{Colors.BOLD}Authorization Required for Composio Tool:{Colors.ENDC}
 Instruction: {tool_result['data']['instruction']}
 Authorization URL: {tool_result['data']['response_data']['redirect_url']}
 Choose action:
@@ -505,31 +4220,27 @@ Choose action:
 2: Redirect agent with new instructions
 3: Stop task
 4: Complete authorization and continue
-Enter choice (1-4): """)
+Enter choice (1-4): """, {"1": "skip", "2": "redirect", "3": "stop", "4": "authorize"}, default="skip")
 
-                            if user_break_input == '1':
-                                messages.append({
-                                    "role": "user",
-                                    "content": "The previous tool requires authorization. Please try an alternative approach."
-                                })
-                                break
-                            elif user_break_input == '2':
-                                new_instruction = input("Enter new instructions for the agent: ")
+                            if user_break_input == "redirect":
+                                new_instruction = session.ask("Enter new instructions for the agent: ")
                                 messages.append({"role": "user", "content": new_instruction})
                                 break
-                            elif user_break_input == '3':
-                                print(f"{Colors.WARNING}{Colors.BOLD}Stopping task based on user input.{Colors.ENDC}")
-                                return
-                            elif user_break_input == '4':
+                            elif user_break_input == "stop":
+                                print(f"{Colors.WARNING}{Colors.BOLD}{session.prefix}Stopping task: authorization required.{Colors.ENDC}")
+                                return finish("stopped")
+                            elif user_break_input == "authorize":
                                 print(f"{Colors.WARNING}{Colors.BOLD}Waiting for authorization to complete...{Colors.ENDC}")
-                                input("Press Enter after you have completed the authorization process...")
+                                session.ask("Press Enter after you have completed the authorization process...")
+                                app_name = parse_tool_arguments(tool_call).get("tool")
+                                if app_name:
+                                    session.prefetcher.connection_ready(app_name)
                                 messages.append({
                                     "role": "user",
                                     "content": "Authorization completed. Please proceed with checking connection and executing the action."
                                 })
                                 break
                             else:
-                                print(f"{Colors.WARNING}{Colors.BOLD}Invalid choice. Defaulting to skip tool.{Colors.ENDC}")
                                 messages.append({
                                     "role": "user",
                                     "content": "The previous tool requires authorization. Please try an alternative approach."
@@ -547,31 +4258,38 @@ Enter choice (1-4): """)
                     iterations_without_tool_call += 1
 
                 if authorization_needed:
-                    # Immediately break if we hit an authorization requirement
-                    break
+                    # Immediately stop if we hit an authorization requirement
+                    return finish("authorization_required")
 
                 # If 'task_completed' was in the calls, we're done
-                if 'task_completed' in [tc.function.name for tc in response_message.tool_calls]:
-                    print(f"{Colors.OKGREEN}{Colors.BOLD}Task completed.{Colors.ENDC}")
+                if 'task_completed' in [tc["function"]["name"] for tc in response_message["tool_calls"]]:
+                    print(f"{Colors.OKGREEN}{Colors.BOLD}{session.prefix}Task completed.{Colors.ENDC}")
+                    return finish("completed")
 
-                    # --- Post-task completion prompt ---
-                    user_choice_after_completion = input(f"""{Colors.OKGREEN}{Colors.BOLD}Task Completed. Choose action:{Colors.ENDC}
-1: Continue with a new request
-2: Exit
-Enter choice (1-2): """)
-
-                    if user_choice_after_completion == "1":
-                        new_user_task = input(f"{Colors.BOLD}Describe your next task: {Colors.ENDC}")
-                        run_main_loop(new_user_task) # Recursive call for new task
-                        return  # Exit current loop after starting new task
-                    elif user_choice_after_completion == "2":
-                        print(f"{Colors.WARNING}{Colors.BOLD}Exiting.{Colors.ENDC}")
-                        return  # Exit script
+                if messages[-1]["role"] == "user":
+                    # New input from the user may change what earlier calls would return
+                    progress.forget()
+                turn_calls = [
+                    (key, result, content, tool_call["id"] in answered)
+                    for key, tool_call, (result, content) in zip(call_keys, response_message["tool_calls"], results)
+                ]
+                loop_reason = progress.record_turn(iteration, turn_calls)
+                if loop_reason:
+                    progress.escalations += 1
+                    progress.reset()
+                    print(f"{Colors.WARNING}{Colors.BOLD}{session.prefix}Possible loop detected: {loop_reason}.{Colors.ENDC}")
+                    if progress.escalations == 1:
+                        # First time: tell the model what it keeps repeating
+                        messages.append({"role": "user", "content": progress.corrective_message(loop_reason, turn_calls)})
                     else:
-                        print(f"{Colors.WARNING}Invalid choice. Exiting.{Colors.ENDC}")
-                        return  # Exit script if invalid choice
-                    # --- End post-task completion prompt ---
-                    break # Break out of the main loop after handling completion
+                        user_break_input = decide_on_loop()
+                        if user_break_input == "redirect":
+                            new_instruction = session.ask("Enter new instructions for the agent: ")
+                            messages.append({"role": "user", "content": new_instruction})
+                            progress.forget()
+                        elif user_break_input == "stop":
+                            print(f"{Colors.WARNING}{Colors.BOLD}{session.prefix}Stopping task: no progress.{Colors.ENDC}")
+                            return finish("stopped")
 
             else:
                 # No tool calls in the LLM response => check for loop
@@ -579,44 +4297,73 @@ Enter choice (1-2): """)
                 if iterations_without_tool_call >= MAX_ITERATIONS_BEFORE_BREAK:
                     print(f"{Colors.WARNING}{Colors.BOLD}Possible loop detected. Agent last message:{Colors.ENDC}\n\"{last_agent_message_content}\"\n")
                     # Decide user action
-                    if (isinstance(last_tool_result, dict) and last_tool_result.get("authorization_required")):
-                        user_break_input = input(f"""{Colors.WARNING}{Colors.BOLD}Authorization Required for Composio Tool:{Colors.ENDC}
-Last tool error: {last_tool_result.get("error")}
-Choose action:
-1: Continue iteration
-2: Redirect agent with new instructions
-3: Stop task
-Enter choice (1-3): """)
-                    else:
-                        user_break_input = input(f"""{Colors.WARNING}{Colors.BOLD}Choose action:{Colors.ENDC}
-1: Continue iteration
-2: Redirect agent with new instructions
-3: Stop task
-Enter choice (1-3): """)
+                    user_break_input = decide_on_loop()
 
-                    if user_break_input == '2':
-                        new_instruction = input("Enter new instructions for the agent: ")
+                    if user_break_input == "redirect":
+                        new_instruction = session.ask("Enter new instructions for the agent: ")
                         messages.append({"role": "user", "content": new_instruction})
                         iterations_without_tool_call = 0
-                    elif user_break_input == '3':
-                        print(f"{Colors.WARNING}{Colors.BOLD}Stopping task based on user input.{Colors.ENDC}")
-                        break
+                    elif user_break_input == "stop":
+                        print(f"{Colors.WARNING}{Colors.BOLD}{session.prefix}Stopping task: possible loop.{Colors.ENDC}")
+                        return finish("stopped")
                     else:
                         iterations_without_tool_call = 0
 
         except Exception as e:
-            print(f"{Colors.FAIL}{Colors.BOLD}Error:{Colors.ENDC} Error in main loop: {e}")
+            session.metrics["loop_errors"] += 1
+            print(f"{Colors.FAIL}{Colors.BOLD}Error:{Colors.ENDC} {session.prefix}Error in main loop: {e}")
             traceback.print_exc()
+            if dispatched:
+                await settle_started_calls(turn_start)
+            # Back off only after failures, doubling up to the cap; rate limits start higher
+            floor = ERROR_BACKOFF_BASE * (5 if "ratelimit" in type(e).__name__.lower() else 1)
+            error_backoff = min(max(error_backoff * 2, floor), ERROR_BACKOFF_MAX)
+            print(f"{Colors.WARNING}Backing off {error_backoff:.1f}s before retrying...{Colors.ENDC}")
+            await asyncio.sleep(error_backoff)
 
         iteration += 1
-        sleep(2)
+        session.prefetcher.end_turn()
+        if log:
+            log.sync_messages(messages)
+            log.commit(
+                iteration=iteration, iterations_without_tool_call=iterations_without_tool_call,
+                last_agent_message=last_agent_message_content, expanded_tools=sorted(expanded_tools)
+            )
 
-    print(f"{Colors.WARNING}{Colors.BOLD}Max iterations reached or task completed.{Colors.ENDC}")
+    print(f"{Colors.WARNING}{Colors.BOLD}{session.prefix}Max iterations reached.{Colors.ENDC}")
+    return finish("max_iterations")
 
 # ------------------------------------------------------------------------------
 # Entrypoint
 # ------------------------------------------------------------------------------
 
-if __name__ == "__main__":
-    user_task = input(f"{Colors.BOLD}Describe the task you want to complete: {Colors.ENDC}")
-    run_main_loop(user_task)
\ No newline at end of file
+if __name__ == "__main__" and IS_SANDBOX_WORKER:
+    sandbox_worker_main()
+elif __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="A minimal self-extending agent.")
+    parser.add_argument("--batch", metavar="TASKS", help="Run tasks headlessly from a JSONL file ('-' reads stdin).")
+    parser.add_argument("--concurrency", type=int, default=BATCH_CONCURRENCY, help="Batch tasks run at once.")
+    parser.add_argument("--output", default="orb-lite.results.jsonl", help="Where batch results are written.")
+    parser.add_argument("--resume", metavar="SESSION", help="Continue a checkpointed task from its session log.")
+    parser.add_argument("--on-authorization", choices=["skip", "stop"], default=HEADLESS_POLICY["authorization"],
+                        help="What headless tasks do when a tool needs authorization.")
+    parser.add_argument("--on-loop", choices=["continue", "stop"], default=HEADLESS_POLICY["loop"],
+                        help="What headless tasks do when a possible loop is detected.")
+    cli_args = parser.parse_args()
+
+    if TOOL_RELOAD_ENABLED:
+        load_persisted_tools()
+    try:
+        if cli_args.batch:
+            asyncio.run(run_batch(
+                load_batch_tasks(cli_args.batch), cli_args.output, cli_args.concurrency,
+                {"authorization": cli_args.on_authorization, "loop": cli_args.on_loop}
+            ))
+        elif cli_args.resume:
+            asyncio.run(run_main_loop(None, resume=cli_args.resume))
+        else:
+            user_task = input(f"{Colors.BOLD}Describe the task you want to complete: {Colors.ENDC}")
+            asyncio.run(run_main_loop(user_task))
+    finally:
+        tracer.flush()
+        tracer.print_summary()
\ No newline at end of file